@@ -1,11 +1,26 @@
 import { useGame } from "../context/GameContextCore";
 
+/** 决策选项增量的字段路径前缀 */
+const OPTION_PREFIX = "event.decision_options.";
+
 /**
  * 轮次加载页面组件
- * 显示轮次加载状态和进度
+ * 显示轮次加载状态和进度，事件流式生成时实时显示已生成的内容
  */
 function RoundLoadingPage() {
-  const { currentRound } = useGame();
+  const { currentRound, streamingEvent } = useGame();
+
+  const situation = streamingEvent["situation"];
+  const title = streamingEvent["event.event_title"];
+  const description = streamingEvent["event.event_description"];
+  const options = Object.keys(streamingEvent)
+    .filter((path) => path.startsWith(OPTION_PREFIX))
+    .sort()
+    .map((path) => ({
+      key: path.slice(OPTION_PREFIX.length),
+      text: streamingEvent[path],
+    }));
+  const streaming = Boolean(situation || title || description || options.length);
 
   return (
     <div className="min-h-screen w-full bg-stone-950 overflow-hidden flex flex-col items-center justify-center p-4">
@@ -19,6 +34,22 @@ function RoundLoadingPage() {
       <p className="text-white text-lg mt-4">公司发展中...</p>
       <p className="text-white text-lg mt-4">第{currentRound}轮</p>
       <small className="text-white text-sm mt-4">一共5轮</small>
+
+      {/* 正在生成的本轮局势和事件 */}
+      {streaming && (
+        <div className="w-full mt-8 space-y-3 text-left">
+          {situation && <p className="text-stone-300 text-sm leading-relaxed">{situation}</p>}
+          {title && <p className="text-white text-base font-medium">{title}</p>}
+          {description && (
+            <p className="text-stone-200 text-sm leading-relaxed">{description}</p>
+          )}
+          {options.map(({ key, text }) => (
+            <p key={key} className="text-stone-300 text-sm">
+              {key}. {text}
+            </p>
+          ))}
+        </div>
+      )}
     </div>
   );
 }
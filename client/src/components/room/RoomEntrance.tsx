@@ -1,4 +1,4 @@
-import { useState, useRef, KeyboardEvent } from "react";
+import { useState, useRef, useEffect, KeyboardEvent } from "react";
 import { useGame } from "../../context/GameContextCore";
 import { Button } from "../Button";
 
@@ -12,13 +12,21 @@ function RoomEntrance() {
     playerName, 
     roomList, 
     loadingRoomList, 
-    fetchRoomList 
+    fetchRoomList,
+    subscribeRoomList
   } = useGame();
   const [teamCode, setTeamCode] = useState<string[]>(["", "", "", ""]);
   const [loading, setLoading] = useState<boolean>(false);
   const [showRoomList, setShowRoomList] = useState<boolean>(false);
   const inputRefs = useRef<(HTMLInputElement | null)[]>([]);
 
+  // 打开房间列表时订阅大厅变化，关闭时取消订阅
+  useEffect(() => {
+    if (!showRoomList) return;
+    return subscribeRoomList();
+    // eslint-disable-next-line react-hooks/exhaustive-deps
+  }, [showRoomList]);
+
   /**
    * 处理快速加入房间
    */
@@ -37,7 +45,6 @@ function RoomEntrance() {
    */
   const handleShowRoomList = (): void => {
     setShowRoomList(true);
-    fetchRoomList();
   };
 
   /**
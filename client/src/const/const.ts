@@ -111,6 +111,22 @@ export interface GameResult {
     impact: string;
   }[];
   final_report: string;
+  /** 本房间大模型调用的token用量和费用 */
+  token_usage?: {
+    total: TokenUsage;
+    by_stage: Record<string, TokenUsage>;
+  };
+}
+
+/**
+ * 大模型token用量
+ */
+export interface TokenUsage {
+  calls: number;
+  prompt_tokens: number;
+  completion_tokens: number;
+  total_tokens: number;
+  cost: number;
 }
 
 /**
@@ -141,6 +157,8 @@ export interface WebSocketMessage {
   id?: string;
   /** 时间戳（可选） */
   timestamp?: string;
+  /** 房间状态版本号（可选） */
+  version?: number;
 }
 
 /**
@@ -189,3 +207,28 @@ export interface RoomListResponse {
   /** 房间总数 */
   total_count: number;
 }
+
+/**
+ * 大厅订阅消息类型
+ */
+export type LobbyMessage =
+  | {
+      type: "lobby_snapshot";
+      data: {
+        /** 大厅版本号 */
+        version: number;
+        /** 当前显示的所有房间 */
+        rooms: RoomInfo[];
+      };
+    }
+  | {
+      type: "lobby_delta";
+      data: {
+        /** 大厅版本号 */
+        version: number;
+        /** 新增或变化的房间 */
+        upserts: RoomInfo[];
+        /** 从大厅移除的房间ID */
+        removed: string[];
+      };
+    };
@@ -11,7 +11,8 @@ import {
   type WebSocketMessage,
   type RoomStatus,
   type RoomInfo,
-  type RoomListResponse
+  type RoomListResponse,
+  type LobbyMessage
 } from "../const/const";
 import { GameContext, type GameContextType } from "./GameContextCore";
 
@@ -55,6 +56,11 @@ const getServerConfig = (): ServerConfig => {
 // 解构获取服务器配置
 const { http: API_BASE, ws: WS_BASE } = getServerConfig();
 
+/** 大厅订阅不可用（分片部署）时轮询房间列表的间隔（毫秒） */
+const ROOM_LIST_POLL_INTERVAL = 5000;
+/** 服务器要求改为轮询房间列表时的关闭代码 */
+const LOBBY_POLL_CLOSE_CODE = 4011;
+
 /**
  * 游戏提供者组件属性
  */
@@ -109,6 +115,9 @@ export function GameProvider({ children }: GameProviderProps) {
   
   /** 玩家私人消息，key为玩家名，value为消息内容 */
   const [privateMessages, setPrivateMessages] = useState<Record<string, string>>({});
+
+  /** 正在流式生成的轮次事件，key为字段路径（如 event.event_title），value为已收到的文本 */
+  const [streamingEvent, setStreamingEvent] = useState<Record<string, string>>({});
   
   /** 玩家行动列表，存储所有玩家的行动记录 */
   const [playerActions, setPlayerActions] = useState<PlayerAction[]>([]);
@@ -143,6 +152,9 @@ export function GameProvider({ children }: GameProviderProps) {
   
   /** WebSocket连接引用 */
   const wsRef = useRef<WebSocket | null>(null);
+
+  /** 最后看到的房间状态版本号，重连同一房间时只请求之后的变化 */
+  const roomVersionRef = useRef<{ roomId: string; version: number } | null>(null);
   
   /** 背景音乐引用 */
   const audioRef = useRef<HTMLAudioElement | null>(null);
@@ -332,9 +344,22 @@ export function GameProvider({ children }: GameProviderProps) {
       case "round_loading":
         setGameState(GAME_STATES.ROUND_LOADING);
         setCurrentRound(message.data.round as number);
+        setStreamingEvent({});
         saveGameState(playerName, currentRoom, GAME_STATES.ROUND_LOADING);
         addMessage(`🔄 ${message.data.message}`);
         break;
+      // 轮次事件流式生成中的增量内容
+      case "round_event_delta": {
+        const deltas = message.data.deltas as { path: string; text: string }[];
+        setStreamingEvent((prev) => {
+          const next = { ...prev };
+          for (const { path, text } of deltas) {
+            next[path] = (next[path] || "") + text;
+          }
+          return next;
+        });
+        break;
+      }
       // 新轮次开始
       case "round_start":
         setGameState(GAME_STATES.PLAYING);
@@ -385,8 +410,13 @@ export function GameProvider({ children }: GameProviderProps) {
    * 建立WebSocket连接
    * @param player - 玩家名称
    * @param roomId - 房间ID
+   * @param wsUrl - WebSocket地址，分片部署时由服务器重定向到房间所在节点
    */
-  const connectWebSocket = (player: string, roomId: string): void => {
+  const connectWebSocket = (
+    player: string,
+    roomId: string,
+    wsUrl: string = `${WS_BASE}/ws`
+  ): void => {
     // 参数验证
     if (!player || !roomId) {
       addMessage("请输入玩家名称和房间ID", "error");
@@ -399,7 +429,6 @@ export function GameProvider({ children }: GameProviderProps) {
     }
 
     // 建立新连接
-    const wsUrl = `${WS_BASE}/ws`;
     addMessage(`正在连接到: ${wsUrl}`);
     wsRef.current = new WebSocket(wsUrl);
 
@@ -409,10 +438,15 @@ export function GameProvider({ children }: GameProviderProps) {
      */
     wsRef.current.onopen = (): void => {
       if (wsRef.current) {
+        const lastVersion =
+          roomVersionRef.current?.roomId === roomId
+            ? roomVersionRef.current.version
+            : undefined;
         wsRef.current.send(
           JSON.stringify({
             player_name: player,
             room_id: roomId,
+            last_version: lastVersion,
           })
         );
       }
@@ -424,7 +458,21 @@ export function GameProvider({ children }: GameProviderProps) {
      */
     wsRef.current.onmessage = (event: MessageEvent): void => {
       const message = JSON.parse(event.data) as WebSocketMessage;
+
+      // 记录房间状态版本号
+      const version = message.version ?? message.data?.version;
+      if (typeof version === "number") {
+        roomVersionRef.current = { roomId, version };
+      }
       
+      // 房间在其他节点上，重连到该节点
+      if (message.type === "redirect") {
+        const ws = wsRef.current;
+        if (ws) ws.onclose = null;
+        connectWebSocket(player, roomId, message.data.url as string);
+        return;
+      }
+
       // 处理连接成功消息
       if (message.type === "connection_success") {
         setWsConnected(true);
@@ -433,6 +481,7 @@ export function GameProvider({ children }: GameProviderProps) {
         // 解构服务器返回的状态数据
         const {
           is_reconnect,        // 是否为重新连接
+          is_delta,            // 是否只包含上次收到的版本之后变化的字段
           game_state,          // 当前游戏状态
           current_round,       // 当前轮次
           players: playersData, // 玩家列表
@@ -446,7 +495,10 @@ export function GameProvider({ children }: GameProviderProps) {
         setPlayers((playersData as Player[]) || []);
 
         // 处理重新连接的情况
-        if (is_reconnect) {
+        // 增量状态中没有的字段表示没有变化，保留本地已有的值（下面只在字段存在时才更新）
+        if (is_reconnect && is_delta && !game_state) {
+          addMessage(`🔄 重新连接到房间: ${roomId}`);
+        } else if (is_reconnect) {
           addMessage(`🔄 重新连接到房间: ${roomId}`);
           
           // 根据服务器状态恢复游戏状态
@@ -762,6 +814,7 @@ export function GameProvider({ children }: GameProviderProps) {
       wsRef.current.close();
       wsRef.current = null;
     }
+    roomVersionRef.current = null;
     
     // 清除保存的游戏状态
     clearSavedState();
@@ -776,6 +829,7 @@ export function GameProvider({ children }: GameProviderProps) {
     setCurrentRound(1);
     setRoundEvent(null);
     setPrivateMessages({});
+    setStreamingEvent({});
     setPlayerActions([]);
     setGameResult(null);
     setSelectedRoles([]);
@@ -819,6 +873,71 @@ export function GameProvider({ children }: GameProviderProps) {
     }
   };
 
+  /**
+   * 定时拉取房间列表，只更新列表，不记录消息
+   */
+  const pollRoomList = async (): Promise<void> => {
+    try {
+      const response = await fetch(`${API_BASE}/rooms`);
+      if (response.ok) {
+        const data: RoomListResponse = await response.json();
+        setRoomList(data.rooms);
+      }
+    } catch (error) {
+      console.error("轮询房间列表错误:", error);
+    }
+  };
+
+  /**
+   * 订阅房间列表
+   * 通过大厅WebSocket先接收房间列表快照，之后只接收增量变化；
+   * 分片部署时服务器关闭订阅，改为定时拉取合并了所有节点的房间列表
+   * @returns 取消订阅的函数
+   */
+  const subscribeRoomList = (): (() => void) => {
+    setLoadingRoomList(true);
+    const lobbyWs = new WebSocket(`${WS_BASE}/ws/lobby`);
+    let pollTimer: ReturnType<typeof setInterval> | null = null;
+
+    lobbyWs.onmessage = (event: MessageEvent): void => {
+      const message = JSON.parse(event.data) as LobbyMessage;
+
+      if (message.type === "lobby_snapshot") {
+        setRoomList(message.data.rooms || []);
+        setLoadingRoomList(false);
+      } else if (message.type === "lobby_delta") {
+        const { upserts = [], removed = [] } = message.data;
+        setRoomList((prev) => {
+          const changed = new Map(upserts.map((room) => [room.room_id, room]));
+          const next = prev
+            .filter((room) => !removed.includes(room.room_id))
+            .map((room) => changed.get(room.room_id) ?? room);
+          const existing = new Set(prev.map((room) => room.room_id));
+          return next.concat(upserts.filter((room) => !existing.has(room.room_id)));
+        });
+      }
+    };
+
+    lobbyWs.onerror = (): void => {
+      // 订阅失败时退回到一次性拉取
+      fetchRoomList();
+    };
+
+    lobbyWs.onclose = (event: CloseEvent): void => {
+      if (event.code === LOBBY_POLL_CLOSE_CODE && pollTimer === null) {
+        fetchRoomList();
+        pollTimer = setInterval(pollRoomList, ROOM_LIST_POLL_INTERVAL);
+      }
+    };
+
+    return () => {
+      lobbyWs.onerror = null;
+      lobbyWs.onclose = null;
+      lobbyWs.close();
+      if (pollTimer !== null) clearInterval(pollTimer);
+    };
+  };
+
   /**
    * 重置游戏状态
    * 将所有游戏相关状态重置为初始值
@@ -828,6 +947,7 @@ export function GameProvider({ children }: GameProviderProps) {
     setCurrentRound(1);
     setRoundEvent(null);
     setPrivateMessages({});
+    setStreamingEvent({});
     setPlayerActions([]);
     setGameResult(null);
     setSelectedRoles([]);
@@ -859,6 +979,7 @@ export function GameProvider({ children }: GameProviderProps) {
     currentRound,
     roundEvent,
     privateMessages,
+    streamingEvent,
     playerActions,
     gameResult,
     selectedRoles,
@@ -881,6 +1002,7 @@ export function GameProvider({ children }: GameProviderProps) {
     handleRestartGame,
     handleExitRoom,
     fetchRoomList,
+    subscribeRoomList,
   };
 
   return <GameContext.Provider value={value}>{children}</GameContext.Provider>;
@@ -34,6 +34,8 @@ export interface GameContextType {
   roundEvent: RoundEvent | null;
   /** 玩家私人消息 */
   privateMessages: Record<string, string>;
+  /** 正在流式生成的轮次事件内容，key为字段路径 */
+  streamingEvent: Record<string, string>;
   /** 玩家行动列表 */
   playerActions: PlayerAction[];
   /** 游戏结果数据 */
@@ -76,6 +78,8 @@ export interface GameContextType {
   handleExitRoom: () => void;
   /** 获取房间列表 */
   fetchRoomList: () => Promise<void>;
+  /** 订阅房间列表变化，返回取消订阅的函数 */
+  subscribeRoomList: () => () => void;
 }
 
 /**
@@ -1,14 +1,36 @@
-from fastapi import FastAPI, HTTPException, WebSocket
+from typing import Optional
+import asyncio
+import hashlib
+import hmac
+import os
+from fastapi import FastAPI, Header, HTTPException, Query, Request, Response, WebSocket
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import RedirectResponse
+import httpx
 import logging
 
 from room_manager import room_manager
 from websocket_handler import WebSocketHandler
+from lobby_hub import lobby_hub
+from llm import close_async_clients
+from game_handler import game_handler
+from room_journal import room_journal
+from room_mailbox import room_mailboxes
+from state_backend import SHARED_STATE, WORKER_ID, broadcast_bus
+from connection_manager import encode_message
+from shard_ring import shard_ring
+from llm_cache import llm_cache
+from llm_policy import llm_policy
+from llm_scheduler import llm_scheduler
+from llm_usage import llm_usage
+from single_flight import single_flight
 
-# 配置日志
-logging.basicConfig(level=logging.INFO)
+# 日志配置见 logger_config
 logger = logging.getLogger(__name__)
 
+# 访问管理接口需要的令牌（请求头 X-Admin-Token），为空时管理接口不可访问
+ADMIN_TOKEN = os.getenv("ADMIN_TOKEN", "")
+
 app = FastAPI(title="创业模拟器 API", version="1.0.0")
 
 # 添加CORS中间件
@@ -18,11 +40,34 @@ app.add_middleware(
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],
+    expose_headers=["ETag"],
 )
 
 websocket_handler = WebSocketHandler()
 
 
+@app.on_event("startup")
+async def startup():
+    # 多worker部署时订阅其他worker的房间变化，并加载已有房间
+    await broadcast_bus.start()
+    await room_manager.load_shared_rooms()
+    # 恢复重启前的房间，并继续被中断的生成阶段
+    for room in room_manager.restore_rooms():
+        asyncio.create_task(room_mailboxes.run(
+            room.room_id,
+            lambda room=room: game_handler.resume_interrupted_game(room.room_id, room),
+        ))
+
+
+@app.on_event("shutdown")
+async def shutdown():
+    # 关闭共享的LLM连接池
+    await close_async_clients()
+    await broadcast_bus.stop()
+    if room_journal:
+        room_journal.flush()
+
+
 # API 端点
 @app.get("/")
 async def root():
@@ -37,11 +82,28 @@ class CreateRoomRequest(BaseModel):
     player_name: str
 
 
+def _redirect_to_owner(request: Request, room_id: str) -> Optional[RedirectResponse]:
+    """分片部署时，不属于当前worker的房间请求重定向到所属worker"""
+    if not shard_ring:
+        return None
+    owner_url = shard_ring.owner_url(room_id)
+    if not owner_url:
+        return None
+    target = owner_url + request.url.path
+    if request.url.query:
+        target += "?" + request.url.query
+    # 307 保留请求方法和请求体
+    return RedirectResponse(target, status_code=307)
+
+
 @app.post("/rooms/create")
-async def create_room(request: CreateRoomRequest):
+async def create_room(request: CreateRoomRequest, http_request: Request):
+    redirect = _redirect_to_owner(http_request, request.room_id)
+    if redirect:
+        return redirect
     try:
         # 检查房间是否已存在
-        existing_room = room_manager.get_room(request.room_id)
+        existing_room = await room_manager.fetch_room(request.room_id)
         if existing_room:
             # 房间已存在，直接加入
             room = room_manager.join_room(request.player_name, request.room_id)
@@ -74,88 +136,95 @@ class EventGenerationRequest(BaseModel):
 
 
 @app.get("/rooms")
-async def get_all_rooms():
-    """获取所有房间列表"""
+async def get_all_rooms(
+    request: Request,
+    game_state: Optional[str] = None,
+    offset: int = Query(0, ge=0),
+    limit: Optional[int] = Query(None, ge=1),
+):
+    """获取所有房间列表，支持按游戏状态过滤、分页以及If-None-Match条件请求
+
+    分片部署时默认汇总所有worker的房间，scope=local 只返回当前worker的房间。
+    """
     try:
-        all_rooms = room_manager.get_all_rooms()
-        logger.info(f"Total rooms before cleanup: {len(all_rooms)}")
-        
-        # 记录房间状态
-        for room_id, room in all_rooms.items():
-            online_players = room.get_online_players()
-            all_players = room.players
-            logger.info(f"Room {room_id}: {len(all_players)} total players, {len(online_players)} online")
-            for player in all_players:
-                logger.info(f"  Player {player.name}: online={player.is_online}")
-        
-        room_list = []
-        
-        for room_id, room in all_rooms.items():
-            online_players = room.get_online_players()
-            all_players = room.players
-            
-            # 智能显示逻辑：
-            # 1. 优先显示有在线玩家的房间
-            # 2. 对于刚创建的房间（可能WebSocket还没连接），给予短暂的宽限期
-            from datetime import datetime, timedelta
-            room_age = datetime.now() - room.created_at
-            is_new_room = room_age < timedelta(seconds=30)  # 30秒宽限期
-            
-            if online_players:
-                # 有在线玩家，直接显示
-                display_players = online_players
-                room_data = {
-                    "room_id": room_id,
-                    "player_count": len(display_players),
-                    "max_players": 4,
-                    "game_state": room.game_state.value if hasattr(room.game_state, 'value') else str(room.game_state),
-                    "created_at": room.created_at.isoformat() if room.created_at else None,
-                    "players": [{"name": p.name, "is_host": p.is_host} for p in display_players]
-                }
-                room_list.append(room_data)
-                logger.info(f"Added room to list (有在线玩家): {room_data}")
-            elif all_players and is_new_room:
-                # 新房间且有玩家，给予宽限期（可能WebSocket还在连接中）
-                display_players = all_players
-                room_data = {
-                    "room_id": room_id,
-                    "player_count": len(display_players),
-                    "max_players": 4,
-                    "game_state": room.game_state.value if hasattr(room.game_state, 'value') else str(room.game_state),
-                    "created_at": room.created_at.isoformat() if room.created_at else None,
-                    "players": [{"name": p.name, "is_host": p.is_host} for p in display_players]
-                }
-                room_list.append(room_data)
-                logger.info(f"Added room to list (新房间宽限期): {room_data}")
-            else:
-                # 旧房间且无在线玩家，不显示
-                logger.info(f"Skipping room {room_id}: 无在线玩家且非新房间 (age: {room_age.total_seconds()}秒)")
-        
-        result = {
-            "success": True,
-            "rooms": room_list,
-            "total_count": len(room_list)
-        }
-        logger.info(f"Returning room list: {result}")
-        
-        return result
+        if shard_ring and request.query_params.get("scope") != "local":
+            body = await _gather_lobby_listing(game_state, offset, limit)
+            etag = f'W/"{hashlib.sha1(body).hexdigest()}"'
+        else:
+            etag, body = room_manager.get_lobby_listing(game_state, offset, limit)
+        headers = {"ETag": etag, "Cache-Control": "no-cache"}
+        if request.headers.get("if-none-match") == etag:
+            return Response(status_code=304, headers=headers)
+        return Response(content=body, media_type="application/json", headers=headers)
     except Exception as e:
         logger.error(f"Error getting room list: {e}")
         raise HTTPException(status_code=500, detail=str(e))
 
 
+async def _gather_lobby_listing(
+    game_state: Optional[str], offset: int, limit: Optional[int]
+) -> bytes:
+    """并发获取所有分片的本地房间列表并合并分页"""
+    params = {"scope": "local"}
+    if game_state:
+        params["game_state"] = game_state
+
+    async def fetch(node_url: str):
+        async with httpx.AsyncClient(timeout=2.0) as client:
+            response = await client.get(node_url + "/rooms", params=params)
+            response.raise_for_status()
+            return response.json()["rooms"]
+
+    results = await asyncio.gather(
+        *(fetch(url) for node_id, url in shard_ring.nodes.items() if node_id != WORKER_ID),
+        return_exceptions=True,
+    )
+    rooms = [
+        entry
+        for entry in room_manager.get_lobby_rooms()
+        if game_state is None or entry["game_state"] == game_state
+    ]
+    for result in results:
+        if isinstance(result, Exception):
+            logger.warning(f"获取其他分片的房间列表失败: {result}")
+            continue
+        rooms.extend(result)
+    page = rooms[offset:] if limit is None else rooms[offset:offset + limit]
+    return encode_message(
+        {"success": True, "rooms": page, "total_count": len(rooms)}
+    ).encode("utf-8")
+
+
 @app.get("/rooms/{room_id}/status")
-async def get_room_status(room_id: str):
+async def get_room_status(room_id: str, request: Request):
     """检查房间状态"""
-    room = room_manager.get_room(room_id)
+    redirect = _redirect_to_owner(request, room_id)
+    if redirect:
+        return redirect
+    room = await room_manager.fetch_room(room_id)
     if not room:
         raise HTTPException(status_code=404, detail="房间不存在")
 
     return {
         "exists": True,
         "room_id": room_id,
-        "player_count": len(room.get_online_players()),
+        "player_count": room.online_player_count(),
         "game_state": room.game_state.value if room.game_state else "waiting",
+        "stage_timings": room.stage_timings,
+    }
+
+
+@app.get("/admin/llm")
+async def get_llm_stats(x_admin_token: Optional[str] = Header(None)):
+    """大模型用量、费用、调度、调用策略和缓存的统计"""
+    if not ADMIN_TOKEN or not hmac.compare_digest(x_admin_token or "", ADMIN_TOKEN):
+        raise HTTPException(status_code=403, detail="无权访问")
+    return {
+        "usage": llm_usage.stats(),
+        "scheduler": llm_scheduler.stats(),
+        "policy": llm_policy.stats(),
+        "single_flight": single_flight.stats(),
+        "cache": llm_cache.stats() if llm_cache else None,
     }
 
 
@@ -169,7 +238,29 @@ async def websocket_endpoint(websocket: WebSocket):
         await websocket.close()
 
 
+@app.websocket("/ws/lobby")
+async def lobby_websocket_endpoint(websocket: WebSocket):
+    """大厅订阅：连接后推送房间列表快照，之后推送合并的增量变化"""
+    if shard_ring:
+        # 订阅只能看到当前节点的房间，分片部署时让客户端改为轮询合并了所有节点的 /rooms
+        await websocket.accept()
+        await websocket.close(code=4011, reason="分片部署下请使用 /rooms 获取房间列表")
+        return
+    try:
+        await lobby_hub.handle_connection(websocket)
+    except Exception as e:
+        logger.error(f"Lobby WebSocket error: {e}")
+
+
 if __name__ == "__main__":
     import uvicorn
 
-    uvicorn.run(app, host="0.0.0.0", port=8000)
+    # 多个worker需要共享房间状态（STATE_BACKEND=redis）
+    workers = int(os.getenv("UVICORN_WORKERS", "1"))
+    if workers > 1 and not SHARED_STATE:
+        logger.warning("未启用共享房间状态，只能以单个worker运行")
+        workers = 1
+    if workers > 1:
+        uvicorn.run("app:app", host="0.0.0.0", port=8000, workers=workers)
+    else:
+        uvicorn.run(app, host="0.0.0.0", port=8000)
@@ -1,10 +1,132 @@
-from typing import Dict, Optional
+from collections import deque
+from typing import Callable, Deque, Dict, Optional, Tuple
 from fastapi import WebSocket
+import asyncio
 import json
 import logging
+import os
+
+from logger_config import debug_sampled
+from state_backend import SHARED_STATE, broadcast_bus
+
+try:
+    # 可选依赖，安装后用于加速消息编码
+    import orjson
+except ImportError:
+    orjson = None
 
 logger = logging.getLogger(__name__)
 
+# 单个连接的发送超时（秒）
+WS_SEND_TIMEOUT = float(os.getenv("WS_SEND_TIMEOUT", "5"))
+# 单个连接待发送队列的最大长度
+WS_SEND_QUEUE_SIZE = int(os.getenv("WS_SEND_QUEUE_SIZE", "64"))
+# 队列满时的慢消费者策略: coalesce（丢弃已被更新的同类型快照消息替代的旧消息，仍然放不下时断开连接）、
+# disconnect（直接断开连接）；drop与coalesce相同。不会丢弃改变游戏状态的消息，断开后客户端重连时收到完整状态
+WS_SLOW_CONSUMER_POLICY = os.getenv("WS_SLOW_CONSUMER_POLICY", "coalesce")
+
+# 携带完整快照的消息类型，新消息可以替代队列中同类型的旧消息
+COALESCIBLE_MESSAGE_TYPES = {
+    "player_join",
+    "player_leave",
+    "role_selected",
+    "action_submitted",
+}
+
+# 定向广播中私人信息的占位符，公共部分编码后在此处拼接每个玩家自己的私人信息
+PRIVATE_PLACEHOLDER = "\u0000private_messages\u0000"
+
+
+def encode_message(message: dict) -> str:
+    """把消息编码为JSON文本，安装了orjson时优先使用orjson"""
+    if orjson is not None:
+        try:
+            return orjson.dumps(
+                message, default=str, option=orjson.OPT_NON_STR_KEYS
+            ).decode("utf-8")
+        except orjson.JSONEncodeError:
+            # orjson不接受的内容（例如单独的代理项）交给标准库编码
+            pass
+    return json.dumps(message, default=str)
+
+
+_ENCODED_PLACEHOLDER = encode_message(PRIVATE_PLACEHOLDER)
+
+
+class PlayerOutbox:
+    """单个连接的待发送队列，由独立的写任务按顺序发送
+
+    广播只把消息放入各连接的队列，不等待实际发送，
+    因此一个缓慢或半断开的连接不会拖慢同房间的其他玩家。
+    """
+
+    def __init__(
+        self,
+        player_id: str,
+        websocket: WebSocket,
+        on_failure: Callable[["PlayerOutbox"], None],
+        policy: str = WS_SLOW_CONSUMER_POLICY,
+    ):
+        self.player_id = player_id
+        self.websocket = websocket
+        self._on_failure = on_failure
+        self.policy = policy
+        # (消息类型, 已编码文本)
+        self._queue: Deque[Tuple[str, str]] = deque()
+        self._ready = asyncio.Event()
+        self._closed = False
+        self._task = asyncio.create_task(self._run())
+
+    def put(self, message_type: str, text: str) -> bool:
+        """放入队列，返回False表示连接过慢需要断开"""
+        if len(self._queue) >= WS_SEND_QUEUE_SIZE:
+            if self.policy == "disconnect":
+                return False
+            self._drop_superseded(message_type)
+            if len(self._queue) >= WS_SEND_QUEUE_SIZE:
+                # 剩下的消息都不能丢弃（例如轮次开始、事件增量），断开后由重连同步完整状态
+                return False
+            logger.warning("玩家 %s 的发送队列已满，已合并快照消息", self.player_id)
+
+        self._queue.append((message_type, text))
+        self._ready.set()
+        return True
+
+    def _drop_superseded(self, message_type: str):
+        """丢弃之后还有同类型快照消息（包括即将放入的消息）的旧快照消息"""
+        latest = {message_type} & COALESCIBLE_MESSAGE_TYPES
+        kept: Deque[Tuple[str, str]] = deque()
+        for item in reversed(self._queue):
+            if item[0] in latest:
+                continue
+            if item[0] in COALESCIBLE_MESSAGE_TYPES:
+                latest.add(item[0])
+            kept.appendleft(item)
+        self._queue = kept
+
+    async def _run(self):
+        # 发送恰好完成时wait_for可能吞掉取消，因此同时检查关闭标记
+        while not self._closed:
+            if not self._queue:
+                self._ready.clear()
+                await self._ready.wait()
+                continue
+
+            _, text = self._queue.popleft()
+            try:
+                await asyncio.wait_for(self.websocket.send_text(text), WS_SEND_TIMEOUT)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error("发送消息给玩家 %s 失败: %r", self.player_id, e)
+                self._on_failure(self)
+                return
+
+    def close(self):
+        """停止写任务，丢弃未发送的消息"""
+        self._closed = True
+        self._task.cancel()
+
 
 class ConnectionManager:
     """WebSocket连接管理器"""
@@ -14,20 +136,33 @@ class ConnectionManager:
         self.active_connections: Dict[str, WebSocket] = {}
         # 玩家ID -> 房间ID
         self.player_rooms: Dict[str, str] = {}
+        # 玩家ID -> 待发送队列
+        self.outboxes: Dict[str, PlayerOutbox] = {}
+        # 多worker部署时，接收其他worker转发的房间广播
+        broadcast_bus.subscribe(self._on_bus_message)
 
     async def connect(self, websocket: WebSocket, player_id: str):
         """建立WebSocket连接"""
         self.active_connections[player_id] = websocket
-        logger.info(f"玩家 {player_id} 已连接")
+        old_outbox = self.outboxes.pop(player_id, None)
+        if old_outbox:
+            old_outbox.close()
+        self.outboxes[player_id] = PlayerOutbox(
+            player_id, websocket, self._handle_send_failure
+        )
+        logger.info("玩家 %s 已连接", player_id)
 
     def disconnect(self, player_id: str):
         """断开WebSocket连接"""
         if player_id in self.active_connections:
             del self.active_connections[player_id]
+        outbox = self.outboxes.pop(player_id, None)
+        if outbox:
+            outbox.close()
         # 同时从房间映射中移除
         if player_id in self.player_rooms:
             del self.player_rooms[player_id]
-        logger.info(f"玩家 {player_id} 已断开连接")
+        logger.info("玩家 %s 已断开连接", player_id)
 
     def join_room(self, player_id: str, room_id: str):
         """玩家加入房间"""
@@ -40,13 +175,36 @@ class ConnectionManager:
     async def send_to_player(self, player_id: str, message: dict):
         """发送消息给指定玩家"""
         if player_id in self.active_connections:
-            try:
-                await self.active_connections[player_id].send_text(
-                    json.dumps(message, default=str)
-                )
-            except Exception as e:
-                logger.error(f"发送消息给玩家 {player_id} 失败: {e}")
-                self.disconnect(player_id)
+            self._send_text(player_id, message.get("type", ""), encode_message(message))
+
+    def _send_text(self, player_id: str, message_type: str, text: str):
+        """把已编码的消息放入玩家的发送队列"""
+        outbox = self.outboxes.get(player_id)
+        if outbox and not outbox.put(message_type, text):
+            logger.warning("玩家 %s 消费过慢，断开连接", player_id)
+            self._handle_send_failure(outbox)
+
+    def _handle_send_failure(self, outbox: PlayerOutbox):
+        """发送超时或失败时关闭连接
+
+        只关闭WebSocket并停止发送，玩家的离线处理仍由接收循环中的断开逻辑完成。
+        """
+        if self.outboxes.get(outbox.player_id) is not outbox:
+            return
+        del self.outboxes[outbox.player_id]
+        if self.active_connections.get(outbox.player_id) is outbox.websocket:
+            del self.active_connections[outbox.player_id]
+        outbox.close()
+        asyncio.create_task(self._close_websocket(outbox.websocket))
+
+    @staticmethod
+    async def _close_websocket(websocket: WebSocket):
+        try:
+            await asyncio.wait_for(
+                websocket.close(code=4008, reason="发送超时"), WS_SEND_TIMEOUT
+            )
+        except Exception:
+            pass
 
     async def broadcast_to_room(
         self, room_id: str, message: dict, exclude_player: Optional[str] = None
@@ -56,31 +214,167 @@ class ConnectionManager:
         
         room = room_manager.get_room(room_id)
         if room:
+            # 只编码一次，所有玩家共用同一份文本，放入各自的发送队列后并发发送
+            # 附带房间状态版本号，客户端重连时据此只请求之后的变化
+            text = encode_message({**message, "version": room.version})
+            message_type = message.get("type", "")
             sent_count = 0
-            logger.info(f"房间 {room_id} 开始广播 {message.get('type', 'unknown')} 消息，房间内共有 {len(room.players)} 个玩家")
-            for player in room.players:
-                logger.info(f"检查玩家 {player.name}: is_online={player.is_online}, in_active_connections={player.name in self.active_connections}")
-                if player.is_online and player.name in self.active_connections:
-                    if exclude_player and player.name == exclude_player:
-                        logger.info(f"跳过发送消息给排除的玩家: {player.name}")
-                        continue
-                    logger.info(f"发送 {message.get('type', 'unknown')} 消息给玩家: {player.name}")
-                    await self.send_to_player(player.name, message)
-                    sent_count += 1
-                else:
-                    logger.info(f"跳过离线或未连接的玩家: {player.name} (is_online: {player.is_online}, connected: {player.name in self.active_connections})")
-            logger.info(f"房间 {room_id} 广播消息完成，发送给 {sent_count} 个玩家")
+            for player in self._room_recipients(room, exclude_player):
+                self._send_text(player.name, message_type, text)
+                sent_count += 1
+            logger.debug(
+                "房间 %s 广播 %s 消息完成，发送给 %d 个玩家", room_id, message_type, sent_count
+            )
+            if SHARED_STATE:
+                # 连接在其他worker上的玩家由对应的worker发送
+                await broadcast_bus.publish({
+                    "type": "room_broadcast",
+                    "room_id": room_id,
+                    "message_type": message_type,
+                    "text": text,
+                    "exclude": exclude_player,
+                })
         else:
-            logger.warning(f"尝试向不存在的房间 {room_id} 广播消息")
+            logger.warning("尝试向不存在的房间 %s 广播消息", room_id)
+
+    async def broadcast_private_to_room(
+        self,
+        room_id: str,
+        message: dict,
+        private_messages: Dict,
+        field: str = "privateMessages",
+    ):
+        """向房间内所有玩家广播消息，每个玩家的 data[field] 只包含发给自己角色的私人信息
+
+        公共部分只编码一次，按角色编码的私人信息拼接到占位符的位置。
+        """
+        from room_manager import room_manager  # 避免循环导入
+
+        room = room_manager.get_room(room_id)
+        if not room:
+            logger.warning("尝试向不存在的房间 %s 广播消息", room_id)
+            return
+
+        common = {
+            **message,
+            "data": {**message.get("data", {}), field: PRIVATE_PLACEHOLDER},
+            "version": room.version,
+        }
+        prefix, suffix = encode_message(common).split(_ENCODED_PLACEHOLDER, 1)
+        message_type = message.get("type", "")
+        # 角色 -> 编码后的私人信息，同一角色只编码一次
+        encoded: Dict[Optional[str], str] = {}
+        sent_count = 0
+        for player in self._room_recipients(room):
+            if player.role not in encoded:
+                encoded[player.role] = encode_message(
+                    room.private_messages_for(player.name, private_messages)
+                )
+            self._send_text(player.name, message_type, prefix + encoded[player.role] + suffix)
+            sent_count += 1
+        logger.debug(
+            "房间 %s 定向广播 %s 消息完成，发送给 %d 个玩家", room_id, message_type, sent_count
+        )
+        if SHARED_STATE:
+            # 其他worker上的玩家可能是任意角色，把房间内所有角色的私人信息都编码后转发
+            for player in room.players:
+                if player.role not in encoded:
+                    encoded[player.role] = encode_message(
+                        room.private_messages_for(player.name, private_messages)
+                    )
+            await broadcast_bus.publish({
+                "type": "room_private_broadcast",
+                "room_id": room_id,
+                "message_type": message_type,
+                "prefix": prefix,
+                "suffix": suffix,
+                "encoded": {(role.value if role else ""): text for role, text in encoded.items()},
+            })
+
+    async def _on_bus_message(self, message: Dict):
+        """把其他worker转发的房间广播发送给连接在本worker上的玩家"""
+        message_type = message.get("type")
+        if message_type not in ("room_broadcast", "room_private_broadcast"):
+            return
+        from room_manager import room_manager  # 避免循环导入
+
+        room_id = message.get("room_id")
+        room = room_manager.get_room(room_id)
+        # 只发送给连接在本worker上的该房间玩家
+        for player_id, player_room_id in list(self.player_rooms.items()):
+            if player_room_id != room_id or player_id == message.get("exclude"):
+                continue
+            if message_type == "room_broadcast":
+                text = message["text"]
+            else:
+                player = room.get_player(player_id) if room else None
+                role = player.role.value if player and player.role else ""
+                text = message["prefix"] + message["encoded"].get(role, "{}") + message["suffix"]
+            self._send_text(player_id, message.get("message_type", ""), text)
+
+    def _room_recipients(self, room, exclude_player: Optional[str] = None):
+        """房间内在线且已连接的玩家"""
+        for player in room.players:
+            if player.is_online and player.name in self.active_connections:
+                if exclude_player and player.name == exclude_player:
+                    continue
+                yield player
+            else:
+                debug_sampled(
+                    logger,
+                    "broadcast_skip_player",
+                    "跳过离线或未连接的玩家: %s (is_online: %s)",
+                    player.name,
+                    player.is_online,
+                )
 
     def get_connected_players(self) -> list:
         """获取所有已连接的玩家列表"""
         return list(self.active_connections.keys())
 
+    def has_newer_connection(self, player_id: str, websocket: WebSocket) -> bool:
+        """玩家是否已经用另一个连接替换了该连接"""
+        current = self.active_connections.get(player_id)
+        return current is not None and current is not websocket
+
     def is_player_connected(self, player_id: str) -> bool:
         """检查玩家是否已连接"""
         return player_id in self.active_connections
 
 
 # 全局连接管理器实例
-connection_manager = ConnectionManager()
\ No newline at end of file
+connection_manager = ConnectionManager()
+
+
+# 编码性能基准：python connection_manager.py
+if __name__ == "__main__":
+    import timeit
+
+    players = 4
+    message = {
+        "type": "game_complete",
+        "data": {
+            "result": {
+                "final_score": 80,
+                "success_level": "成功上市",
+                "timeline": [
+                    {"round": i, "event": "产品原型开发完成", "impact": "positive"}
+                    for i in range(1, 6)
+                ],
+                "round_actions": {
+                    i: [{"playerName": f"玩家{j}", "action": "A", "reason": "理由" * 20} for j in range(players)]
+                    for i in range(1, 6)
+                },
+                "final_report": "公司发展概述：团队在五轮决策中经历了起伏。" * 200,
+            }
+        },
+    }
+
+    per_player = lambda: [json.dumps(message, default=str) for _ in range(players)]
+    cases = [("每个玩家各编码一次(json)", per_player), ("编码一次(json)", lambda: json.dumps(message, default=str))]
+    if orjson is not None:
+        cases.append(("编码一次(orjson)", lambda: encode_message(message)))
+
+    for label, fn in cases:
+        seconds = min(timeit.repeat(fn, number=1000, repeat=5))
+        print(f"{label}: 每次广播 {seconds / 1000 * 1e6:.1f} 微秒（{players} 个玩家）")
@@ -0,0 +1,76 @@
+from typing import Dict, Optional, Tuple
+import asyncio
+import logging
+import os
+
+from room import GameRoom
+
+logger = logging.getLogger(__name__)
+
+# 已提交行动的玩家比例达到该值时确认（必要时重新开始）下一轮事件的预生成
+EVENT_SPECULATION_QUORUM = float(os.getenv("EVENT_SPECULATION_QUORUM", "0.5"))
+
+
+class EventSpeculator:
+    """轮次事件预生成器
+
+    在玩家还在决策时，提前在后台生成下一轮的事件。轮次真正开始时，
+    如果提示词输入没有变化就直接复用预生成的结果，否则取消并重新生成。
+    """
+
+    def __init__(self):
+        # (房间ID, 轮次) -> (生成时使用的提示词, 后台任务)
+        self._tasks: Dict[Tuple[str, int], Tuple[str, asyncio.Task]] = {}
+
+    def start(self, room_id: str, room: GameRoom, round_num: int):
+        """开始在后台预生成指定轮次的事件，提示词未变化时不会重复生成"""
+        situation_data = room.situation_for_round(round_num) if round_num > 1 else None
+        prompt = room.build_event_prompt(round_num, situation_data)
+
+        key = (room_id, round_num)
+        existing = self._tasks.get(key)
+        if existing:
+            if existing[0] == prompt:
+                return
+            existing[1].cancel()
+            logger.info(f"房间 {room_id} 第{round_num}轮的输入已变化，重新预生成事件")
+
+        task = asyncio.create_task(room.generate_event(round_num, prompt=prompt))
+        # 预生成失败时由take重新生成，这里只取出异常避免未处理的警告
+        task.add_done_callback(lambda t: t.cancelled() or t.exception())
+        self._tasks[key] = (prompt, task)
+        logger.info(f"房间 {room_id} 开始预生成第{round_num}轮事件")
+
+    async def take(self, room_id: str, room: GameRoom, round_num: int, on_delta=None) -> Dict:
+        """获取指定轮次的事件：输入未变化时复用预生成结果，否则重新生成"""
+        entry = self._tasks.pop((room_id, round_num), None)
+        prompt = room.build_event_prompt(round_num)
+
+        if entry:
+            speculative_prompt, task = entry
+            if speculative_prompt == prompt:
+                try:
+                    event_data = await task
+                    logger.info(f"房间 {room_id} 第{round_num}轮复用预生成的事件")
+                    return event_data
+                except asyncio.CancelledError:
+                    if not task.cancelled():
+                        raise
+                except Exception as e:
+                    logger.error(f"房间 {room_id} 第{round_num}轮预生成事件失败: {str(e)}")
+            else:
+                task.cancel()
+                logger.info(f"房间 {room_id} 第{round_num}轮的输入已变化，放弃预生成的事件")
+
+        return await room.generate_event(round_num, on_delta=on_delta, prompt=prompt)
+
+    def cancel_room(self, room_id: str, round_num: Optional[int] = None):
+        """取消房间的预生成任务，指定轮次时只取消该轮"""
+        for key in list(self._tasks):
+            if key[0] == room_id and (round_num is None or key[1] == round_num):
+                _, task = self._tasks.pop(key)
+                task.cancel()
+
+
+# 全局事件预生成器实例
+event_speculator = EventSpeculator()
@@ -1,9 +1,9 @@
 from typing import Dict
 from datetime import datetime
 import logging
-import asyncio
 import os
 import sys
+import time
 
 # 添加script目录到Python路径
 script_dir = os.path.join(os.path.dirname(__file__), "script")
@@ -12,6 +12,7 @@ sys.path.append(script_dir)
 from room import GameRoom, GameState, Role, MessageType
 from connection_manager import connection_manager
 from room_manager import room_manager
+from event_speculator import event_speculator, EVENT_SPECULATION_QUORUM
 
 logger = logging.getLogger(__name__)
 
@@ -35,8 +36,8 @@ class GameHandler:
             return
 
         # 设置玩家的创业想法
-        player.startup_idea = idea
-        logger.info(f"玩家 {player_name} 提交创业想法: {idea}")
+        room.set_player_idea(player_name, idea)
+        logger.info("玩家 %s 提交创业想法: %s", player_name, idea)
 
         # 广播玩家想法提交状态更新
         await connection_manager.broadcast_to_room(
@@ -64,7 +65,9 @@ class GameHandler:
             # 选择一个想法作为团队的创业想法（这里简单选择第一个）
             room.startup_idea = room.get_online_players()[0].startup_idea
             logger.info(
-                f"房间 {room_id} 确定创业想法: {room.startup_idea}， 确认创业想法之后应该直接开始游戏。"
+                "房间 %s 确定创业想法: %s， 确认创业想法之后应该直接开始游戏。",
+                room_id,
+                room.startup_idea,
             )
 
             # 广播所有想法已提交完成，可以开始游戏
@@ -97,79 +100,8 @@ class GameHandler:
 
         # 只有在大厅状态时才能开始游戏
         if room.game_state == GameState.LOBBY:
-            # 先广播游戏开始加载消息
-            await connection_manager.broadcast_to_room(
-                room_id,
-                {
-                    "type": MessageType.GAME_LOADING,
-                    "data": {"message": "AI正在生成游戏背景，请稍候..."},
-                },
-            )
-
-            # 收集所有玩家的想法
-            player_ideas = [
-                p.startup_idea for p in room.get_online_players() if p.startup_idea
-            ]
-
-            # 生成背景故事
-            try:
-                background = await asyncio.get_event_loop().run_in_executor(
-                    None,
-                    room.generate_background_from_ideas,
-                    player_ideas,
-                )
-                room.background = background
-                logger.info(f"房间 {room_id} 生成背景故事: {background}")
-                logger.info(f"房间 {room_id} 生成背景故事成功")
-            except Exception as e:
-                logger.error(f"房间 {room_id} 生成背景故事失败: {str(e)}")
-                # 如果生成失败，使用默认背景
-                room.background = "创业团队正在开始他们的创业之旅..."
-
-            # 根据背景故事生成动态角色定义
-            dynamic_roles = {}  # 默认使用硬编码角色
-            try:
-                generated_roles = await asyncio.get_event_loop().run_in_executor(
-                    None,
-                    room.generate_roles_from_background,
-                    room.background,
-                )
-                # 转换生成的角色格式以匹配前端期望的格式
-                dynamic_roles = {}
-                for role_key, role_data in generated_roles.items():
-                    try:
-                        action = role_data.get("actions", [])
-                    except ValueError:
-                        # 如果角色键无效，使用空的actions列表
-                        action = []
-
-                    dynamic_roles[role_key] = {
-                        "name": role_data["name"],
-                        "description": role_data["description"],
-                        "actions": action,
-                    }
-                # 保存动态角色定义到房间状态中
-                room.dynamic_roles = dynamic_roles
-                logger.info(f"房间 {room_id} 生成动态角色定义成功")
-            except Exception as e:
-                logger.error(f"房间 {room_id} 生成动态角色定义失败: {str(e)}")
-                # 如果生成失败，使用默认角色定义
-                dynamic_roles = {}
-
-            room.game_state = GameState.ROLE_SELECTION
-            logger.info(f"房间 {room_id} 自动开始游戏，进入角色选择阶段")
-
-            await connection_manager.broadcast_to_room(
-                room_id,
-                {
-                    "type": MessageType.GAME_START,
-                    "data": {
-                        "startup_idea": room.startup_idea,
-                        "background": room.background,
-                        "roles": dynamic_roles,
-                    },
-                },
-            )
+            await GameHandler._start_role_selection(room_id, room)
+            logger.info("房间 %s 自动开始游戏，进入角色选择阶段", room_id)
 
     @staticmethod
     async def handle_start_game(player_name: str):
@@ -188,42 +120,81 @@ class GameHandler:
 
         # 在大厅状态时生成背景和角色，在角色选择状态时开始第一轮游戏
         if room.game_state == GameState.LOBBY:
-            # 先广播游戏开始加载消息
-            await connection_manager.broadcast_to_room(
-                room_id,
-                {
-                    "type": MessageType.GAME_LOADING,
-                    "data": {"message": "AI正在生成游戏背景，请稍候..."},
+            await GameHandler._start_role_selection(room_id, room)
+            logger.info("房间 %s 开始游戏，进入角色选择阶段", room_id)
+
+        # 角色选择完成后会自动开始游戏，不再需要房主手动开始
+
+    @staticmethod
+    async def _start_role_selection(room_id: str, room: GameRoom):
+        """生成背景和角色后进入角色选择阶段"""
+        # 先广播游戏开始加载消息
+        await connection_manager.broadcast_to_room(
+            room_id,
+            {
+                "type": MessageType.GAME_LOADING,
+                "data": {"message": "AI正在生成游戏背景，请稍候..."},
+            },
+        )
+
+        await GameHandler._run_start_pipeline(room_id, room)
+
+        room.game_state = GameState.ROLE_SELECTION
+        await connection_manager.broadcast_to_room(
+            room_id,
+            {
+                "type": MessageType.GAME_START,
+                "data": {
+                    "startup_idea": room.startup_idea,
+                    "background": room.background,
+                    "roles": room.dynamic_roles,
                 },
-            )
+            },
+        )
+
+    @staticmethod
+    async def _run_start_pipeline(room_id: str, room: GameRoom) -> Dict[str, float]:
+        """开局生成流水线，已生成的阶段会被跳过
+
+        第一轮事件只依赖玩家想法，在后台预生成，与背景、角色的生成以及
+        玩家选择角色的时间重叠；角色定义依赖背景，在背景生成后进行。
+
+        Returns:
+            本次实际执行的各阶段耗时（秒）
+        """
+        timings: Dict[str, float] = {}
+        pipeline_start = time.perf_counter()
+
+        event_speculator.start(room_id, room, 1)
 
+        # 生成背景故事（如果还没有生成）
+        if not room.background:
+            stage_start = time.perf_counter()
             # 收集所有玩家的想法
             player_ideas = [
                 p.startup_idea for p in room.get_online_players() if p.startup_idea
             ]
 
-            # 生成背景故事
             try:
-                background = await asyncio.get_event_loop().run_in_executor(
-                    None,
-                    room.generate_background_from_ideas,
-                    player_ideas,
-                )
+                background = await room.generate_background_from_ideas(player_ideas)
                 room.background = background
-                logger.info(f"房间 {room_id} 生成背景故事: {background}")
-                logger.info(f"房间 {room_id} 生成背景故事成功")
+                logger.debug("房间 %s 生成背景故事: %s", room_id, background)
+                logger.info("房间 %s 生成背景故事成功", room_id)
             except Exception as e:
-                logger.error(f"房间 {room_id} 生成背景故事失败: {str(e)}")
+                logger.error("房间 %s 生成背景故事失败: %s", room_id, e)
                 # 如果生成失败，使用默认背景
                 room.background = "创业团队正在开始他们的创业之旅..."
+            timings["background"] = time.perf_counter() - stage_start
+
+            # 背景确定后确认第一轮事件的预生成输入，输入变化时会重新生成
+            event_speculator.start(room_id, room, 1)
 
-            # 根据背景故事生成动态角色定义
-            dynamic_roles = {}  # 默认使用硬编码角色
+        # 根据背景故事生成动态角色定义（如果还没有生成）
+        if not room.dynamic_roles:
+            stage_start = time.perf_counter()
             try:
-                generated_roles = await asyncio.get_event_loop().run_in_executor(
-                    None,
-                    room.generate_roles_from_background,
-                    room.background,
+                generated_roles = await room.generate_roles_from_background(
+                    room.background
                 )
                 # 转换生成的角色格式以匹配前端期望的格式
                 dynamic_roles = {}
@@ -241,28 +212,19 @@ class GameHandler:
                     }
                 # 保存动态角色定义到房间状态中
                 room.dynamic_roles = dynamic_roles
-                logger.info(f"房间 {room_id} 生成动态角色定义成功")
+                logger.info("房间 %s 生成动态角色定义成功", room_id)
             except Exception as e:
-                logger.error(f"房间 {room_id} 生成动态角色定义失败: {str(e)}")
+                logger.error("房间 %s 生成动态角色定义失败: %s", room_id, e)
                 # 如果生成失败，使用默认角色定义
-                dynamic_roles = {}
-
-            room.game_state = GameState.ROLE_SELECTION
-            logger.info(f"房间 {room_id} 开始游戏，进入角色选择阶段")
-
-            await connection_manager.broadcast_to_room(
-                room_id,
-                {
-                    "type": MessageType.GAME_START,
-                    "data": {
-                        "startup_idea": room.startup_idea,
-                        "background": room.background,
-                        "roles": dynamic_roles,
-                    },
-                },
-            )
+                room.dynamic_roles = {}
+            timings["roles"] = time.perf_counter() - stage_start
 
-        # 角色选择完成后会自动开始游戏，不再需要房主手动开始
+        if timings:
+            timings["total"] = time.perf_counter() - pipeline_start
+            room.stage_timings.update(timings)
+            room.touch("stage_timings")
+            logger.info("房间 %s 开局流水线各阶段耗时: %s", room_id, timings)
+        return timings
 
     @staticmethod
     async def handle_role_selection(player_name: str, role: str):
@@ -287,15 +249,13 @@ class GameHandler:
             return
 
         # 检查角色是否已被选择
-        role_taken = any(
-            p.role == role_lower for p in room.players if p.name != player_name
-        )
-        if role_taken:
+        role_owner = room.get_role_owner(role_lower)
+        if role_owner and role_owner != player_name:
             return
 
         # 设置玩家角色
-        player.role = Role(role_lower)
-        logger.info(f"玩家 {player_name} 选择角色: {role}")
+        room.set_player_role(player_name, Role(role_lower))
+        logger.info("玩家 %s 选择角色: %s", player_name, role)
 
         # 广播角色选择
         await connection_manager.broadcast_to_room(
@@ -320,7 +280,7 @@ class GameHandler:
 
         # 检查是否所有玩家都选择了角色
         if room.all_players_have_roles():
-            logger.info(f"房间 {room_id} 所有角色已选择，直接开始游戏")
+            logger.info("房间 %s 所有角色已选择，直接开始游戏", room_id)
 
             # 所有玩家选择完角色后，直接开始游戏
             await GameHandler._auto_start_game_after_role_selection(room_id)
@@ -332,7 +292,7 @@ class GameHandler:
         if not room:
             return
 
-        logger.info(f"房间 {room_id} 所有角色已选择，开始生成游戏内容")
+        logger.info("房间 %s 所有角色已选择，开始生成游戏内容", room_id)
 
         # 第一步：广播进入loading状态
         room.game_state = GameState.LOADING
@@ -344,57 +304,10 @@ class GameHandler:
             },
         )
 
-        # 第二步：生成背景故事（如果还没有生成）
-        if not room.background:
-            # 收集所有玩家的想法
-            player_ideas = [
-                p.startup_idea for p in room.get_online_players() if p.startup_idea
-            ]
+        # 第二步：生成背景故事和角色介绍（如果还没有生成）
+        await GameHandler._run_start_pipeline(room_id, room)
 
-            try:
-                background = await asyncio.get_event_loop().run_in_executor(
-                    None,
-                    room.generate_background_from_ideas,
-                    player_ideas,
-                )
-                room.background = background
-                logger.info(f"房间 {room_id} 生成背景故事成功")
-            except Exception as e:
-                logger.error(f"房间 {room_id} 生成背景故事失败: {str(e)}")
-                # 如果生成失败，使用默认背景
-                room.background = "创业团队正在开始他们的创业之旅..."
-
-        # 第三步：生成角色介绍（如果还没有生成）
-        if not room.dynamic_roles:
-            try:
-                generated_roles = await asyncio.get_event_loop().run_in_executor(
-                    None,
-                    room.generate_roles_from_background,
-                    room.background,
-                )
-                # 转换生成的角色格式以匹配前端期望的格式
-                dynamic_roles = {}
-                for role_key, role_data in generated_roles.items():
-                    try:
-                        action = role_data.get("actions", [])
-                    except ValueError:
-                        # 如果角色键无效，使用空的actions列表
-                        action = []
-
-                    dynamic_roles[role_key] = {
-                        "name": role_data["name"],
-                        "description": role_data["description"],
-                        "actions": action,
-                    }
-                # 保存动态角色定义到房间状态中
-                room.dynamic_roles = dynamic_roles
-                logger.info(f"房间 {room_id} 生成动态角色定义成功")
-            except Exception as e:
-                logger.error(f"房间 {room_id} 生成动态角色定义失败: {str(e)}")
-                # 如果生成失败，使用默认角色定义
-                room.dynamic_roles = {}
-
-        # 第四步：广播背景故事和角色介绍
+        # 第三步：广播背景故事和角色介绍
         await connection_manager.broadcast_to_room(
             room_id,
             {
@@ -407,9 +320,9 @@ class GameHandler:
             },
         )
 
-        # 第五步：开始生成第一轮事件
+        # 第四步：开始生成第一轮事件
         room.current_round = 1
-        logger.info(f"房间 {room_id} 开始生成第1轮事件")
+        logger.info("房间 %s 开始生成第1轮事件", room_id)
 
         # 广播第一轮事件加载状态
         await connection_manager.broadcast_to_room(
@@ -420,24 +333,77 @@ class GameHandler:
             },
         )
 
-        # 生成第一轮事件
+        # 生成第一轮事件（通常已在开局流水线中预生成）
+        stage_start = time.perf_counter()
+        await GameHandler._generate_round_event(room_id, room, 1)
+        room.stage_timings["round_1_event"] = time.perf_counter() - stage_start
+        room.touch("stage_timings")
+
+        # 第五步：设置游戏状态为进行中并广播游戏开始消息
+        room.game_state = GameState.PLAYING
+        await connection_manager.broadcast_private_to_room(
+            room_id,
+            {
+                "type": MessageType.GAME_STARTED,
+                "data": {
+                    "round": 1,
+                    "roundEvent": room.round_events[1],
+                },
+            },
+            room.round_private_messages[1],
+        )
+
+        # 玩家决策期间预生成下一轮事件
+        GameHandler._speculate_next_round(room_id, room)
+
+    @staticmethod
+    async def _generate_round_event(room_id: str, room: GameRoom, round_num: int):
+        """流式生成指定轮次的事件并保存到房间状态
+
+        生成过程中把公共的 situation 和 event 字段增量广播给房间，
+        私人信息不参与增量广播。
+        """
+
+        async def forward_deltas(deltas):
+            public_deltas = [
+                {"path": ".".join(str(p) for p in path), "text": text}
+                for path, text in deltas
+                if path and path[0] in ("situation", "event")
+            ]
+            if public_deltas:
+                await connection_manager.broadcast_to_room(
+                    room_id,
+                    {
+                        "type": MessageType.ROUND_EVENT_DELTA,
+                        "data": {"round": round_num, "deltas": public_deltas},
+                    },
+                )
+
         try:
-            event_data = await asyncio.get_event_loop().run_in_executor(
-                None, room.generate_event, 1
+            event_data = await event_speculator.take(
+                room_id, room, round_num, on_delta=forward_deltas
             )
 
             # 保存事件和私人信息到房间状态
-            room.round_events[1] = event_data["event"]
-            room.round_private_messages[1] = event_data["private_messages"]
+            room.set_round_event(
+                round_num, event_data["event"], event_data["private_messages"]
+            )
             if "situation" in event_data:
-                room.round_situation[1] = event_data["situation"]
+                room.set_round_situation(round_num, event_data["situation"])
+            # 在预生成下一轮之前更新摘要，下一轮的提示词会用到
+            room.summarize_round(round_num)
 
-            logger.info(f"房间 {room_id} 第1轮事件生成成功")
+            logger.info("房间 %s 第%s轮事件生成成功", room_id, round_num)
+            logger.debug("私人信息内容: %s", event_data["private_messages"])
         except Exception as e:
-            logger.error(f"房间 {room_id} 生成第1轮事件失败: {str(e)}")
+            logger.error("房间 %s 生成第%s轮事件失败: %s", room_id, round_num, e)
             # 如果生成失败，使用默认事件
             default_event = {
-                "description": "团队面临第一个重要决策...",
+                "description": (
+                    "团队面临第一个重要决策..."
+                    if round_num == 1
+                    else f"团队面临第{round_num}轮的重要决策..."
+                ),
                 "options": [
                     "选项1: 保守策略",
                     "选项2: 激进策略",
@@ -445,22 +411,8 @@ class GameHandler:
                     "选项4: 创新策略",
                 ],
             }
-            room.round_events[1] = default_event
-            room.round_private_messages[1] = {}
-
-        # 第六步：设置游戏状态为进行中并广播游戏开始消息
-        room.game_state = GameState.PLAYING
-        await connection_manager.broadcast_to_room(
-            room_id,
-            {
-                "type": MessageType.GAME_STARTED,
-                "data": {
-                    "round": 1,
-                    "roundEvent": room.round_events[1],
-                    "privateMessages": room.round_private_messages[1],
-                },
-            },
-        )
+            room.set_round_event(round_num, default_event, {})
+            room.summarize_round(round_num)
 
     @staticmethod
     async def handle_game_action(player_name: str, action_data: Dict):
@@ -477,6 +429,12 @@ class GameHandler:
         if not player:
             return
 
+        # 排队期间轮次已经结束的行动不计入新的轮次
+        action_round = action_data.get("round")
+        if isinstance(action_round, int) and action_round != room.current_round:
+            logger.info("忽略玩家 %s 第%s轮的过期行动", player_name, action_round)
+            return
+
         # 构建行动数据
         action = {
             "playerName": player_name,  # 修正为前端期望的字段名
@@ -490,7 +448,7 @@ class GameHandler:
 
         room.add_round_action(room.current_round, action)
         logger.info(
-            f"玩家 {player_name} 提交第{room.current_round}轮行动: {action['action']}"
+            "玩家 %s 提交第%s轮行动: %s", player_name, room.current_round, action['action']
         )
 
         # 广播行动提交
@@ -510,11 +468,18 @@ class GameHandler:
         # 检查是否所有玩家都提交了行动
         if room.all_players_submitted_actions(room.current_round):
             await GameHandler._handle_round_complete(room_id, room)
+        elif room.submitted_action_count(room.current_round) >= (
+            EVENT_SPECULATION_QUORUM * room.online_player_count()
+        ):
+            # 达到法定人数后确认预生成任务的输入，输入变化时会重新生成
+            GameHandler._speculate_next_round(room_id, room)
 
     @staticmethod
     async def _handle_round_complete(room_id: str, room: GameRoom):
         """处理轮次完成"""
-        logger.info(f"房间 {room_id} 第{room.current_round}轮完成")
+        logger.info("房间 %s 第%s轮完成", room_id, room.current_round)
+        # 补上本轮玩家的决策，最终报告会用到
+        room.summarize_round(room.current_round)
 
         # 检查是否游戏结束
         if room.current_round >= 5:
@@ -538,8 +503,8 @@ class GameHandler:
         
         # 计算游戏结果
         room.game_state = GameState.FINISHED
-        room.game_result = room.calculate_game_result()
-        logger.info(f"房间 {room_id} 游戏结束")
+        room.game_result = await room.calculate_game_result()
+        logger.info("房间 %s 游戏结束", room_id)
 
         await connection_manager.broadcast_to_room(
             room_id,
@@ -548,11 +513,29 @@ class GameHandler:
 
     # handle_continue_next_round方法已移除，因为现在自动进入下一轮
 
+    @staticmethod
+    async def resume_interrupted_game(room_id: str, room: GameRoom):
+        """继续进程重启时中断的生成阶段，已经保存的生成结果不会重新生成"""
+        if room.game_state == GameState.FINISHED and room.game_result is None:
+            logger.info("房间 %s 恢复后继续计算游戏结果", room_id)
+            await GameHandler._handle_game_complete(room_id, room)
+        elif room.game_state == GameState.LOADING:
+            if room.current_round in room.round_events:
+                # 本轮事件已经生成，只是还没来得及进入进行中状态
+                room.game_state = GameState.PLAYING
+            elif not room.round_events:
+                logger.info("房间 %s 恢复后继续开局生成", room_id)
+                await GameHandler._auto_start_game_after_role_selection(room_id)
+            else:
+                logger.info("房间 %s 恢复后继续生成第%s轮事件", room_id, room.current_round)
+                room.current_round -= 1
+                await GameHandler._start_next_round(room_id, room)
+
     @staticmethod
     async def _start_next_round(room_id: str, room):
         """开始下一轮"""
         room.current_round += 1
-        logger.info(f"房间 {room_id} 开始第{room.current_round}轮")
+        logger.info("房间 %s 开始第%s轮", room_id, room.current_round)
 
         # 先广播回合加载状态
         room.game_state = GameState.LOADING
@@ -567,54 +550,20 @@ class GameHandler:
             },
         )
 
-        # 生成当前轮次的事件
-        try:
-
-            # 设置之前的输出用于生成连贯的事件
-            if room.current_round > 1:
-                previous_round = room.current_round - 1
-                if previous_round in room.round_actions:
-                    room.round_situation[room.current_round] = {
-                        "round": previous_round,
-                        "players_choices": {},  # 这里可以根据实际行动数据构建
-                        "final_choice": 1,  # 简化处理
-                        "impact": "上一轮的决策产生了影响...",
-                    }
-
-            event_data = await asyncio.get_event_loop().run_in_executor(
-                None, room.generate_event, room.current_round
-            )
-
-            # 保存事件和私人信息到房间状态
-            room.round_events[room.current_round] = event_data["event"]
-            room.round_private_messages[room.current_round] = event_data[
-                "private_messages"
-            ]
-            if "situation" in event_data:
-                room.round_situation[room.current_round] = event_data["situation"]
+        # 设置之前的输出用于生成连贯的事件
+        if room.current_round > 1:
+            previous_round = room.current_round - 1
+            if previous_round in room.round_actions:
+                room.set_round_situation(
+                    room.current_round, room.situation_for_round(room.current_round)
+                )
 
-            logger.info(f"房间 {room_id} 第{room.current_round}轮事件生成成功")
-            logger.info(f"私人信息内容: {event_data['private_messages']}")
-        except Exception as e:
-            logger.error(
-                f"房间 {room_id} 生成第{room.current_round}轮事件失败: {str(e)}"
-            )
-            # 如果生成失败，使用默认事件
-            default_event = {
-                "description": f"团队面临第{room.current_round}轮的重要决策...",
-                "options": [
-                    "选项1: 保守策略",
-                    "选项2: 激进策略",
-                    "选项3: 平衡策略",
-                    "选项4: 创新策略",
-                ],
-            }
-            room.round_events[room.current_round] = default_event
-            room.round_private_messages[room.current_round] = {}
+        # 生成当前轮次的事件
+        await GameHandler._generate_round_event(room_id, room, room.current_round)
 
         # 设置游戏状态为进行中并广播轮次开始
         room.game_state = GameState.PLAYING
-        await connection_manager.broadcast_to_room(
+        await connection_manager.broadcast_private_to_room(
             room_id,
             {
                 "type": MessageType.ROUND_START,
@@ -622,11 +571,20 @@ class GameHandler:
                     "round": room.current_round,
                     "roundInfo": room.get_round_info(room.current_round),
                     "roundEvent": room.round_events[room.current_round],
-                    "privateMessages": room.round_private_messages[room.current_round],
                 },
             },
+            room.round_private_messages[room.current_round],
         )
 
+        # 玩家决策期间预生成下一轮事件
+        GameHandler._speculate_next_round(room_id, room)
+
+    @staticmethod
+    def _speculate_next_round(room_id: str, room: GameRoom):
+        """在后台预生成下一轮事件（最后一轮之后不需要）"""
+        if room.current_round < 5:
+            event_speculator.start(room_id, room, room.current_round + 1)
+
     @staticmethod
     async def handle_restart_game(player_name: str):
         """处理游戏重新开始"""
@@ -643,8 +601,9 @@ class GameHandler:
             return
 
         # 只有房主可以重新开始游戏
+        event_speculator.cancel_room(room_id)
         room.restart_game()
-        logger.info(f"房间 {room_id} 游戏重新开始")
+        logger.info("房间 %s 游戏重新开始", room_id)
 
         await connection_manager.broadcast_to_room(
             room_id,
@@ -0,0 +1,275 @@
+from typing import Any, Dict, List, Optional, Tuple, Union
+import json
+
+# JSON路径，例如 ("event", "decision_options", "A")
+JSONPath = Tuple[Union[str, int], ...]
+
+_ESCAPES = {
+    '"': '"',
+    "\\": "\\",
+    "/": "/",
+    "b": "\b",
+    "f": "\f",
+    "n": "\n",
+    "r": "\r",
+    "t": "\t",
+}
+
+
+class IncrementalJSONParser:
+    """增量JSON解析器
+
+    逐块喂入模型的流式输出，实时返回各字符串字段新增的文本片段，
+    无需等待整个JSON对象生成完毕。第一个 "{" 之前的内容（例如markdown前缀）会被忽略。
+    """
+
+    def __init__(self):
+        # 容器栈：对象为 {"key": 当前键, "expect_key": 是否等待键}，数组为 {"index": 当前下标}
+        self._stack: List[Dict[str, Any]] = []
+        self._started = False
+        self._done = False
+        self._in_string = False
+        self._is_key = False
+        self._key_chars: List[str] = []
+        self._escape: Optional[str] = None
+        # \uXXXX转义得到的高位代理项，等待下一个转义的低位代理项组合成一个字符
+        self._high_surrogate: Optional[int] = None
+        self._deltas: List[Tuple[JSONPath, str]] = []
+
+    @property
+    def done(self) -> bool:
+        """最外层对象是否已经闭合"""
+        return self._done
+
+    def feed(self, chunk: str) -> List[Tuple[JSONPath, str]]:
+        """喂入一段文本，返回本段中各字符串字段新增的 (路径, 文本) 列表"""
+        self._deltas = []
+        for ch in chunk:
+            if self._done:
+                break
+            if self._in_string:
+                self._feed_string_char(ch)
+            elif not self._started:
+                if ch == "{":
+                    self._started = True
+                    self._stack.append({"key": None, "expect_key": True})
+            else:
+                self._feed_structural_char(ch)
+        return self._deltas
+
+    def _feed_string_char(self, ch: str):
+        if self._escape is not None:
+            self._escape += ch
+            if self._escape[0] == "u":
+                if len(self._escape) < 5:
+                    return
+                self._escape, code = None, self._escape[1:]
+                try:
+                    self._feed_code_point(int(code, 16))
+                except ValueError:
+                    pass
+                return
+            text = _ESCAPES.get(self._escape, self._escape)
+            self._escape = None
+            self._emit_text(text)
+        elif ch == "\\":
+            # 高位代理项在这里不输出，后面可能紧跟低位代理项的转义
+            self._escape = ""
+        elif ch == '"':
+            self._flush_surrogate()
+            self._in_string = False
+            if self._is_key:
+                self._stack[-1]["key"] = "".join(self._key_chars)
+        else:
+            self._emit_text(ch)
+
+    def _feed_code_point(self, code: int):
+        """处理\\uXXXX转义，代理对（例如emoji）组合成一个字符，不输出单独的代理项"""
+        if 0xD800 <= code <= 0xDBFF:
+            self._flush_surrogate()
+            self._high_surrogate = code
+        elif 0xDC00 <= code <= 0xDFFF:
+            if self._high_surrogate is None:
+                self._emit("\ufffd")
+                return
+            high, self._high_surrogate = self._high_surrogate, None
+            self._emit(chr(0x10000 + ((high - 0xD800) << 10) + (code - 0xDC00)))
+        else:
+            self._emit_text(chr(code))
+
+    def _flush_surrogate(self):
+        """没有配对的高位代理项替换为U+FFFD"""
+        if self._high_surrogate is not None:
+            self._high_surrogate = None
+            self._emit("\ufffd")
+
+    def _emit_text(self, text: str):
+        self._flush_surrogate()
+        self._emit(text)
+
+    def _feed_structural_char(self, ch: str):
+        top = self._stack[-1]
+        if ch == '"':
+            self._in_string = True
+            self._is_key = "expect_key" in top and top["expect_key"]
+            self._key_chars = []
+        elif ch == "{":
+            self._stack.append({"key": None, "expect_key": True})
+        elif ch == "[":
+            self._stack.append({"index": 0})
+        elif ch in "}]":
+            self._stack.pop()
+            if not self._stack:
+                self._done = True
+        elif ch == ":":
+            top["expect_key"] = False
+        elif ch == ",":
+            if "expect_key" in top:
+                top["expect_key"] = True
+                top["key"] = None
+            else:
+                top["index"] += 1
+
+    def _current_path(self) -> JSONPath:
+        return tuple(
+            level["key"] if "expect_key" in level else level["index"]
+            for level in self._stack
+        )
+
+    def _emit(self, text: str):
+        if self._is_key:
+            self._key_chars.append(text)
+            return
+        path = self._current_path()
+        if self._deltas and self._deltas[-1][0] == path:
+            self._deltas[-1] = (path, self._deltas[-1][1] + text)
+        else:
+            self._deltas.append((path, text))
+
+
+_CLOSERS = {"{": "}", "[": "]"}
+
+
+def _strip_trailing_comma(out: List[str]):
+    """去掉末尾的空白和逗号"""
+    while out and (out[-1].isspace() or out[-1] == ","):
+        out.pop()
+
+
+def repair_json(text: str) -> str:
+    """从模型输出中提取最外层的JSON对象并修复常见问题
+
+    - 忽略第一个 "{" 之前和最外层对象闭合之后的内容（markdown代码块标记、说明文字等）
+    - 去掉对象和数组末尾多余的逗号
+    - 输出被截断（例如达到max_tokens）时补全未结束的字符串和括号，
+      丢弃只有键没有值的字段和不完整的数字、布尔值
+
+    Raises:
+        ValueError: 输出中没有JSON对象
+    """
+    start = text.find("{")
+    if start < 0:
+        raise ValueError("输出中没有JSON对象")
+
+    out: List[str] = []
+    # 容器栈，每层为 [括号, 状态, 当前键或元素在out中的起始位置]
+    # 对象的状态: key, key_str, colon, value, value_str, scalar, after
+    # 数组的状态: value, value_str, scalar, after
+    stack: List[List[Any]] = []
+    in_string = False
+    escape = False
+    # 字符串中最近一个转义序列的反斜杠在out中的位置
+    escape_start = -1
+    scalar_start = 0
+
+    for ch in text[start:]:
+        if in_string:
+            out.append(ch)
+            if escape:
+                escape = False
+            elif ch == "\\":
+                escape = True
+                escape_start = len(out) - 1
+            elif ch == '"':
+                in_string = False
+                top = stack[-1]
+                top[1] = "colon" if top[1] == "key_str" else "after"
+            continue
+
+        top = stack[-1] if stack else None
+        if top and top[1] == "scalar" and (ch in ",}]" or ch.isspace()):
+            top[1] = "after"
+
+        if ch == '"':
+            if top[1] == "key":
+                top[1], top[2] = "key_str", len(out)
+            elif top[1] == "value":
+                if top[0] == "[":
+                    top[2] = len(out)
+                top[1] = "value_str"
+            else:
+                continue
+            in_string = True
+            out.append(ch)
+        elif ch in "{[":
+            if top:
+                if top[1] != "value":
+                    continue
+                if top[0] == "[":
+                    top[2] = len(out)
+                top[1] = "after"
+            stack.append([ch, "key" if ch == "{" else "value", len(out)])
+            out.append(ch)
+        elif ch in "}]":
+            _strip_trailing_comma(out)
+            out.append(_CLOSERS[stack.pop()[0]])
+            if not stack:
+                return "".join(out)
+        elif ch == ":":
+            if top[1] == "colon":
+                top[1] = "value"
+                out.append(ch)
+        elif ch == ",":
+            if top[1] == "after":
+                top[1] = "key" if top[0] == "{" else "value"
+                out.append(ch)
+        elif ch.isspace():
+            out.append(ch)
+        elif top[1] == "value":
+            if top[0] == "[":
+                top[2] = len(out)
+            top[1] = "scalar"
+            scalar_start = len(out)
+            out.append(ch)
+        elif top[1] == "scalar":
+            out.append(ch)
+
+    # 输出被截断，补全最内层未完成的键或值
+    top = stack[-1]
+    if in_string:
+        if escape:
+            out.pop()
+        elif out[escape_start + 1:escape_start + 2] == ["u"] and len(out) - escape_start < 6:
+            # 截断在 \uXXXX 中间，丢弃不完整的转义序列
+            del out[escape_start:]
+        if top[1] == "key_str":
+            top[1] = "colon"
+        else:
+            out.append('"')
+            top[1] = "after"
+    if top[1] == "scalar":
+        try:
+            json.loads("".join(out[scalar_start:]))
+            top[1] = "after"
+        except ValueError:
+            del out[scalar_start:]
+            top[1] = "value"
+    if top[0] == "{" and top[1] in ("colon", "value"):
+        # 只有键没有值的字段整个丢弃
+        del out[top[2]:]
+
+    while stack:
+        _strip_trailing_comma(out)
+        out.append(_CLOSERS[stack.pop()[0]])
+    return "".join(out)
+
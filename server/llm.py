@@ -1,10 +1,17 @@
 import openai
+import httpx
 import json
 import os
-from typing import Iterable, Optional, Dict, Any, List
+from typing import Iterable, Optional, Dict, Any, List, Tuple, Callable, Awaitable, Type
+from pydantic import BaseModel
 from dotenv import load_dotenv
 
 from logger_config import logger
+from json_stream import IncrementalJSONParser, JSONPath, repair_json
+from llm_cache import llm_cache, make_cache_key
+from llm_policy import LLMError, llm_policy
+from llm_scheduler import estimate_tokens, llm_scheduler
+from llm_usage import llm_usage
 
 # 加载.env文件
 load_dotenv()
@@ -12,6 +19,80 @@ from openai.types.chat import ChatCompletionMessageParam
 # model = "qwen/qwen3-coder-480b-a35b-instruct"
 model = "moonshotai/kimi-k2-instruct"
 
+# 异步客户端连接池配置
+LLM_MAX_CONNECTIONS = int(os.getenv("LLM_MAX_CONNECTIONS", "50"))
+LLM_MAX_KEEPALIVE_CONNECTIONS = int(os.getenv("LLM_MAX_KEEPALIVE_CONNECTIONS", "20"))
+LLM_KEEPALIVE_EXPIRY = float(os.getenv("LLM_KEEPALIVE_EXPIRY", "60"))
+
+# 进程级共享的异步客户端，按(api_key, base_url)复用同一个连接池
+_async_clients: Dict[Tuple[Optional[str], Optional[str]], openai.AsyncOpenAI] = {}
+
+
+def get_async_client(
+    api_key: Optional[str] = None, base_url: Optional[str] = None
+) -> openai.AsyncOpenAI:
+    """获取进程级共享的AsyncOpenAI客户端（带有上限的keep-alive连接池）"""
+    key = (api_key, base_url)
+    client = _async_clients.get(key)
+    if client is None:
+        client = openai.AsyncOpenAI(
+            api_key=api_key,
+            base_url=base_url,
+            http_client=openai.DefaultAsyncHttpxClient(
+                limits=httpx.Limits(
+                    max_connections=LLM_MAX_CONNECTIONS,
+                    max_keepalive_connections=LLM_MAX_KEEPALIVE_CONNECTIONS,
+                    keepalive_expiry=LLM_KEEPALIVE_EXPIRY,
+                )
+            ),
+        )
+        _async_clients[key] = client
+    return client
+
+
+async def close_async_clients():
+    """关闭所有共享的异步客户端（在应用关闭时调用）"""
+    clients = list(_async_clients.values())
+    _async_clients.clear()
+    for client in clients:
+        await client.close()
+
+
+def _build_messages(prompt: str, system_prompt: Optional[str]) -> List[Dict[str, str]]:
+    """构建对话消息列表"""
+    messages = []
+    if system_prompt:
+        messages.append({"role": "system", "content": system_prompt})
+    messages.append({"role": "user", "content": prompt})
+    return messages
+
+
+def _json_system_prompt(system_prompt: Optional[str]) -> str:
+    """为JSON输出补充格式要求"""
+    # 如果没有提供系统提示，添加默认的JSON格式要求
+    if not system_prompt:
+        return "请以有效的JSON格式回复，不要包含任何其他文本。不要包含markdown格式的前后缀！"
+    return system_prompt + "\n\n请确保回复是有效的JSON格式。"
+
+
+def _parse_json_content(content: str) -> Dict[str, Any]:
+    """解析模型输出的JSON，格式有误或被截断时先修复再解析，避免整次重新生成"""
+    logger.debug("生成结果:%s", content)
+    try:
+        return json.loads(content)
+    except json.JSONDecodeError:
+        # 去掉markdown代码块前后缀和说明文字，修复多余的逗号和截断的输出
+        result = json.loads(repair_json(content), strict=False)
+        logger.warning("模型输出的JSON格式有误或不完整，已自动修复")
+        return result
+
+
+def _validate(result: Dict[str, Any], schema: Optional[Type[BaseModel]]) -> Any:
+    """按阶段的输出结构校验并规范化结果，不符合时抛出ValidationError（会被重试）"""
+    if schema is None:
+        return result
+    return schema.model_validate(result).model_dump()
+
 
 class LLM:
     """封装OpenAI大模型的类"""
@@ -21,14 +102,63 @@ class LLM:
         api_key: Optional[str] = None,
         model: str = model,
         base_url: Optional[str] = None,
+        cache: bool = False,
+        room_id: Optional[str] = None,
+        stage: Optional[str] = None,
     ):
+        """
+        Args:
+            cache: 是否对异步的text/json调用启用响应缓存（相同输入直接返回之前的结果）
+            room_id: 发起请求的房间，用于调度时在房间之间轮流执行
+            stage: 生成阶段（event、background、roles、report），决定调度优先级
+        """
         # 从环境变量获取api_key和base_url
         if api_key is None:
             api_key = os.getenv('PPIO_API_KEY')
         if base_url is None:
             base_url = os.getenv('PPIO_BASE_URL')
-        self.client = openai.OpenAI(api_key=api_key, base_url=base_url)
+        self.api_key = api_key
+        self.base_url = base_url
         self.model = model
+        self.cache = cache
+        self.room_id = room_id
+        self.stage = stage
+        self._client: Optional[openai.OpenAI] = None
+
+    @property
+    def client(self) -> openai.OpenAI:
+        """同步客户端（按需创建）"""
+        if self._client is None:
+            self._client = openai.OpenAI(api_key=self.api_key, base_url=self.base_url)
+        return self._client
+
+    @property
+    def async_client(self) -> openai.AsyncOpenAI:
+        """进程级共享的异步客户端"""
+        return get_async_client(self.api_key, self.base_url)
+
+    def _slot(self, prompt: str, system_prompt: Optional[str], max_tokens: Optional[int]):
+        """异步请求的调度名额，超出并发或token预算时排队"""
+        return llm_scheduler.slot(
+            self.room_id,
+            self.stage,
+            estimate_tokens(system_prompt, prompt, max_tokens=max_tokens),
+        )
+
+    def _cache_key(
+        self,
+        kind: str,
+        temperature: float,
+        max_tokens: Optional[int],
+        system_prompt: Optional[str],
+        prompt: str,
+    ) -> Optional[str]:
+        """未启用缓存时返回None"""
+        if not self.cache or llm_cache is None:
+            return None
+        return make_cache_key(
+            kind, self.model, temperature, max_tokens, system_prompt, prompt
+        )
 
     def text(
         self,
@@ -49,14 +179,9 @@ class LLM:
         Returns:
             生成的文本内容
         """
-        messages = []
-
-        if system_prompt:
-            messages.append({"role": "system", "content": system_prompt})
+        messages = _build_messages(prompt, system_prompt)
 
-        messages.append({"role": "user", "content": prompt})
-
-        logger.info(f"发送给OpenAI的消息: {messages}")
+        logger.debug("发送给OpenAI的消息: %s", messages)
 
         try:
             response = self.client.chat.completions.create(
@@ -65,10 +190,10 @@ class LLM:
                 temperature=temperature,
                 max_tokens=max_tokens,
             )
-            logger.info(f"生成的结果:{response.choices[0].message.content}")
+            logger.debug("生成的结果:%s", response.choices[0].message.content)
             return response.choices[0].message.content or ""
         except Exception as e:
-            raise Exception(f"调用OpenAI API失败: {str(e)}")
+            raise LLMError(f"调用OpenAI API失败: {str(e)}")
 
     def json(
         self,
@@ -89,11 +214,7 @@ class LLM:
         Returns:
             解析后的JSON对象
         """
-        # 如果没有提供系统提示，添加默认的JSON格式要求
-        if not system_prompt:
-            system_prompt = "请以有效的JSON格式回复，不要包含任何其他文本。不要包含markdown格式的前后缀！"
-        else:
-            system_prompt += "\n\n请确保回复是有效的JSON格式。"
+        system_prompt = _json_system_prompt(system_prompt)
         try:
             response = self.client.chat.completions.create(
                 model=self.model,
@@ -106,21 +227,14 @@ class LLM:
                 response_format={"type": "json_object"},
             )
 
-            logger.info(f"提示词：{prompt}")
+            logger.debug("提示词：%s", prompt)
 
             content = response.choices[0].message.content or ""
-
-            if content.startswith("```json"):
-                content = content[7:]
-            if content.endswith("```"):
-                content = content[:-3]
-
-            logger.info(f"生成结果:{content}")
-            return json.loads(content)
+            return _parse_json_content(content)
         except json.JSONDecodeError as e:
-            raise Exception(f"返回的内容不是有效的JSON格式: {str(e)}")
+            raise LLMError(f"返回的内容不是有效的JSON格式: {str(e)}")
         except Exception as e:
-            raise Exception(f"调用OpenAI API失败: {str(e)}")
+            raise LLMError(f"调用OpenAI API失败: {str(e)}")
 
     def chat(
         self,
@@ -148,7 +262,176 @@ class LLM:
             )
             return response.choices[0].message.content or ""
         except Exception as e:
-            raise Exception(f"调用OpenAI API失败: {str(e)}")
+            raise LLMError(f"调用OpenAI API失败: {str(e)}")
+
+    async def _acreate(
+        self,
+        messages: List[Dict[str, str]],
+        temperature: float,
+        max_tokens: Optional[int],
+        parse: Callable[[str], Any] = lambda content: content,
+        cache_key: Optional[str] = None,
+        **kwargs,
+    ) -> Any:
+        """发送一次非流式请求并解析结果，经过调度和调用策略（重试、对冲、备用模型）
+
+        解析失败的返回内容和API错误一样会重试。提供cache_key时缓存主模型的结果；
+        缓存键按主模型计算，备用模型返回的结果不缓存。
+        """
+        prompt = "".join(str(message.get("content") or "") for message in messages)
+
+        async def call(model: str) -> Any:
+            async with self._slot(prompt, None, max_tokens):
+                response = await self.async_client.chat.completions.create(
+                    model=model,
+                    messages=messages,
+                    temperature=temperature,
+                    max_tokens=max_tokens,
+                    **kwargs,
+                )
+            llm_usage.record(self.room_id, self.stage, model, getattr(response, "usage", None))
+            content = response.choices[0].message.content or ""
+            logger.debug("生成的结果:%s", content)
+            result = parse(content)
+            if cache_key and model == self.model and result:
+                llm_cache.set(cache_key, result)
+            return result
+
+        return await llm_policy.run(self.stage, self.model, call)
+
+    async def atext(
+        self,
+        prompt: str,
+        system_prompt: Optional[str] = None,
+        temperature: float = 0.7,
+        max_tokens: Optional[int] = None,
+    ) -> str:
+        """text的异步版本，直接在事件循环上运行"""
+        cache_key = self._cache_key("text", temperature, max_tokens, system_prompt, prompt)
+        if cache_key:
+            cached = llm_cache.get(cache_key)
+            if cached is not None:
+                logger.info("命中LLM缓存，直接返回之前的生成结果")
+                return cached
+
+        messages = _build_messages(prompt, system_prompt)
+
+        logger.debug("发送给OpenAI的消息: %s", messages)
+
+        return await self._acreate(messages, temperature, max_tokens, cache_key=cache_key)
+
+    async def ajson(
+        self,
+        prompt: str,
+        system_prompt: Optional[str] = None,
+        temperature: float = 0.3,
+        max_tokens: Optional[int] = None,
+        schema: Optional[Type[BaseModel]] = None,
+    ) -> Dict[str, Any]:
+        """json的异步版本，直接在事件循环上运行
+
+        提供schema时按该结构校验输出，不符合时和调用失败一样重试。
+        """
+        system_prompt = _json_system_prompt(system_prompt)
+        cache_key = self._cache_key("json", temperature, max_tokens, system_prompt, prompt)
+        if cache_key:
+            cached = llm_cache.get(cache_key)
+            if cached is not None:
+                logger.info("命中LLM缓存，直接返回之前的生成结果")
+                return cached
+
+        logger.debug("提示词：%s", prompt)
+
+        return await self._acreate(
+            [
+                {"role": "system", "content": system_prompt},
+                {"role": "user", "content": prompt},
+            ],
+            temperature,
+            max_tokens,
+            parse=lambda content: _validate(_parse_json_content(content), schema),
+            cache_key=cache_key,
+            response_format={"type": "json_object"},
+        )
+
+    async def ajson_stream(
+        self,
+        prompt: str,
+        on_delta: Callable[[List[Tuple[JSONPath, str]]], Awaitable[None]],
+        system_prompt: Optional[str] = None,
+        temperature: float = 0.3,
+        max_tokens: Optional[int] = None,
+        schema: Optional[Type[BaseModel]] = None,
+    ) -> Dict[str, Any]:
+        """
+        以流式方式生成JSON格式的响应
+
+        已经推送过增量后失败不再重试，避免玩家收到重复的内容；不使用对冲请求。
+
+        Args:
+            prompt: 用户输入的提示
+            on_delta: 每收到一段输出时调用，参数为各字符串字段新增的 (路径, 文本) 列表
+            system_prompt: 系统提示（可选）
+            temperature: 温度参数
+            max_tokens: 最大token数量
+            schema: 输出结构（可选），不符合时抛出ValidationError
+
+        Returns:
+            解析后的完整JSON对象
+        """
+        system_prompt = _json_system_prompt(system_prompt)
+        delivered = False
+
+        async def call(model: str) -> Dict[str, Any]:
+            nonlocal delivered
+            parser = IncrementalJSONParser()
+            parts: List[str] = []
+            # 流式请求在整个输出期间占用名额
+            async with self._slot(prompt, system_prompt, max_tokens):
+                stream = await self.async_client.chat.completions.create(
+                    model=model,
+                    messages=[
+                        {"role": "system", "content": system_prompt},
+                        {"role": "user", "content": prompt},
+                    ],
+                    temperature=temperature,
+                    max_tokens=max_tokens,
+                    response_format={"type": "json_object"},
+                    stream=True,
+                    # 最后一个数据块中返回整个请求的token用量
+                    stream_options={"include_usage": True},
+                )
+
+                logger.debug("提示词：%s", prompt)
+
+                async for chunk in stream:
+                    if getattr(chunk, "usage", None):
+                        llm_usage.record(self.room_id, self.stage, model, chunk.usage)
+                    if not chunk.choices:
+                        continue
+                    text = chunk.choices[0].delta.content
+                    if not text:
+                        continue
+                    parts.append(text)
+                    deltas = parser.feed(text)
+                    if deltas:
+                        delivered = True
+                        await on_delta(deltas)
+
+            return _validate(_parse_json_content("".join(parts)), schema)
+
+        return await llm_policy.run(
+            self.stage, self.model, call, hedge=False, can_retry=lambda: not delivered
+        )
+
+    async def achat(
+        self,
+        messages: Iterable[ChatCompletionMessageParam],
+        temperature: float = 0.7,
+        max_tokens: Optional[int] = None,
+    ) -> str:
+        """chat的异步版本，直接在事件循环上运行"""
+        return await self._acreate(list(messages), temperature, max_tokens)
 
 
 # 使用示例
@@ -0,0 +1,165 @@
+from collections import OrderedDict
+from typing import Any, Dict, Optional, Tuple
+import copy
+import hashlib
+import json
+import os
+import sqlite3
+import time
+
+from logger_config import logger
+
+# 缓存后端: memory（默认）、sqlite、off
+LLM_CACHE_BACKEND = os.getenv("LLM_CACHE_BACKEND", "memory")
+LLM_CACHE_MAX_ENTRIES = int(os.getenv("LLM_CACHE_MAX_ENTRIES", "512"))
+LLM_CACHE_TTL = float(os.getenv("LLM_CACHE_TTL", "3600"))
+# 与房间持久化一样默认保存在用户目录下，不写入代码目录
+LLM_CACHE_PATH = os.getenv(
+    "LLM_CACHE_PATH",
+    os.path.join(os.path.expanduser("~"), ".startup-mod", "llm_cache.sqlite3"),
+)
+
+
+def make_cache_key(
+    kind: str,
+    model: str,
+    temperature: float,
+    max_tokens: Optional[int],
+    system_prompt: Optional[str],
+    prompt: str,
+) -> str:
+    """根据模型、温度、系统提示和渲染后的提示词计算缓存键"""
+    payload = json.dumps(
+        [kind, model, temperature, max_tokens, system_prompt, prompt],
+        ensure_ascii=False,
+    )
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+class MemoryLLMCache:
+    """内存LRU缓存，条目超过TTL后失效"""
+
+    def __init__(self, max_entries: int = LLM_CACHE_MAX_ENTRIES, ttl: float = LLM_CACHE_TTL):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        # 缓存键 -> (过期时间, 生成结果)
+        self._entries: "OrderedDict[str, Tuple[float, Any]]" = OrderedDict()
+
+    def get(self, key: str) -> Optional[Any]:
+        """获取缓存的生成结果，不存在或已过期时返回None"""
+        entry = self._entries.get(key)
+        if entry is None or entry[0] < time.monotonic():
+            if entry is not None:
+                del self._entries[key]
+            self.misses += 1
+            return None
+        self._entries.move_to_end(key)
+        self.hits += 1
+        # 返回副本，避免调用方修改缓存中的对象
+        return copy.deepcopy(entry[1])
+
+    def set(self, key: str, value: Any):
+        """写入生成结果，超出容量时淘汰最久未使用的条目"""
+        # 存入副本，调用方之后修改返回给它的结果不会影响缓存
+        self._entries[key] = (time.monotonic() + self.ttl, copy.deepcopy(value))
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    def clear(self):
+        """清空缓存"""
+        self._entries.clear()
+
+    def stats(self) -> Dict[str, Any]:
+        """命中统计"""
+        return {
+            "backend": "memory",
+            "hits": self.hits,
+            "misses": self.misses,
+            "size": len(self._entries),
+        }
+
+
+class SQLiteLLMCache:
+    """基于SQLite的磁盘缓存，进程重启后仍然有效"""
+
+    def __init__(
+        self,
+        path: str = LLM_CACHE_PATH,
+        max_entries: int = LLM_CACHE_MAX_ENTRIES,
+        ttl: float = LLM_CACHE_TTL,
+    ):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS llm_cache ("
+            "key TEXT PRIMARY KEY, value TEXT NOT NULL, "
+            "expires_at REAL NOT NULL, used_at REAL NOT NULL)"
+        )
+        self._conn.commit()
+
+    def get(self, key: str) -> Optional[Any]:
+        """获取缓存的生成结果，不存在或已过期时返回None"""
+        now = time.time()
+        row = self._conn.execute(
+            "SELECT value, expires_at FROM llm_cache WHERE key = ?", (key,)
+        ).fetchone()
+        if row is None or row[1] < now:
+            if row is not None:
+                self._conn.execute("DELETE FROM llm_cache WHERE key = ?", (key,))
+                self._conn.commit()
+            self.misses += 1
+            return None
+        self._conn.execute("UPDATE llm_cache SET used_at = ? WHERE key = ?", (now, key))
+        self._conn.commit()
+        self.hits += 1
+        return json.loads(row[0])
+
+    def set(self, key: str, value: Any):
+        """写入生成结果，超出容量时淘汰最久未使用的条目"""
+        now = time.time()
+        self._conn.execute(
+            "INSERT OR REPLACE INTO llm_cache (key, value, expires_at, used_at) "
+            "VALUES (?, ?, ?, ?)",
+            (key, json.dumps(value, ensure_ascii=False), now + self.ttl, now),
+        )
+        self._conn.execute(
+            "DELETE FROM llm_cache WHERE key NOT IN "
+            "(SELECT key FROM llm_cache ORDER BY used_at DESC LIMIT ?)",
+            (self.max_entries,),
+        )
+        self._conn.commit()
+
+    def clear(self):
+        """清空缓存"""
+        self._conn.execute("DELETE FROM llm_cache")
+        self._conn.commit()
+
+    def stats(self) -> Dict[str, Any]:
+        """命中统计"""
+        size = self._conn.execute("SELECT COUNT(*) FROM llm_cache").fetchone()[0]
+        return {
+            "backend": "sqlite",
+            "hits": self.hits,
+            "misses": self.misses,
+            "size": size,
+        }
+
+
+def _create_cache():
+    if LLM_CACHE_BACKEND == "off":
+        return None
+    if LLM_CACHE_BACKEND == "sqlite":
+        logger.info(f"LLM缓存使用SQLite后端: {LLM_CACHE_PATH}")
+        return SQLiteLLMCache()
+    return MemoryLLMCache()
+
+
+# 全局LLM缓存实例，LLM_CACHE_BACKEND=off 时为None
+llm_cache = _create_cache()
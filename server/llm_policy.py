@@ -0,0 +1,212 @@
+from collections import deque
+from typing import Any, Awaitable, Callable, Deque, Dict, List, Optional
+import asyncio
+import logging
+import os
+import random
+import time
+
+import openai
+
+logger = logging.getLogger(__name__)
+
+# 每个模型的最大尝试次数（包括第一次）
+LLM_MAX_ATTEMPTS = int(os.getenv("LLM_MAX_ATTEMPTS", "3"))
+# 指数退避的基础间隔和上限（秒），实际等待时间在 [0, 上限] 之间随机
+LLM_BACKOFF_BASE = float(os.getenv("LLM_BACKOFF_BASE", "0.5"))
+LLM_BACKOFF_MAX = float(os.getenv("LLM_BACKOFF_MAX", "8"))
+# 各生成阶段的总时限（秒，包括重试和备用模型），格式为 "stage=seconds,stage=seconds"
+LLM_STAGE_DEADLINES = os.getenv(
+    "LLM_STAGE_DEADLINES", "event=45,background=30,roles=45,report=90"
+)
+LLM_DEFAULT_DEADLINE = float(os.getenv("LLM_DEFAULT_DEADLINE", "60"))
+# 主模型失败后依次尝试的备用模型，逗号分隔
+LLM_FALLBACK_MODELS = os.getenv(
+    "LLM_FALLBACK_MODELS", "qwen/qwen3-coder-480b-a35b-instruct"
+)
+# 对冲请求：请求耗时超过该阶段最近耗时的p95时再发出一个相同的请求，使用先完成的结果
+LLM_HEDGE = os.getenv("LLM_HEDGE", "off")
+# 计算p95所需的最少样本数，以及保留的最近样本数
+LLM_HEDGE_MIN_SAMPLES = int(os.getenv("LLM_HEDGE_MIN_SAMPLES", "20"))
+LLM_LATENCY_WINDOW = int(os.getenv("LLM_LATENCY_WINDOW", "100"))
+
+
+class LLMError(Exception):
+    """大模型调用失败（已经过重试和备用模型）"""
+
+
+def _parse_stage_deadlines(spec: str) -> Dict[str, float]:
+    deadlines = {}
+    for item in spec.split(","):
+        stage, _, seconds = item.partition("=")
+        if stage.strip() and seconds.strip():
+            deadlines[stage.strip()] = float(seconds)
+    return deadlines
+
+
+# 错误处理方式
+_RETRY = "retry"            # 稍后重试同一模型
+_NEXT_MODEL = "next_model"  # 该模型无法处理这个请求，换下一个模型
+_FATAL = "fatal"            # 换模型也不会成功，直接失败
+
+
+def _classify(error: Exception) -> str:
+    if isinstance(error, (openai.AuthenticationError, openai.PermissionDeniedError)):
+        return _FATAL
+    if isinstance(
+        error,
+        (openai.BadRequestError, openai.NotFoundError, openai.UnprocessableEntityError),
+    ):
+        return _NEXT_MODEL
+    # 超时、连接错误、限流、5xx以及返回内容无法解析都可以重试
+    return _RETRY
+
+
+def _retry_after(error: Exception) -> Optional[float]:
+    """限流响应中的Retry-After（秒）"""
+    response = getattr(error, "response", None)
+    value = response.headers.get("retry-after") if response is not None else None
+    try:
+        return float(value) if value else None
+    except ValueError:
+        return None
+
+
+class LLMPolicy:
+    """大模型调用策略：总时限、带随机抖动的指数退避重试、对冲请求和备用模型
+
+    每次尝试都是一个独立的调用，退避等待期间不占用调度名额。
+    """
+
+    def __init__(self):
+        self.deadlines = _parse_stage_deadlines(LLM_STAGE_DEADLINES)
+        self.fallback_models = [m.strip() for m in LLM_FALLBACK_MODELS.split(",") if m.strip()]
+        self.hedge = LLM_HEDGE == "on"
+        # 阶段 -> 最近成功请求的耗时
+        self._latencies: Dict[str, Deque[float]] = {}
+        self.counters = {"retries": 0, "fallbacks": 0, "hedged": 0, "hedge_wins": 0, "failures": 0}
+
+    def models_for(self, model: str) -> List[str]:
+        """依次尝试的模型：主模型在前，然后是备用模型"""
+        return [model] + [m for m in self.fallback_models if m != model]
+
+    async def run(
+        self,
+        stage: Optional[str],
+        model: str,
+        call: Callable[[str], Awaitable[Any]],
+        hedge: bool = True,
+        can_retry: Optional[Callable[[], bool]] = None,
+    ) -> Any:
+        """按策略执行调用
+
+        Args:
+            stage: 生成阶段，决定总时限
+            model: 主模型
+            call: 使用指定模型执行一次调用
+            hedge: 是否允许对冲请求（有副作用的流式调用应关闭）
+            can_retry: 失败后是否还能重试，例如流式调用已经向玩家推送了部分内容时不能重试
+        """
+        stage = stage or "other"
+        deadline = self.deadlines.get(stage, LLM_DEFAULT_DEADLINE)
+        try:
+            return await asyncio.wait_for(
+                self._attempts(stage, model, call, hedge, can_retry), deadline
+            )
+        except asyncio.TimeoutError:
+            self.counters["failures"] += 1
+            raise LLMError(f"{stage} 生成超过 {deadline:g}s 仍未完成") from None
+
+    async def _attempts(self, stage, model, call, hedge, can_retry):
+        last_error: Optional[Exception] = None
+        for model_index, current_model in enumerate(self.models_for(model)):
+            if model_index:
+                self.counters["fallbacks"] += 1
+                logger.warning("%s 生成改用备用模型 %s", stage, current_model)
+            for attempt in range(LLM_MAX_ATTEMPTS):
+                started = time.monotonic()
+                try:
+                    if hedge and self.hedge:
+                        result = await self._hedged(stage, lambda: call(current_model))
+                    else:
+                        result = await call(current_model)
+                    self._record_latency(stage, time.monotonic() - started)
+                    return result
+                except asyncio.CancelledError:
+                    raise
+                except Exception as e:
+                    last_error = e
+                    kind = _classify(e)
+                    if kind == _FATAL or (can_retry and not can_retry()):
+                        self.counters["failures"] += 1
+                        raise LLMError(f"调用OpenAI API失败: {e}") from e
+                    logger.warning(
+                        "%s 生成第%s次调用 %s 失败: %r", stage, attempt + 1, current_model, e
+                    )
+                    if kind == _NEXT_MODEL or attempt + 1 >= LLM_MAX_ATTEMPTS:
+                        break
+                    self.counters["retries"] += 1
+                    await asyncio.sleep(self._backoff(attempt, e))
+
+        self.counters["failures"] += 1
+        raise LLMError(f"调用OpenAI API失败: {last_error}") from last_error
+
+    @staticmethod
+    def _backoff(attempt: int, error: Exception) -> float:
+        """带完全随机抖动的指数退避，服务端给出Retry-After时以它为准"""
+        retry_after = _retry_after(error)
+        if retry_after is not None:
+            return min(retry_after, LLM_BACKOFF_MAX)
+        return random.uniform(0, min(LLM_BACKOFF_MAX, LLM_BACKOFF_BASE * 2 ** attempt))
+
+    async def _hedged(self, stage: str, call: Callable[[], Awaitable[Any]]) -> Any:
+        """请求超过p95耗时仍未完成时再发出一个相同的请求，返回先成功的结果"""
+        delay = self.p95(stage)
+        if delay is None:
+            return await call()
+
+        tasks = [asyncio.create_task(call())]
+        try:
+            done, _ = await asyncio.wait(tasks, timeout=delay)
+            if done:
+                return tasks[0].result()
+
+            self.counters["hedged"] += 1
+            tasks.append(asyncio.create_task(call()))
+            pending = set(tasks)
+            error: Optional[BaseException] = None
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    if task.exception() is None:
+                        if task is tasks[1]:
+                            self.counters["hedge_wins"] += 1
+                        return task.result()
+                    error = error or task.exception()
+            raise error
+        finally:
+            for task in tasks:
+                task.cancel()
+
+    def _record_latency(self, stage: str, seconds: float):
+        self._latencies.setdefault(stage, deque(maxlen=LLM_LATENCY_WINDOW)).append(seconds)
+
+    def p95(self, stage: str) -> Optional[float]:
+        """阶段最近耗时的p95，样本不足时返回None"""
+        samples = self._latencies.get(stage)
+        if not samples or len(samples) < LLM_HEDGE_MIN_SAMPLES:
+            return None
+        ordered = sorted(samples)
+        return ordered[min(len(ordered) - 1, int(len(ordered) * 0.95))]
+
+    def stats(self) -> Dict:
+        """重试、备用模型和对冲请求的统计"""
+        return {
+            **self.counters,
+            "hedge": self.hedge,
+            "p95": {stage: self.p95(stage) for stage in self._latencies},
+        }
+
+
+# 全局大模型调用策略实例
+llm_policy = LLMPolicy()
@@ -0,0 +1,213 @@
+from collections import OrderedDict, deque
+from contextlib import asynccontextmanager
+from typing import Deque, Dict, Optional
+import asyncio
+import logging
+import os
+import time
+
+logger = logging.getLogger(__name__)
+
+# 同时进行的大模型请求上限
+LLM_MAX_CONCURRENCY = int(os.getenv("LLM_MAX_CONCURRENCY", "8"))
+# 每分钟的token预算（提示词和输出合计的估算值），0表示不限制
+LLM_TOKENS_PER_MINUTE = int(os.getenv("LLM_TOKENS_PER_MINUTE", "0"))
+# 未指定max_tokens时按该值估算输出的token数
+LLM_ESTIMATED_COMPLETION_TOKENS = int(os.getenv("LLM_ESTIMATED_COMPLETION_TOKENS", "1024"))
+# 排队时间超过该值（秒）时记录警告
+LLM_QUEUE_WARN_SECONDS = float(os.getenv("LLM_QUEUE_WARN_SECONDS", "2"))
+
+# 各生成阶段的优先级，数值越小越先执行：轮次事件在玩家等待的关键路径上，最终报告最后
+STAGE_PRIORITIES: Dict[str, int] = {
+    "event": 0,
+    "background": 1,
+    "roles": 1,
+    "report": 2,
+}
+DEFAULT_PRIORITY = 1
+
+
+def estimate_tokens(*texts: Optional[str], max_tokens: Optional[int] = None) -> int:
+    """粗略估算一次请求的token数：提示词按每个字符一个token，加上输出上限"""
+    prompt_tokens = sum(len(text) for text in texts if text)
+    return prompt_tokens + (max_tokens or LLM_ESTIMATED_COMPLETION_TOKENS)
+
+
+class _Waiter:
+    """一个排队中的请求"""
+
+    __slots__ = ("future", "room_id", "stage", "tokens", "enqueued_at")
+
+    def __init__(self, future: asyncio.Future, room_id: str, stage: str, tokens: int):
+        self.future = future
+        self.room_id = room_id
+        self.stage = stage
+        self.tokens = tokens
+        self.enqueued_at = time.monotonic()
+
+
+class LLMScheduler:
+    """大模型请求调度器
+
+    限制同时进行的请求数和每分钟的token用量（令牌桶），超出时排队。
+    排队的请求先按优先级执行；同一优先级内按房间轮流执行，
+    一个房间的多个请求不会让其他房间一直等待。
+    """
+
+    def __init__(
+        self,
+        max_concurrency: int = LLM_MAX_CONCURRENCY,
+        tokens_per_minute: int = LLM_TOKENS_PER_MINUTE,
+    ):
+        self.max_concurrency = max_concurrency
+        self.tokens_per_minute = tokens_per_minute
+        self._running = 0
+        # 优先级 -> 房间ID -> 该房间排队中的请求，房间顺序即轮转顺序
+        self._queues: Dict[int, "OrderedDict[str, Deque[_Waiter]]"] = {}
+        # 令牌桶
+        self._tokens = float(tokens_per_minute)
+        self._refilled_at = time.monotonic()
+        self._refill_handle: Optional[asyncio.TimerHandle] = None
+        # 阶段 -> 排队时间统计
+        self._wait_stats: Dict[str, Dict[str, float]] = {}
+
+    @asynccontextmanager
+    async def slot(self, room_id: Optional[str], stage: Optional[str], tokens: int):
+        """获取执行名额，退出时释放"""
+        await self.acquire(room_id, stage, tokens)
+        try:
+            yield
+        finally:
+            self.release()
+
+    async def acquire(self, room_id: Optional[str], stage: Optional[str], tokens: int):
+        """排队等待执行名额"""
+        stage = stage or "other"
+        waiter = _Waiter(
+            asyncio.get_running_loop().create_future(), room_id or "", stage, tokens
+        )
+        priority = STAGE_PRIORITIES.get(stage, DEFAULT_PRIORITY)
+        rooms = self._queues.setdefault(priority, OrderedDict())
+        rooms.setdefault(waiter.room_id, deque()).append(waiter)
+        self._dispatch()
+
+        try:
+            await waiter.future
+        except asyncio.CancelledError:
+            # 已经分配了名额但调用方被取消，归还名额；仍在排队的请求在分配时跳过
+            if waiter.future.done() and not waiter.future.cancelled():
+                self.release()
+            raise
+
+    def release(self):
+        """请求结束，释放执行名额"""
+        self._running -= 1
+        self._dispatch()
+
+    def _dispatch(self):
+        """在名额和token预算允许时按优先级和房间轮转分配名额"""
+        while self._running < self.max_concurrency:
+            waiter = self._next_waiter()
+            if waiter is None:
+                return
+            if not self._take_tokens(waiter.tokens):
+                # 预算不足时等待补充，不让后面的低优先级请求插队
+                return
+            self._pop_waiter()
+            self._running += 1
+            self._record_wait(waiter)
+            waiter.future.set_result(None)
+
+    def _next_waiter(self) -> Optional[_Waiter]:
+        """下一个应该执行的请求（不出队），顺便丢弃已取消的请求"""
+        for priority in sorted(self._queues):
+            rooms = self._queues[priority]
+            while rooms:
+                room_id, waiters = next(iter(rooms.items()))
+                while waiters and waiters[0].future.done():
+                    waiters.popleft()
+                if waiters:
+                    return waiters[0]
+                del rooms[room_id]
+        return None
+
+    def _pop_waiter(self):
+        """取出_next_waiter返回的请求，该房间还有请求时移到轮转末尾"""
+        for priority in sorted(self._queues):
+            rooms = self._queues[priority]
+            if not rooms:
+                continue
+            room_id, waiters = next(iter(rooms.items()))
+            waiters.popleft()
+            if waiters:
+                rooms.move_to_end(room_id)
+            else:
+                del rooms[room_id]
+            return
+
+    def _take_tokens(self, tokens: int) -> bool:
+        """从令牌桶中扣除token，不足时安排在补足后重新分配"""
+        if self.tokens_per_minute <= 0:
+            return True
+        now = time.monotonic()
+        rate = self.tokens_per_minute / 60
+        self._tokens = min(
+            float(self.tokens_per_minute), self._tokens + (now - self._refilled_at) * rate
+        )
+        self._refilled_at = now
+        # 超过整个预算的请求在桶满时放行，否则永远无法执行
+        needed = min(tokens, self.tokens_per_minute)
+        if self._tokens >= needed:
+            self._tokens -= needed
+            return True
+        if self._refill_handle is None:
+            delay = (needed - self._tokens) / rate
+            self._refill_handle = asyncio.get_running_loop().call_later(
+                delay, self._on_refill
+            )
+        return False
+
+    def _on_refill(self):
+        self._refill_handle = None
+        self._dispatch()
+
+    def _record_wait(self, waiter: _Waiter):
+        waited = time.monotonic() - waiter.enqueued_at
+        stats = self._wait_stats.setdefault(
+            waiter.stage, {"count": 0, "total_wait": 0.0, "max_wait": 0.0}
+        )
+        stats["count"] += 1
+        stats["total_wait"] += waited
+        stats["max_wait"] = max(stats["max_wait"], waited)
+        if waited >= LLM_QUEUE_WARN_SECONDS:
+            logger.warning(
+                "房间 %s 的 %s 请求排队 %.2fs，当前并发 %s/%s",
+                waiter.room_id, waiter.stage, waited, self._running, self.max_concurrency
+            )
+
+    def stats(self) -> Dict:
+        """当前并发、排队数量和各阶段的排队时间"""
+        return {
+            "running": self._running,
+            "max_concurrency": self.max_concurrency,
+            "queued": sum(
+                len(waiters)
+                for rooms in self._queues.values()
+                for waiters in rooms.values()
+            ),
+            "tokens_available": (
+                round(self._tokens) if self.tokens_per_minute > 0 else None
+            ),
+            "wait_by_stage": {
+                stage: {
+                    "count": int(stats["count"]),
+                    "avg_wait": stats["total_wait"] / stats["count"],
+                    "max_wait": stats["max_wait"],
+                }
+                for stage, stats in self._wait_stats.items()
+            },
+        }
+
+
+# 全局大模型请求调度器实例
+llm_scheduler = LLMScheduler()
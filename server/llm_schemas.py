@@ -0,0 +1,56 @@
+from typing import Any, Dict, List
+from pydantic import BaseModel, RootModel, field_validator
+
+
+class RoundEvent(BaseModel):
+    """轮次事件：标题、描述和决策选项"""
+
+    event_title: str
+    event_description: str
+    decision_options: Dict[str, str]
+
+    @field_validator("decision_options")
+    @classmethod
+    def _require_options(cls, options: Dict[str, str]) -> Dict[str, str]:
+        if not options:
+            raise ValueError("决策选项不能为空")
+        return options
+
+
+class PrivateMessages(RootModel[Dict[str, str]]):
+    """各角色的私人信息，键统一为大写的角色名（CEO、CTO、CMO、COO）"""
+
+    @field_validator("root", mode="before")
+    @classmethod
+    def _normalize_roles(cls, value: Any) -> Any:
+        if not isinstance(value, dict):
+            return value
+        return {str(role).upper(): "" if text is None else str(text) for role, text in value.items()}
+
+
+class RoundEventOutput(BaseModel):
+    """轮次事件生成（prompt2）的输出"""
+
+    situation: str = ""
+    event: RoundEvent
+    # 输出被截断时私人信息可能不完整，缺失的角色不会收到私人信息，不必整轮重新生成
+    private_messages: PrivateMessages = PrivateMessages({})
+
+
+class RoleDefinition(BaseModel):
+    """单个角色的定义"""
+
+    name: str
+    description: str
+    actions: List[str] = []
+
+
+class RoleDefinitions(RootModel[Dict[str, RoleDefinition]]):
+    """角色生成（role_generation）的输出，键为小写的角色名"""
+
+    @field_validator("root")
+    @classmethod
+    def _require_roles(cls, roles: Dict[str, RoleDefinition]) -> Dict[str, RoleDefinition]:
+        if not roles:
+            raise ValueError("没有生成任何角色")
+        return {key.lower(): role for key, role in roles.items()}
@@ -0,0 +1,95 @@
+from collections import OrderedDict
+from typing import Any, Dict, Optional, Tuple
+import logging
+import os
+
+logger = logging.getLogger(__name__)
+
+# 每百万token的价格，格式为 "model=输入价格:输出价格,model=输入价格:输出价格"，未配置的模型不计算费用
+LLM_TOKEN_PRICES = os.getenv("LLM_TOKEN_PRICES", "")
+# 保留用量明细的房间数，超出时丢弃最久没有调用的房间
+LLM_USAGE_MAX_ROOMS = int(os.getenv("LLM_USAGE_MAX_ROOMS", "1000"))
+
+
+def _parse_prices(spec: str) -> Dict[str, Tuple[float, float]]:
+    prices = {}
+    for item in spec.split(","):
+        model, _, price = item.strip().rpartition("=")
+        prompt_price, _, completion_price = price.partition(":")
+        if model and prompt_price and completion_price:
+            prices[model.strip()] = (float(prompt_price), float(completion_price))
+    return prices
+
+
+def _empty() -> Dict[str, Any]:
+    return {"calls": 0, "prompt_tokens": 0, "completion_tokens": 0, "total_tokens": 0, "cost": 0.0}
+
+
+def _add(totals: Dict[str, Any], prompt_tokens: int, completion_tokens: int, cost: float):
+    totals["calls"] += 1
+    totals["prompt_tokens"] += prompt_tokens
+    totals["completion_tokens"] += completion_tokens
+    totals["total_tokens"] += prompt_tokens + completion_tokens
+    totals["cost"] += cost
+
+
+class LLMUsageTracker:
+    """大模型token用量和费用统计，按房间、生成阶段和模型汇总"""
+
+    def __init__(self):
+        self.prices = _parse_prices(LLM_TOKEN_PRICES)
+        self.total = _empty()
+        self.by_stage: Dict[str, Dict[str, Any]] = {}
+        self.by_model: Dict[str, Dict[str, Any]] = {}
+        # 房间ID -> 阶段 -> 用量
+        self.by_room: "OrderedDict[str, Dict[str, Dict[str, Any]]]" = OrderedDict()
+
+    def record(self, room_id: Optional[str], stage: Optional[str], model: str, usage: Any):
+        """记录一次调用返回的usage，没有usage（例如服务端不支持）时忽略"""
+        if usage is None:
+            return
+        prompt_tokens = getattr(usage, "prompt_tokens", 0) or 0
+        completion_tokens = getattr(usage, "completion_tokens", 0) or 0
+        prompt_price, completion_price = self.prices.get(model, (0.0, 0.0))
+        cost = (prompt_tokens * prompt_price + completion_tokens * completion_price) / 1_000_000
+
+        stage = stage or "other"
+        _add(self.total, prompt_tokens, completion_tokens, cost)
+        _add(self.by_stage.setdefault(stage, _empty()), prompt_tokens, completion_tokens, cost)
+        _add(self.by_model.setdefault(model, _empty()), prompt_tokens, completion_tokens, cost)
+        if room_id:
+            room = self.by_room.setdefault(room_id, {})
+            self.by_room.move_to_end(room_id)
+            _add(room.setdefault(stage, _empty()), prompt_tokens, completion_tokens, cost)
+            while len(self.by_room) > LLM_USAGE_MAX_ROOMS:
+                self.by_room.popitem(last=False)
+        logger.debug(
+            "房间 %s 的 %s 调用 %s 使用了 %d + %d 个token",
+            room_id, stage, model, prompt_tokens, completion_tokens,
+        )
+
+    def room_usage(self, room_id: str) -> Dict[str, Any]:
+        """房间的用量：合计和各阶段明细"""
+        stages = self.by_room.get(room_id, {})
+        total = _empty()
+        for usage in stages.values():
+            for key in total:
+                total[key] += usage[key]
+        return {"total": total, "by_stage": {stage: dict(usage) for stage, usage in stages.items()}}
+
+    def reset_room(self, room_id: str):
+        """清空房间的用量（重新开始游戏时），全局和各阶段、各模型的累计不受影响"""
+        self.by_room.pop(room_id, None)
+
+    def stats(self) -> Dict[str, Any]:
+        """全部用量统计"""
+        return {
+            "total": dict(self.total),
+            "by_stage": {stage: dict(usage) for stage, usage in self.by_stage.items()},
+            "by_model": {model: dict(usage) for model, usage in self.by_model.items()},
+            "by_room": {room_id: self.room_usage(room_id)["total"] for room_id in self.by_room},
+        }
+
+
+# 全局大模型用量统计实例
+llm_usage = LLMUsageTracker()
@@ -0,0 +1,131 @@
+from datetime import datetime
+from typing import Dict, Optional
+from fastapi import WebSocket, WebSocketDisconnect
+import asyncio
+import itertools
+import logging
+import os
+
+from connection_manager import PlayerOutbox, WS_SEND_TIMEOUT, encode_message
+from room_manager import room_manager
+
+logger = logging.getLogger(__name__)
+
+# 大厅变化的合并推送间隔（秒），间隔内同一房间的多次变化只推送最终状态
+LOBBY_FLUSH_INTERVAL = float(os.getenv("LOBBY_FLUSH_INTERVAL", "0.5"))
+
+
+class LobbyHub:
+    """大厅订阅中心
+
+    订阅者连接后先收到一次完整快照，之后只收到按间隔合并的增量变化。
+    每批增量只编码一次，所有订阅者共用同一份文本；没有订阅者时房间变化不产生任何开销。
+    """
+
+    def __init__(self):
+        # 订阅ID -> 待发送队列
+        self.subscribers: Dict[str, PlayerOutbox] = {}
+        # 房间ID -> 最新展示数据，None表示房间已从大厅移除
+        self._pending: Dict[str, Optional[Dict]] = {}
+        self._flush_handle: Optional[asyncio.TimerHandle] = None
+        self._grace_handle: Optional[asyncio.TimerHandle] = None
+        self._ids = itertools.count(1)
+        room_manager.add_lobby_listener(self.on_room_changed)
+
+    async def handle_connection(self, websocket: WebSocket):
+        """处理一个大厅订阅连接，直到客户端断开"""
+        await websocket.accept()
+        subscriber_id = f"lobby-{next(self._ids)}"
+        # 增量无法合并，慢订阅者直接断开，重连后会重新收到快照
+        outbox = PlayerOutbox(
+            subscriber_id, websocket, self._handle_send_failure, policy="disconnect"
+        )
+        self.subscribers[subscriber_id] = outbox
+        outbox.put("lobby_snapshot", encode_message({
+            "type": "lobby_snapshot",
+            "data": {
+                "version": room_manager.lobby_version,
+                "rooms": room_manager.get_lobby_rooms(),
+            },
+        }))
+        self._schedule_grace_check()
+        logger.debug("大厅订阅者 %s 已连接，当前订阅数 %d", subscriber_id, len(self.subscribers))
+
+        try:
+            while True:
+                # 客户端不需要发送内容，这里只用来感知断开
+                await websocket.receive_text()
+        except WebSocketDisconnect:
+            pass
+        finally:
+            self._remove(subscriber_id, outbox)
+
+    def on_room_changed(self, room_id: str, entry: Optional[Dict]):
+        """房间的大厅展示数据变化时由RoomManager调用"""
+        if not self.subscribers:
+            return
+        self._pending[room_id] = entry
+        if self._flush_handle is None:
+            loop = asyncio.get_running_loop()
+            self._flush_handle = loop.call_later(LOBBY_FLUSH_INTERVAL, self._flush)
+
+    def _flush(self):
+        """把合并后的增量编码一次并放入所有订阅者的发送队列"""
+        self._flush_handle = None
+        if not self._pending:
+            return
+        pending, self._pending = self._pending, {}
+        if not self.subscribers:
+            return
+
+        text = encode_message({
+            "type": "lobby_delta",
+            "data": {
+                "version": room_manager.lobby_version,
+                "upserts": [entry for entry in pending.values() if entry],
+                "removed": [room_id for room_id, entry in pending.items() if not entry],
+            },
+        })
+        for outbox in list(self.subscribers.values()):
+            if not outbox.put("lobby_delta", text):
+                self._handle_send_failure(outbox)
+        self._schedule_grace_check()
+
+    def _schedule_grace_check(self):
+        """在最早的新房间宽限期结束时重新计算展示数据，让订阅者及时看到房间消失"""
+        if self._grace_handle is not None:
+            return
+        expiry = room_manager.next_lobby_grace_expiry()
+        if expiry is None:
+            return
+        delay = max((expiry - datetime.now()).total_seconds(), 0)
+        self._grace_handle = asyncio.get_running_loop().call_later(delay, self._check_grace)
+
+    def _check_grace(self):
+        self._grace_handle = None
+        room_manager.expire_lobby_grace()
+        if self.subscribers:
+            self._schedule_grace_check()
+
+    def _handle_send_failure(self, outbox: PlayerOutbox):
+        logger.warning(f"大厅订阅者 {outbox.player_id} 发送失败或消费过慢，断开连接")
+        self._remove(outbox.player_id, outbox)
+        asyncio.create_task(_close_websocket(outbox.websocket))
+
+    def _remove(self, subscriber_id: str, outbox: PlayerOutbox):
+        if self.subscribers.get(subscriber_id) is outbox:
+            del self.subscribers[subscriber_id]
+        outbox.close()
+
+
+async def _close_websocket(websocket: WebSocket):
+    try:
+        await asyncio.wait_for(
+            websocket.close(code=4008, reason="发送超时"), WS_SEND_TIMEOUT
+        )
+    except Exception:
+        pass
+
+
+# 全局大厅订阅中心实例
+lobby_hub = LobbyHub()
@@ -1,9 +1,50 @@
+from collections import defaultdict
+from typing import Dict
+import atexit
 import logging
+import logging.handlers
+import os
+import queue
+
+# 日志级别，生产环境保持INFO，排查问题时可设为DEBUG
+LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO").upper()
+# 采样日志每N次记录一次
+LOG_SAMPLE_EVERY = int(os.getenv("LOG_SAMPLE_EVERY", "100"))
+LOG_FORMAT = '%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+
+
+def _setup_logging():
+    """配置根日志记录器：日志先进入队列，由后台线程统一格式化输出，避免在事件循环中做I/O"""
+    root = logging.getLogger()
+    if any(isinstance(h, logging.handlers.QueueHandler) for h in root.handlers):
+        return
+
+    log_queue: queue.SimpleQueue = queue.SimpleQueue()
+    stream_handler = logging.StreamHandler()
+    stream_handler.setFormatter(logging.Formatter(LOG_FORMAT))
+    listener = logging.handlers.QueueListener(
+        log_queue, stream_handler, respect_handler_level=True
+    )
+
+    root.addHandler(logging.handlers.QueueHandler(log_queue))
+    root.setLevel(LOG_LEVEL)
+    listener.start()
+    atexit.register(listener.stop)
+
 
 # 配置日志记录器
-logging.basicConfig(
-    level=logging.INFO,
-    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s'
-)
+_setup_logging()
+
+logger = logging.getLogger(__name__)
+
+_sample_counters: Dict[str, int] = defaultdict(int)
+
 
-logger = logging.getLogger(__name__)
\ No newline at end of file
+def debug_sampled(log: logging.Logger, key: str, msg: str, *args):
+    """按key采样的DEBUG日志，每LOG_SAMPLE_EVERY次只记录一次，未开启DEBUG时几乎没有开销"""
+    if not log.isEnabledFor(logging.DEBUG):
+        return
+    count = _sample_counters[key]
+    _sample_counters[key] = count + 1
+    if count % LOG_SAMPLE_EVERY == 0:
+        log.debug(msg + " (采样: 第%d次)", *args, count + 1)
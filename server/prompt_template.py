@@ -0,0 +1,102 @@
+from typing import Dict, Iterable, List, Tuple
+import os
+import re
+
+PROMPT_DIR = os.path.join(os.path.dirname(__file__), "prompt")
+# 模板中单独一行的分隔符：之前是不含占位符的固定指令（作为系统提示），之后是带占位符的输入（作为用户消息）
+INPUT_SEPARATOR = "<<<输入>>>"
+
+
+class PromptTemplate:
+    """预编译的提示词模板
+
+    加载时把模板解析为字面量片段和占位符片段，渲染时只需一次拼接。
+    只有声明过的字段会被当作占位符，模板中其他的花括号（例如JSON示例）保持原样。
+    分隔符之前的固定指令作为系统提示，所有房间完全相同，服务端可以缓存这段前缀。
+    """
+
+    def __init__(self, name: str, text: str, fields: Iterable[str]):
+        self.name = name
+        self.fields = tuple(fields)
+
+        system, separator, text = text.partition(INPUT_SEPARATOR)
+        if not separator:
+            system, text = "", system
+        self.system = system.strip()
+        text = text.strip()
+
+        pattern = re.compile(
+            r"\{(" + "|".join(re.escape(field) for field in self.fields) + r")\}"
+        )
+        # re.split 的结果中奇数下标为占位符名称，偶数下标为字面量
+        pieces = pattern.split(text) if self.fields else [text]
+        self._parts: List[str] = pieces
+        self._slots: List[Tuple[int, str]] = [
+            (i, pieces[i]) for i in range(1, len(pieces), 2)
+        ]
+
+        # 启动时校验每个声明的占位符都出现在模板中
+        used = {field for _, field in self._slots}
+        missing = [field for field in self.fields if field not in used]
+        if missing:
+            raise ValueError(f"提示词模板 {name} 缺少占位符: {missing}")
+        # 系统提示中出现占位符会使前缀随房间变化
+        leaked = [field for field in self.fields if "{" + field + "}" in self.system]
+        if leaked:
+            raise ValueError(f"提示词模板 {name} 的固定指令中包含占位符: {leaked}")
+
+    def render(self, **values: str) -> str:
+        """用给定的值填充所有占位符，返回分隔符之后的用户消息"""
+        missing = [field for field in self.fields if field not in values]
+        if missing:
+            raise ValueError(f"渲染提示词模板 {self.name} 缺少字段: {missing}")
+
+        parts = self._parts.copy()
+        for i, field in self._slots:
+            parts[i] = values[field]
+        return "".join(parts)
+
+
+def load_prompt(filename: str, *fields: str) -> PromptTemplate:
+    """从prompt目录加载并预编译模板"""
+    with open(os.path.join(PROMPT_DIR, filename), "r", encoding="utf-8") as f:
+        return PromptTemplate(filename, f.read(), fields)
+
+
+# 渲染性能基准：python prompt_template.py
+if __name__ == "__main__":
+    import timeit
+
+    template = load_prompt(
+        "prompt4.txt",
+        "initial_idea", "output1", "output2", "output3", "output4", "output5",
+        "ceo_name", "cto_name", "cmo_name", "coo_name",
+    )
+    with open(os.path.join(PROMPT_DIR, "prompt4.txt"), "r", encoding="utf-8") as f:
+        raw = f.read().partition(INPUT_SEPARATOR)[2].strip()
+
+    values: Dict[str, str] = {
+        "initial_idea": "- 面向大学生的二手教材交易平台",
+        "ceo_name": "玩家A",
+        "cto_name": "玩家B",
+        "cmo_name": "玩家C",
+        "coo_name": "玩家D",
+    }
+    for i in range(1, 6):
+        values[f"output{i}"] = f"第{i}轮情况：公司面临资金压力。\n事件：竞争对手降价。" * 5
+
+    def chained_replace() -> str:
+        prompt = raw
+        for field, value in values.items():
+            prompt = prompt.replace("{" + field + "}", value)
+        return prompt
+
+    assert chained_replace() == template.render(**values)
+
+    rooms = 1000
+    for label, fn in (
+        ("链式str.replace", chained_replace),
+        ("预编译模板render", lambda: template.render(**values)),
+    ):
+        seconds = min(timeit.repeat(fn, number=rooms, repeat=5))
+        print(f"{label}: 每次渲染 {seconds / rooms * 1e6:.2f} 微秒（{rooms} 个房间）")
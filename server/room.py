@@ -1,48 +1,64 @@
+from collections import deque
 from enum import Enum
-from typing import Dict, List, Optional
+from typing import Any, Callable, Deque, Dict, List, Optional, Set, Tuple
 from datetime import datetime
-from pydantic import BaseModel
-import random
+from pydantic import BaseModel, PrivateAttr
 import os
+import random
 from llm import LLM
-
-# 读取prompt模板
-with open(
-    os.path.join(os.path.dirname(__file__), "prompt", "role_generation.txt"),
-    "r",
-    encoding="utf-8",
-) as f:
-    role_generator = f.read()
-
-# 读取prompt模板
-with open(
-    os.path.join(os.path.dirname(__file__), "prompt", "prompt1.txt"),
-    "r",
-    encoding="utf-8",
-) as f:
-    prompt_template = f.read()
-
-# 读取prompt模板
-with open(
-    os.path.join(os.path.dirname(__file__), "prompt", "prompt2.txt"),
-    "r",
-    encoding="utf-8",
-) as f:
-    prompt2_template = f.read()
-
-with open(
-    os.path.join(os.path.dirname(__file__), "prompt", "prompt3.txt"),
-    "r",
-    encoding="utf-8",
-) as f:
-    prompt3_template = f.read()
-
-with open(
-    os.path.join(os.path.dirname(__file__), "prompt", "prompt4.txt"),
-    "r",
-    encoding="utf-8",
-) as f:
-    prompt4_template = f.read()
+from single_flight import single_flight
+from llm_schemas import RoleDefinitions, RoundEventOutput
+from llm_usage import llm_usage
+from prompt_template import load_prompt
+from logger_config import logger
+
+# 加载并预编译prompt模板（占位符在启动时校验）
+# 模板的固定指令作为系统提示，所有房间完全相同，便于服务端缓存提示词前缀；随房间变化的内容放在用户消息中
+role_generator = load_prompt("role_generation.txt", "background")
+prompt_template = load_prompt("prompt1.txt", "initial_idea")
+prompt2_template = load_prompt("prompt2.txt", "initial_idea", "previous_output")
+prompt3_template = load_prompt(
+    "prompt3.txt", "ceo_choice", "cto_choice", "coo_choice", "cmo_choice"
+)
+prompt4_template = load_prompt(
+    "prompt4.txt",
+    "initial_idea", "output1", "output2", "output3", "output4", "output5",
+    "ceo_name", "cto_name", "cmo_name", "coo_name",
+)
+
+# 每个房间保留的最近变更记录条数，断线时间过长超出该范围的客户端会收到完整状态
+ROOM_CHANGE_LOG_SIZE = int(os.getenv("ROOM_CHANGE_LOG_SIZE", "256"))
+# 故事梗概的总长度上限（字符），超出时越早的轮次越先压缩为只保留事件标题
+STORY_MAX_CHARS = int(os.getenv("STORY_MAX_CHARS", "600"))
+# 单轮摘要中事件标题、局势和玩家决策各自的长度上限（字符）
+STORY_TITLE_MAX_CHARS = 40
+STORY_SITUATION_MAX_CHARS = 120
+STORY_DECISIONS_MAX_CHARS = 120
+# 最终报告中完整经过的总长度上限（字符），从最近的轮次开始保留，放不下的较早轮次改用精简摘要
+REPORT_HISTORY_MAX_CHARS = int(os.getenv("REPORT_HISTORY_MAX_CHARS", "6000"))
+
+# 需要同步给客户端的房间字段
+SYNCED_FIELDS = (
+    "game_state",
+    "current_round",
+    "startup_idea",
+    "background",
+    "dynamic_roles",
+    "game_result",
+    "round_actions",
+    "round_events",
+    "round_private_messages",
+    "dynamic_round_info",
+)
+# 增量同步时也总是包含的字段：客户端据此恢复当前界面，只有在线状态变化时也需要
+ALWAYS_SYNCED_FIELDS = {"game_state", "current_round"}
+# 按轮次保存的字段，变更以轮次为粒度记录
+ROUND_FIELDS = {"round_actions", "round_events", "round_private_messages", "dynamic_round_info"}
+
+
+def _clip(text: str, limit: int) -> str:
+    """截断过长的文本"""
+    return text if len(text) <= limit else text[: max(limit - 1, 0)] + "…"
 
 
 # 枚举定义
@@ -63,6 +79,8 @@ class MessageType(str, Enum):
     GAME_COMPLETE = "game_complete"
     GAME_RESTART = "game_restart"
     CONNECTION_SUCCESS = "connection_success"
+    ROUND_EVENT_DELTA = "round_event_delta"
+    REDIRECT = "redirect"
 
 
 class GameState(str, Enum):
@@ -107,13 +125,163 @@ class GameRoom(BaseModel):
     round_private_messages: Dict[int, Dict] = {}  # 保存每轮的私人信息
     dynamic_round_info: Dict[int, str] = {}  # 保存动态生成的轮次信息
     round_situation: Dict[int, str] = {}  # 保存每轮的情况
+    stage_timings: Dict[str, float] = {}  # 开局各生成阶段的耗时（秒）
+    round_summaries: Dict[int, Dict[str, str]] = {}  # 每轮的精简摘要（事件标题、局势、玩家决策）
+
+    # 以下索引和计数器不参与序列化，由下面的方法增量维护，使就绪检查为O(1)
+    _player_index: Dict[str, Player] = PrivateAttr(default_factory=dict)
+    _role_owners: Dict[str, str] = PrivateAttr(default_factory=dict)
+    _online_count: int = PrivateAttr(default=0)
+    _online_idea_count: int = PrivateAttr(default=0)
+    _online_role_count: int = PrivateAttr(default=0)
+    _submitted_players: Dict[int, Set[str]] = PrivateAttr(default_factory=dict)
+    # 大厅可见信息（玩家、在线状态、游戏状态）变化时的回调，由RoomManager设置
+    _on_change: Optional[Callable[["GameRoom"], None]] = PrivateAttr(default=None)
+    # 状态版本号，每次同步字段变化时递增；变更记录为 (版本号, 字段, 轮次)，轮次为None表示整个字段
+    _version: int = PrivateAttr(default=0)
+    _change_log: Deque[Tuple[int, str, Optional[int]]] = PrivateAttr(
+        default_factory=lambda: deque(maxlen=ROOM_CHANGE_LOG_SIZE)
+    )
+    # 任意状态变化（包括玩家信息）时的回调，由RoomManager在共享状态模式下设置
+    _on_touch: Optional[Callable[["GameRoom"], None]] = PrivateAttr(default=None)
+
+    def model_post_init(self, __context: Any):
+        self._rebuild_index()
+
+    def __setattr__(self, name: str, value: Any):
+        super().__setattr__(name, value)
+        if name in SYNCED_FIELDS:
+            self.touch(name)
+        if name == "game_state":
+            self._notify_change()
+
+    def _notify_change(self):
+        if self._on_change is not None:
+            self._on_change(self)
+
+    @property
+    def version(self) -> int:
+        """当前状态版本号"""
+        return self._version
+
+    def touch(self, field: str, round_num: Optional[int] = None):
+        """记录一次同步字段的变更，版本号加一"""
+        self._version += 1
+        self._change_log.append((self._version, field, round_num))
+        if self._on_touch is not None:
+            self._on_touch(self)
+
+    def snapshot(self) -> str:
+        """序列化房间状态"""
+        return self.model_dump_json()
+
+    @classmethod
+    def from_snapshot(cls, data: str, version: int) -> "GameRoom":
+        """从序列化的房间状态恢复房间"""
+        room = cls.model_validate_json(data)
+        room._version = version
+        return room
+
+    def apply_snapshot(self, data: str, version: int):
+        """用其他worker保存的快照原地替换房间状态
+
+        仍持有这个房间对象的处理流程（例如正在等待大模型生成）之后会看到最新的状态，
+        不会把修改写到已经被替换掉的对象上。变更记录无法衔接，已连接的客户端重连时会收到完整状态。
+        """
+        other = type(self).model_validate_json(data)
+        # 直接写入字段，不触发变更记录和保存
+        for name in type(self).model_fields:
+            self.__dict__[name] = other.__dict__[name]
+        self._version = version
+        self._change_log.clear()
+        self._rebuild_index()
+        self._notify_change()
+
+    def changes_since(self, version: int) -> Optional[Dict[str, Optional[Set[int]]]]:
+        """获取指定版本之后变化的字段及轮次（None表示整个字段）
+
+        版本号无效或变更记录已经不完整时返回None，此时需要发送完整状态。
+        """
+        if version > self._version or version < self._version - len(self._change_log):
+            return None
+        changed: Dict[str, Optional[Set[int]]] = {}
+        for seq, field, round_num in reversed(self._change_log):
+            if seq <= version:
+                break
+            if round_num is None:
+                changed[field] = None
+            elif field not in changed:
+                changed[field] = {round_num}
+            elif changed[field] is not None:
+                changed[field].add(round_num)
+        return changed
+
+    def private_messages_for(self, player_name: str, messages: Dict) -> Dict:
+        """只保留发给该玩家所选角色的私人信息"""
+        player = self.get_player(player_name)
+        if not player or not player.role:
+            return {}
+        role = player.role.upper()
+        return {key: value for key, value in messages.items() if str(key).upper() == role}
+
+    def sync_state(self, player_name: str, last_version: Optional[int] = None) -> Dict:
+        """构建发送给指定玩家的房间状态
+
+        提供客户端最后看到的版本号时只包含之后变化的字段（按轮次保存的字段只包含变化的轮次），
+        否则包含完整状态。游戏状态和当前轮次总是包含。私人信息只包含该玩家自己的部分。
+        """
+        changes = self.changes_since(last_version) if last_version is not None else None
+        data: Dict[str, Any] = {"version": self._version, "is_delta": changes is not None}
+        for field in SYNCED_FIELDS:
+            if changes is not None and field not in changes and field not in ALWAYS_SYNCED_FIELDS:
+                continue
+            value = getattr(self, field)
+            if field in ROUND_FIELDS:
+                rounds = changes.get(field) if changes is not None else None
+                if rounds is not None:
+                    value = {r: value[r] for r in rounds if r in value}
+                if field == "round_private_messages":
+                    value = {
+                        r: self.private_messages_for(player_name, messages)
+                        for r, messages in value.items()
+                    }
+            elif field == "game_state":
+                value = value.value
+            data[field] = value
+        return data
+
+    def _rebuild_index(self):
+        """根据当前玩家和行动数据重建索引和计数器"""
+        self._player_index = {}
+        self._role_owners = {}
+        self._online_count = 0
+        self._online_idea_count = 0
+        self._online_role_count = 0
+        for player in self.players:
+            self._player_index.setdefault(player.name, player)
+            if player.role:
+                self._role_owners.setdefault(player.role, player.name)
+            if player.is_online:
+                self._count_online(player, 1)
+        self._submitted_players = {
+            round_num: {a.get("playerName") for a in actions}
+            for round_num, actions in self.round_actions.items()
+        }
+
+    def _count_online(self, player: Player, delta: int):
+        """玩家上线(+1)或下线(-1)时更新在线计数"""
+        self._online_count += delta
+        if player.startup_idea:
+            self._online_idea_count += delta
+        if player.role:
+            self._online_role_count += delta
 
     def add_player(self, player: Player) -> bool:
         """添加玩家到房间"""
         # 检查玩家是否已存在
         existing_player = self.get_player(player.name)
         if existing_player:
-            existing_player.is_online = True
+            self.set_player_online(player.name, True)
             return True
 
         # 如果是第一个玩家，设为房主
@@ -121,50 +289,88 @@ class GameRoom(BaseModel):
             player.is_host = True
 
         self.players.append(player)
+        self._player_index[player.name] = player
+        if player.role:
+            self._role_owners.setdefault(player.role, player.name)
+        if player.is_online:
+            self._count_online(player, 1)
+        self.touch("players")
+        self._notify_change()
         return True
 
     def remove_player(self, player_name: str) -> bool:
         """移除玩家（设为离线状态）"""
-        player = self.get_player(player_name)
-        if player:
-            player.is_online = False
+        self.set_player_online(player_name, False)
         return True
 
+    def set_player_online(self, player_name: str, is_online: bool):
+        """设置玩家在线状态"""
+        player = self.get_player(player_name)
+        if player and player.is_online != is_online:
+            player.is_online = is_online
+            self._count_online(player, 1 if is_online else -1)
+            self.touch("players")
+            self._notify_change()
+
+    def set_player_idea(self, player_name: str, idea: Optional[str]):
+        """设置玩家的创业想法"""
+        player = self.get_player(player_name)
+        if not player:
+            return
+        if player.is_online:
+            self._online_idea_count += bool(idea) - bool(player.startup_idea)
+        player.startup_idea = idea
+        self.touch("players")
+
+    def set_player_role(self, player_name: str, role: Optional[Role]):
+        """设置玩家角色"""
+        player = self.get_player(player_name)
+        if not player:
+            return
+        if player.role and self._role_owners.get(player.role) == player_name:
+            del self._role_owners[player.role]
+        if role:
+            self._role_owners.setdefault(role, player_name)
+        if player.is_online:
+            self._online_role_count += bool(role) - bool(player.role)
+        player.role = role
+        self.touch("players")
+
     def get_player(self, player_name: str) -> Optional[Player]:
         """根据名称获取玩家"""
-        for player in self.players:
-            if player.name == player_name:
-                return player
-        return None
+        return self._player_index.get(player_name)
+
+    def get_role_owner(self, role: str) -> Optional[str]:
+        """获取选择了该角色的玩家名称"""
+        return self._role_owners.get(role)
 
     def get_online_players(self) -> List[Player]:
         """获取在线玩家列表"""
         return [p for p in self.players if p.is_online]
 
+    def online_player_count(self) -> int:
+        """在线玩家数量"""
+        return self._online_count
+
     def all_players_have_ideas(self) -> bool:
         """检查是否所有玩家都提交了创业想法"""
-        online_players = self.get_online_players()
-        return all(p.startup_idea for p in online_players)
+        return self._online_idea_count == self._online_count
 
     def all_players_have_roles(self) -> bool:
         """检查是否所有玩家都选择了角色"""
-        online_players = self.get_online_players()
-        return all(p.role for p in online_players)
+        return self._online_role_count == self._online_count
 
     def get_selected_roles(self) -> List[str]:
         """获取已选择的角色列表"""
         return [p.role for p in self.players if p.role]
 
+    def submitted_action_count(self, round_num: int) -> int:
+        """已提交指定轮次行动的玩家数量"""
+        return len(self._submitted_players.get(round_num, ()))
+
     def all_players_submitted_actions(self, round_num: int) -> bool:
         """检查是否所有玩家都提交了当前轮次的行动"""
-        online_players = self.get_online_players()
-        submitted_players = set()
-
-        if round_num in self.round_actions:
-            for action in self.round_actions[round_num]:
-                submitted_players.add(action.get("playerName"))  # 修正字段名
-
-        return len(submitted_players) == len(online_players)
+        return self.submitted_action_count(round_num) == self._online_count
 
     def add_round_action(self, round_num: int, action: Dict):
         """添加轮次行动"""
@@ -179,6 +385,132 @@ class GameRoom(BaseModel):
         ]
 
         self.round_actions[round_num].append(action)
+        self._submitted_players.setdefault(round_num, set()).add(
+            action.get("playerName")
+        )
+        self.touch("round_actions", round_num)
+
+    def set_round_situation(self, round_num: int, situation: Any):
+        """保存轮次情况"""
+        self.round_situation[round_num] = situation
+        self.touch("round_situation", round_num)
+
+    def summarize_round(self, round_num: int):
+        """根据轮次事件、局势和玩家决策更新该轮的精简摘要
+
+        事件生成后调用一次，轮次结束后再调用一次补上玩家决策。
+        """
+        event = self.round_events.get(round_num) or {}
+        situation = self.round_situation.get(round_num)
+        if isinstance(situation, dict):
+            situation = situation.get("impact", "")
+        decisions = "；".join(
+            f"{action['role'].upper() if action.get('role') else action.get('playerName', '')}"
+            f"：{_clip(str(action.get('action') or ''), 30)}"
+            for action in self.round_actions.get(round_num, [])
+        )
+        self.round_summaries[round_num] = {
+            "title": _clip(
+                str(event.get("event_title") or event.get("description") or ""),
+                STORY_TITLE_MAX_CHARS,
+            ),
+            "situation": _clip(str(situation or ""), STORY_SITUATION_MAX_CHARS),
+            "decisions": _clip(decisions, STORY_DECISIONS_MAX_CHARS),
+        }
+        self.touch("round_summaries", round_num)
+
+    def round_summary_text(self, round_num: int, include_decisions: bool = True) -> str:
+        """单轮摘要的文本，长度有上限"""
+        summary = self.round_summaries.get(round_num)
+        if not summary:
+            return ""
+        parts = [f"第{round_num}轮：{summary['title']}"]
+        if summary["situation"]:
+            parts.append(f"局势：{summary['situation']}")
+        if include_decisions and summary["decisions"]:
+            parts.append(f"决策：{summary['decisions']}")
+        return "；".join(parts)
+
+    def round_history_text(self, round_num: int) -> str:
+        """单轮的完整经过（局势、事件、决策选项和全部玩家决策），用于最终报告"""
+        parts = []
+        situation = self.round_situation.get(round_num)
+        if isinstance(situation, dict):
+            situation = situation.get("impact", "")
+        if situation:
+            parts.append(f"第{round_num}轮情况：{situation}")
+
+        event = self.round_events.get(round_num)
+        if isinstance(event, dict):
+            parts.append(f"事件：{event.get('event_title', '')}\n{event.get('event_description', '')}")
+            options = event.get("decision_options") or {}
+            if options:
+                parts.append(
+                    "决策选项：\n" + "\n".join(f"{key}. {text}" for key, text in options.items())
+                )
+        elif event:
+            parts.append(f"事件：{event}")
+
+        actions = self.round_actions.get(round_num, [])
+        if actions:
+            parts.append(
+                "玩家决策：\n"
+                + "\n".join(
+                    f"{action.get('playerName')}"
+                    f"({action['role'].upper() if action.get('role') else ''})"
+                    f"：{action.get('action', '')}"
+                    for action in actions
+                )
+            )
+        return "\n".join(parts)
+
+    def report_history(self, last_round: int) -> List[str]:
+        """第1轮到last_round轮的经过，用于最终报告
+
+        从最近的轮次开始使用完整经过，总长度不超过REPORT_HISTORY_MAX_CHARS，
+        放不下时该轮及更早的轮次改用长度有上限的精简摘要。
+        """
+        texts: List[str] = []
+        remaining = REPORT_HISTORY_MAX_CHARS
+        for round_num in range(last_round, 0, -1):
+            text = self.round_history_text(round_num)
+            if len(text) > remaining:
+                remaining = 0
+                text = self.round_summary_text(round_num)
+            else:
+                remaining -= len(text)
+            texts.append(text)
+        return list(reversed(texts))
+
+    def story_so_far(self, before_round: int, decisions_until: Optional[int] = None) -> str:
+        """指定轮次之前的故事梗概，总长度不超过STORY_MAX_CHARS
+
+        从最近的轮次开始保留完整摘要，放不下时较早的轮次只保留事件标题。
+        decisions_until不为空时只有该轮及之前的摘要包含玩家决策。
+        """
+        lines: List[str] = []
+        remaining = STORY_MAX_CHARS
+        for round_num in sorted(
+            (r for r in self.round_summaries if r < before_round), reverse=True
+        ):
+            include_decisions = decisions_until is None or round_num <= decisions_until
+            line = self.round_summary_text(round_num, include_decisions)
+            if len(line) > remaining:
+                line = _clip(f"第{round_num}轮：{self.round_summaries[round_num]['title']}", remaining)
+            if not line:
+                break
+            lines.append(line)
+            remaining -= len(line) + 1
+            if remaining <= 0:
+                break
+        return "\n".join(reversed(lines))
+
+    def set_round_event(self, round_num: int, event: Dict, private_messages: Dict):
+        """保存轮次事件和私人信息"""
+        self.round_events[round_num] = event
+        self.round_private_messages[round_num] = private_messages
+        self.touch("round_events", round_num)
+        self.touch("round_private_messages", round_num)
 
     def get_round_info(self, round_num: int) -> str:
         """获取指定轮次的信息"""
@@ -192,8 +524,9 @@ class GameRoom(BaseModel):
     def set_round_info(self, round_num: int, info: str):
         """设置指定轮次的动态信息"""
         self.dynamic_round_info[round_num] = info
+        self.touch("dynamic_round_info", round_num)
 
-    def generate_background_from_ideas(self, player_ideas):
+    async def generate_background_from_ideas(self, player_ideas):
         """根据所有玩家的想法生成背景"""
         if not player_ideas:
             raise ValueError("没有玩家想法")
@@ -202,59 +535,113 @@ class GameRoom(BaseModel):
         combined_ideas = "\n".join([f"- {idea}" for idea in player_ideas if idea])
 
         # 填充prompt模板
-        prompt = prompt_template.replace("{initial_idea}", combined_ideas)
+        prompt = prompt_template.render(initial_idea=combined_ideas)
 
         try:
-            self.background = LLM().text(prompt, temperature=0.7)
+            llm = LLM(cache=True, room_id=self.room_id, stage="background")
+            self.background = await single_flight.run(
+                self.room_id, "background", None, prompt,
+                lambda: llm.atext(
+                    prompt, system_prompt=prompt_template.system, temperature=0.7
+                ),
+            )
             return self.background
         except Exception as e:
             raise Exception(f"生成背景导入词失败: {str(e)}")
 
-    def generate_roles_from_background(self, background):
+    async def generate_roles_from_background(self, background):
         """根据游戏背景生成角色定义"""
         if not background:
             raise ValueError("背景故事不能为空")
 
         # 填充prompt模板
-        prompt = role_generator.replace("{background}", background)
+        prompt = role_generator.render(background=background)
 
         try:
             # 使用LLM生成角色定义，直接获取JSON格式响应
-            role_definitions = LLM().json(prompt, temperature=0.7)
+            llm = LLM(cache=True, room_id=self.room_id, stage="roles")
+            role_definitions = await single_flight.run(
+                self.room_id, "roles", None, prompt,
+                lambda: llm.ajson(
+                    prompt,
+                    system_prompt=role_generator.system,
+                    temperature=0.7,
+                    schema=RoleDefinitions,
+                ),
+            )
 
             return role_definitions
         except Exception as e:
             raise Exception(f"生成角色定义失败: {str(e)}")
 
-    def generate_event(self, round_num):
-        # 填充prompt2模板
-        prompt = prompt2_template.replace("{background}", self.background or "")
-        
-        # 替换initial_idea占位符
+    def situation_for_round(self, round_num) -> Dict:
+        """根据上一轮的结果构建指定轮次的输入情况"""
+        return {
+            "round": round_num - 1,
+            "players_choices": {},  # 这里可以根据实际行动数据构建
+            "final_choice": 1,  # 简化处理
+            "impact": "上一轮的决策产生了影响...",
+        }
+
+    def build_event_prompt(self, round_num, situation_data=None) -> str:
+        """构建指定轮次的事件生成提示词（用户消息部分），situation_data为空时使用房间中已保存的情况"""
         # 从玩家的startup_idea中获取初始想法
         initial_ideas = [player.startup_idea for player in self.players if player.startup_idea]
         combined_ideas = "\n".join([f"- {idea}" for idea in initial_ideas]) if initial_ideas else "创业想法"
-        prompt = prompt.replace("{initial_idea}", combined_ideas)
-        
-        # 替换situation/previous_output占位符
-        if round_num in self.round_situation:
+
+        # 上一轮的情况
+        if situation_data is None:
+            situation_data = self.round_situation.get(round_num)
+        if situation_data is not None:
             # 如果round_situation是字典，需要转换为字符串
-            situation_data = self.round_situation[round_num]
             if isinstance(situation_data, dict):
                 situation_str = f"第{situation_data.get('round', round_num-1)}轮的决策结果：{situation_data.get('impact', '上一轮的决策产生了影响...')}"
             else:
                 situation_str = str(situation_data)
-            prompt = prompt.replace("{situation}", situation_str)
-            prompt = prompt.replace("{previous_output}", situation_str)
         else:
-            default_situation = "这是第一轮决策，暂无上一轮结果"
-            prompt = prompt.replace("{situation}", default_situation)
-            prompt = prompt.replace("{previous_output}", default_situation)
+            situation_str = "这是第一轮决策，暂无上一轮结果"
 
-        response_json = LLM().json(prompt, temperature=0.7)
+        # 之前各轮的故事梗概（包括玩家决策），长度有上限；上一轮的决策在预生成时还没有全部提交，
+        # 不放进梗概，预生成时提示词和轮次开始时保持一致
+        story = self.story_so_far(round_num, decisions_until=round_num - 2)
+        if story:
+            situation_str = f"之前的经过：\n{story}\n{situation_str}"
+
+        # 填充prompt2模板
+        prompt = prompt2_template.render(
+            initial_idea=combined_ideas, previous_output=situation_str
+        )
+
+        return prompt
+
+    async def generate_event(self, round_num, on_delta=None, prompt=None):
+        """生成指定轮次的事件，提供on_delta时以流式方式生成并实时回调各字段的增量"""
+        if prompt is None:
+            prompt = self.build_event_prompt(round_num)
+
+        llm = LLM(room_id=self.room_id, stage="event")
+        if on_delta:
+            generate = lambda: llm.ajson_stream(
+                prompt,
+                on_delta,
+                system_prompt=prompt2_template.system,
+                temperature=0.7,
+                schema=RoundEventOutput,
+            )
+        else:
+            generate = lambda: llm.ajson(
+                prompt,
+                system_prompt=prompt2_template.system,
+                temperature=0.7,
+                schema=RoundEventOutput,
+            )
+        # 相同输入的生成正在进行时（例如预生成）直接等待它的结果，此时不会收到流式增量
+        response_json = await single_flight.run(
+            self.room_id, "event", round_num, prompt, generate
+        )
 
         # 添加调试信息
-        print(f"本轮事件的信息: {response_json}")
+        logger.debug("本轮事件的信息: %s", response_json)
 
         # 返回完整的事件数据，包含私人信息
         return {
@@ -263,7 +650,7 @@ class GameRoom(BaseModel):
             "private_messages": response_json.get("private_messages", {}),
         }
 
-    def calculate_game_result(self) -> Dict:
+    async def calculate_game_result(self) -> Dict:
         """计算游戏结果"""
         # 简化的游戏结果计算
         base_score = 50
@@ -299,9 +686,9 @@ class GameRoom(BaseModel):
 
         # 生成最终报告
         try:
-            final_report = self.generate_final_report()
+            final_report = await self.generate_final_report()
         except Exception as e:
-            print(f"生成最终报告失败: {e}")
+            logger.error(f"生成最终报告失败: {e}")
             final_report = "报告生成失败，请稍后重试。"
 
         return {
@@ -318,6 +705,7 @@ class GameRoom(BaseModel):
             "player_performance": player_performance,
             "playerScores": player_scores,
             "final_report": final_report,
+            "token_usage": llm_usage.room_usage(self.room_id),
         }
 
     def _generate_achievements(self, score: int) -> List[str]:
@@ -365,76 +753,46 @@ class GameRoom(BaseModel):
 
         return performance
 
-    def generate_final_report(self) -> str:
+    async def generate_final_report(self) -> str:
         """使用prompt4模板生成最终的创业报告"""
         # 获取初始创业想法
         initial_ideas = [player.startup_idea for player in self.players if player.startup_idea]
         combined_ideas = "\n".join([f"- {idea}" for idea in initial_ideas]) if initial_ideas else "创业想法"
         
-        # 获取每轮的分析结果
-        round_outputs = []
-        for round_num in range(1, 6):
-            round_output_parts = []
-            
-            # 获取轮次情况
-            if round_num in self.round_situation:
-                situation_data = self.round_situation[round_num]
-                if isinstance(situation_data, dict):
-                    situation = situation_data.get('impact', '上一轮的决策产生了影响...')
-                else:
-                    situation = str(situation_data)
-                round_output_parts.append(f"第{round_num}轮情况：{situation}")
-            
-            # 获取轮次事件
-            if round_num in self.round_events:
-                event_data = self.round_events[round_num]
-                # round_events存储的是事件对象，可能包含description等字段
-                if isinstance(event_data, dict):
-                    event_desc = event_data.get('description', '') or str(event_data)
-                else:
-                    event_desc = str(event_data)
-                round_output_parts.append(f"事件：{event_desc}")
-            
-            # 添加该轮的玩家行动
-            if round_num in self.round_actions:
-                actions = self.round_actions[round_num]
-                action_summary = "\n".join([f"{action.get('player')}({action.get('role', '')})：{action.get('action', '')}" for action in actions])
-                round_output_parts.append(f"玩家决策：\n{action_summary}")
-            
-            if round_output_parts:
-                round_outputs.append("\n".join(round_output_parts))
-            else:
-                round_outputs.append(f"第{round_num}轮：暂无数据")
-        
-        # 填充prompt4模板
-        prompt = prompt4_template.replace("{initial_idea}", combined_ideas)
-        prompt = prompt.replace("{output1}", round_outputs[0] if len(round_outputs) > 0 else "暂无数据")
-        prompt = prompt.replace("{output2}", round_outputs[1] if len(round_outputs) > 1 else "暂无数据")
-        prompt = prompt.replace("{output3}", round_outputs[2] if len(round_outputs) > 2 else "暂无数据")
-        prompt = prompt.replace("{output4}", round_outputs[3] if len(round_outputs) > 3 else "暂无数据")
-        prompt = prompt.replace("{output5}", round_outputs[4] if len(round_outputs) > 4 else "暂无数据")
-        
-        # 替换玩家姓名占位符
-        # 首先替换CEO的姓名
-        ceo_player = None
-        for player in self.players:
-            if player.role == Role.CEO:
-                ceo_player = player
-                break
-        
-        if ceo_player:
-            # 替换CEO部分的[玩家姓名]
-            prompt = prompt.replace("CEO/Founder：[玩家姓名]", f"CEO/Founder：{ceo_player.name}")
-        
-        # 替换其他角色的玩家姓名
-        role_mapping = {Role.CTO: "CTO", Role.CMO: "CMO", Role.COO: "COO"}
+        # 最近的轮次使用完整经过，总长度有上限，较早的轮次放不下时使用精简摘要
+        round_outputs = [
+            text or f"第{round_num}轮：暂无数据"
+            for round_num, text in enumerate(self.report_history(5), start=1)
+        ]
+
+        # 玩家姓名，每个角色取第一个选择该角色的玩家
+        role_names = {}
         for player in self.players:
-            if player.role and player.role in role_mapping:
-                role_name = role_mapping[player.role]
-                prompt = prompt.replace(f"{role_name}：[玩家姓名]", f"{role_name}：{player.name}")
-        
+            if player.role and player.role not in role_names:
+                role_names[player.role] = player.name
+
+        # 填充prompt4模板
+        prompt = prompt4_template.render(
+            initial_idea=combined_ideas,
+            output1=round_outputs[0] if len(round_outputs) > 0 else "暂无数据",
+            output2=round_outputs[1] if len(round_outputs) > 1 else "暂无数据",
+            output3=round_outputs[2] if len(round_outputs) > 2 else "暂无数据",
+            output4=round_outputs[3] if len(round_outputs) > 3 else "暂无数据",
+            output5=round_outputs[4] if len(round_outputs) > 4 else "暂无数据",
+            ceo_name=role_names.get(Role.CEO, "[玩家姓名]"),
+            cto_name=role_names.get(Role.CTO, "[玩家姓名]"),
+            cmo_name=role_names.get(Role.CMO, "[玩家姓名]"),
+            coo_name=role_names.get(Role.COO, "[玩家姓名]"),
+        )
+
         try:
-            final_report = LLM().text(prompt, temperature=0.7)
+            llm = LLM(room_id=self.room_id, stage="report")
+            final_report = await single_flight.run(
+                self.room_id, "report", None, prompt,
+                lambda: llm.atext(
+                    prompt, system_prompt=prompt4_template.system, temperature=0.7
+                ),
+            )
             return final_report
         except Exception as e:
             raise Exception(f"生成最终报告失败: {str(e)}")
@@ -448,12 +806,24 @@ class GameRoom(BaseModel):
         self.dynamic_roles = None  # 重置动态角色定义，重新开始时会重新生成
         self.game_result = None
         self.round_actions = {}
+        self._submitted_players = {}
         self.round_events = {}  # 重置轮次事件
         self.round_private_messages = {}  # 重置私人信息
         self.dynamic_round_info = {}  # 重置动态轮次信息
+        self.stage_timings = {}  # 重置生成阶段耗时
+        self.touch("stage_timings")
+        self.round_summaries = {}  # 重置轮次摘要
+        self.touch("round_summaries")
+        self.round_situation = {}  # 重置轮次情况，避免摘要和第一轮提示词沿用上一局的内容
+        self.touch("round_situation")
+        # 最终结果中的token用量只统计本局游戏
+        llm_usage.reset_room(self.room_id)
 
         # 重置玩家的游戏相关状态，但保留玩家名称和房主状态
+        self._role_owners = {}
+        self._online_role_count = 0
         for player in self.players:
             player.role = None
             player.actions = []
             # 保留 startup_idea，这样玩家不需要重新输入创业想法
+        self.touch("players")
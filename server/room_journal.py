@@ -0,0 +1,202 @@
+from typing import Dict, List, Optional, Tuple
+import asyncio
+import json
+import logging
+import os
+import sqlite3
+import time
+
+from room import GameRoom
+from shard_ring import shard_ring
+from state_backend import SHARED_STATE, WORKER_ID
+
+logger = logging.getLogger(__name__)
+
+# 房间持久化: off（默认）、sqlite。使用共享状态后端（redis）时房间已保存在redis中，不再重复记录
+ROOM_JOURNAL = os.getenv("ROOM_JOURNAL", "off")
+# 默认保存在用户目录下而不是代码目录中；分片部署时每个worker使用各自的文件
+ROOM_JOURNAL_PATH = os.getenv(
+    "ROOM_JOURNAL_PATH",
+    os.path.join(
+        os.path.expanduser("~"),
+        ".startup-mod",
+        f"rooms-{WORKER_ID}.sqlite3" if shard_ring else "rooms.sqlite3",
+    ),
+)
+# 距上次快照累计的变更条数达到该值时重新写入完整快照并清空变更日志
+ROOM_SNAPSHOT_EVERY = int(os.getenv("ROOM_SNAPSHOT_EVERY", "50"))
+# 超过该时间（秒）没有任何变化的房间在启动时不再恢复
+ROOM_JOURNAL_RETENTION = float(os.getenv("ROOM_JOURNAL_RETENTION", "3600"))
+
+
+class RoomJournal:
+    """房间状态的快照和追加写入的变更日志
+
+    房间每次变化只追加变化的字段（按轮次保存的字段只追加变化的轮次），
+    同一个事件循环迭代内的变化合并到一个事务中写入。
+    变更累计到一定数量后写入完整快照并清空该房间的变更日志。
+    启动时读取快照并按顺序重放之后的变更，恢复进行中的游戏。
+    """
+
+    def __init__(self, path: str = ROOM_JOURNAL_PATH):
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS room_snapshots ("
+            "room_id TEXT PRIMARY KEY, version INTEGER NOT NULL, "
+            "data TEXT NOT NULL, updated_at REAL NOT NULL)"
+        )
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS room_events ("
+            "id INTEGER PRIMARY KEY AUTOINCREMENT, room_id TEXT NOT NULL, "
+            "version INTEGER NOT NULL, field TEXT NOT NULL, round INTEGER, value TEXT)"
+        )
+        self._conn.execute(
+            "CREATE INDEX IF NOT EXISTS room_events_room ON room_events (room_id, id)"
+        )
+        self._conn.commit()
+        # 等待写入的房间
+        self._dirty: Dict[str, GameRoom] = {}
+        self._flush_scheduled = False
+        # 房间ID -> (已记录的房间对象, 已记录的版本号, 距上次快照的变更条数)
+        self._journaled: Dict[str, Tuple[GameRoom, int, int]] = {}
+
+    def mark_dirty(self, room: GameRoom):
+        """房间发生变化，在当前事件循环迭代结束时写入"""
+        self._dirty[room.room_id] = room
+        if self._flush_scheduled:
+            return
+        try:
+            asyncio.get_running_loop().call_soon(self.flush)
+            self._flush_scheduled = True
+        except RuntimeError:
+            self.flush()
+
+    def flush(self):
+        """把所有等待写入的房间变化写入磁盘"""
+        self._flush_scheduled = False
+        dirty, self._dirty = self._dirty, {}
+        if not dirty:
+            return
+        try:
+            with self._conn:
+                for room in dirty.values():
+                    self._write(room)
+        except Exception as e:
+            logger.error(f"写入房间变更日志失败: {e}")
+
+    def _write(self, room: GameRoom):
+        entry = self._journaled.get(room.room_id)
+        # 新房间（包括删除后重新创建的同名房间）直接写入快照
+        if entry is None or entry[0] is not room:
+            self._write_snapshot(room)
+            return
+
+        _, version, pending = entry
+        changes = room.changes_since(version)
+        if changes is None or pending + len(changes) >= ROOM_SNAPSHOT_EVERY:
+            self._write_snapshot(room)
+            return
+        if not changes:
+            return
+
+        data = room.model_dump(mode="json", include=set(changes))
+        rows = []
+        for field, rounds in changes.items():
+            if rounds is None:
+                rows.append((room.room_id, room.version, field, None, json.dumps(data[field])))
+                continue
+            for round_num in rounds:
+                value = data[field].get(str(round_num))
+                rows.append((
+                    room.room_id, room.version, field, round_num,
+                    None if value is None else json.dumps(value),
+                ))
+        self._conn.executemany(
+            "INSERT INTO room_events (room_id, version, field, round, value) "
+            "VALUES (?, ?, ?, ?, ?)",
+            rows,
+        )
+        self._conn.execute(
+            "UPDATE room_snapshots SET updated_at = ? WHERE room_id = ?",
+            (time.time(), room.room_id),
+        )
+        self._journaled[room.room_id] = (room, room.version, pending + len(rows))
+
+    def _write_snapshot(self, room: GameRoom):
+        self._conn.execute(
+            "INSERT OR REPLACE INTO room_snapshots (room_id, version, data, updated_at) "
+            "VALUES (?, ?, ?, ?)",
+            (room.room_id, room.version, room.snapshot(), time.time()),
+        )
+        self._conn.execute("DELETE FROM room_events WHERE room_id = ?", (room.room_id,))
+        self._journaled[room.room_id] = (room, room.version, 0)
+
+    def forget(self, room_id: str):
+        """房间从内存中删除时调用，写入最后的变化后不再跟踪该房间
+
+        记录本身保留到超过保留时间，所有玩家断线导致房间被删除（例如重新部署）时仍然可以恢复。
+        """
+        if room_id in self._dirty:
+            self.flush()
+        self._journaled.pop(room_id, None)
+
+    def restore(self) -> List[GameRoom]:
+        """从快照和变更日志恢复所有房间，恢复的玩家均为离线状态"""
+        expired_before = time.time() - ROOM_JOURNAL_RETENTION
+        with self._conn:
+            self._conn.execute(
+                "DELETE FROM room_events WHERE room_id IN "
+                "(SELECT room_id FROM room_snapshots WHERE updated_at < ?)",
+                (expired_before,),
+            )
+            self._conn.execute(
+                "DELETE FROM room_snapshots WHERE updated_at < ?", (expired_before,)
+            )
+
+        events: Dict[str, List[Tuple[int, str, Optional[int], Optional[str]]]] = {}
+        for room_id, version, field, round_num, value in self._conn.execute(
+            "SELECT room_id, version, field, round, value FROM room_events ORDER BY id"
+        ):
+            events.setdefault(room_id, []).append((version, field, round_num, value))
+
+        rooms = []
+        for room_id, version, data in self._conn.execute(
+            "SELECT room_id, version, data FROM room_snapshots"
+        ).fetchall():
+            try:
+                state = json.loads(data)
+                room_events = events.get(room_id, [])
+                for event_version, field, round_num, value in room_events:
+                    decoded = None if value is None else json.loads(value)
+                    if round_num is None:
+                        state[field] = decoded
+                    elif decoded is None:
+                        state.setdefault(field, {}).pop(str(round_num), None)
+                    else:
+                        state.setdefault(field, {})[str(round_num)] = decoded
+                    version = max(version, event_version)
+                for player in state.get("players", []):
+                    player["is_online"] = False
+
+                room = GameRoom.from_snapshot(json.dumps(state), version)
+                self._journaled[room_id] = (room, version, len(room_events))
+                rooms.append(room)
+            except Exception as e:
+                logger.error(f"恢复房间 {room_id} 失败: {e}")
+
+        if rooms:
+            logger.info(f"已从 {ROOM_JOURNAL_PATH} 恢复 {len(rooms)} 个房间")
+        return rooms
+
+
+def _create_journal() -> Optional[RoomJournal]:
+    if ROOM_JOURNAL != "sqlite" or SHARED_STATE:
+        return None
+    return RoomJournal()
+
+
+# 全局房间持久化实例，ROOM_JOURNAL=off 或使用共享状态后端时为None
+room_journal = _create_journal()
@@ -0,0 +1,103 @@
+from collections import deque
+from typing import Any, AsyncContextManager, Awaitable, Callable, Deque, Dict, Optional, Tuple
+import asyncio
+import logging
+
+logger = logging.getLogger(__name__)
+
+Command = Callable[[], Awaitable[Any]]
+# 包裹每个命令执行过程的上下文，参数为房间ID（例如共享状态模式下的跨worker房间锁）
+CommandGuard = Callable[[str], AsyncContextManager]
+
+
+class RoomMailbox:
+    """单个房间的命令队列，由一个任务按到达顺序逐个执行
+
+    同一房间的命令不会交错执行（包括命令中的await），不同房间的命令互不影响。
+    队列为空时执行任务结束，下次有命令时重新创建，空闲房间不占用任务。
+    """
+
+    def __init__(
+        self,
+        room_id: str,
+        on_idle: Callable[["RoomMailbox"], None],
+        guard: Optional[CommandGuard] = None,
+    ):
+        self.room_id = room_id
+        self._on_idle = on_idle
+        self._guard = guard
+        self._queue: Deque[Tuple[Command, asyncio.Future]] = deque()
+        self._task: Optional[asyncio.Task] = None
+
+    def submit(self, command: Command) -> asyncio.Future:
+        """放入一个命令，返回命令执行结果的future"""
+        future = asyncio.get_running_loop().create_future()
+        self._queue.append((command, future))
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+        return future
+
+    @property
+    def pending(self) -> int:
+        """等待执行的命令数量"""
+        return len(self._queue)
+
+    async def _run(self):
+        try:
+            while self._queue:
+                command, future = self._queue.popleft()
+                if future.cancelled():
+                    continue
+                try:
+                    if self._guard is None:
+                        result = await command()
+                    else:
+                        async with self._guard(self.room_id):
+                            result = await command()
+                except asyncio.CancelledError:
+                    future.cancel()
+                    raise
+                except Exception as e:
+                    if not future.done():
+                        future.set_exception(e)
+                else:
+                    if not future.done():
+                        future.set_result(result)
+        finally:
+            # 正常结束时队列已空；执行任务被取消（例如服务关闭）时剩余的命令不会再执行，
+            # 取消它们的future，调用方不会一直等待
+            while self._queue:
+                _, future = self._queue.popleft()
+                future.cancel()
+            # 检查队列和退出之间没有await，不会漏掉新放入的命令
+            self._task = None
+            self._on_idle(self)
+
+
+class RoomMailboxes:
+    """所有房间的命令队列"""
+
+    def __init__(self):
+        # 房间ID -> 命令队列
+        self._mailboxes: Dict[str, RoomMailbox] = {}
+        # 包裹每个命令的上下文，由RoomManager在共享状态模式下设置
+        self.guard: Optional[CommandGuard] = None
+
+    async def run(self, room_id: str, command: Command) -> Any:
+        """在房间的命令队列中执行命令并等待结果
+
+        命令中不能再调用同一房间的run，否则会互相等待。
+        """
+        mailbox = self._mailboxes.get(room_id)
+        if mailbox is None:
+            mailbox = RoomMailbox(room_id, self._remove, self.guard)
+            self._mailboxes[room_id] = mailbox
+        return await mailbox.submit(command)
+
+    def _remove(self, mailbox: RoomMailbox):
+        if self._mailboxes.get(mailbox.room_id) is mailbox:
+            del self._mailboxes[mailbox.room_id]
+
+
+# 全局房间命令队列实例
+room_mailboxes = RoomMailboxes()
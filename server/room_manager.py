@@ -1,8 +1,23 @@
 # 房间管理器
-from typing import Dict, Optional
-from datetime import datetime
+from collections import OrderedDict
+from contextlib import asynccontextmanager
+from typing import Awaitable, Callable, Dict, List, Optional, Tuple
+from datetime import datetime, timedelta
+import asyncio
+import time
 from room import GameRoom, Player
 from logger_config import logger
+from event_speculator import event_speculator
+from connection_manager import encode_message
+from state_backend import SHARED_STATE, WORKER_ID, broadcast_bus, room_store
+from shard_ring import shard_ring
+from room_journal import room_journal
+from room_mailbox import room_mailboxes
+
+# 新房间即使没有在线玩家（WebSocket可能还在连接中）也在大厅中显示的宽限期
+NEW_ROOM_GRACE_PERIOD = timedelta(seconds=30)
+# 预渲染的大厅列表最多保留的条目数（不同的筛选和分页参数组合），超出时淘汰最久未使用的
+LOBBY_CACHE_MAX_ENTRIES = 64
 
 
 class RoomManager:
@@ -10,17 +25,62 @@ class RoomManager:
     
     def __init__(self):
         self.rooms: Dict[str, GameRoom] = {}
+        # 大厅索引：房间ID -> 房间在大厅中的展示数据，不可见的房间为None
+        self._lobby_entries: Dict[str, Optional[Dict]] = {}
+        # 处于新房间宽限期的房间ID -> 宽限期结束时间
+        self._lobby_grace: Dict[str, datetime] = {}
+        # 大厅索引版本号，任何展示数据变化都会递增，同时作为ETag
+        self._lobby_version = 0
+        # 版本号只在当前进程内有效，ETag中加上worker和启动时间，重启或换到其他worker后不会误判为未变化
+        self._lobby_epoch = f"{WORKER_ID}-{time.time_ns():x}"
+        # (游戏状态, 偏移, 数量) -> 预渲染的大厅列表，版本变化时清空
+        self._lobby_cache: "OrderedDict[Tuple[Optional[str], int, Optional[int]], bytes]" = (
+            OrderedDict()
+        )
+        # 大厅变化监听器，参数为 (房间ID, 新的展示数据)，房间不再显示时展示数据为None
+        self._lobby_listeners: List[Callable[[str, Optional[Dict]], None]] = []
+        # 共享状态模式下等待保存到存储并通知其他worker的房间
+        self._dirty_rooms: Dict[str, GameRoom] = {}
+        self._dirty_event: Optional[asyncio.Event] = None
+        self._persist_task: Optional[asyncio.Task] = None
+        # 房间ID -> 共享存储中该房间的版本号（本worker最后一次加载或保存的），保存时用于比较并写入
+        self._stored_versions: Dict[str, int] = {}
+        # 保存到共享存储时串行执行，后台保存和命令结束时的保存不会用同一个旧版本号互相冲突
+        self._save_lock = asyncio.Lock()
+        # 房间本地修改因保存冲突被丢弃后的回调，用于向本worker的客户端重新推送完整状态
+        self._resync_listeners: List[Callable[[GameRoom], Awaitable[None]]] = []
+        broadcast_bus.subscribe(self._on_bus_message)
+        if SHARED_STATE:
+            room_mailboxes.guard = self._room_command
 
     def create_room(self, room_id: str) -> GameRoom:
         """创建房间"""
         if room_id in self.rooms:
             raise ValueError(f"房间 {room_id} 已存在")
+        if shard_ring and not shard_ring.is_local(room_id):
+            raise ValueError(f"房间 {room_id} 不属于当前节点")
 
         room = GameRoom(room_id=room_id, created_at=datetime.now())
-        self.rooms[room_id] = room
+        self._install_room(room)
+        self._on_room_touched(room)
         logger.info(f"房间 {room_id} 已创建")
         return room
 
+    def _install_room(self, room: GameRoom):
+        """把房间放入本地索引并挂上变化回调"""
+        self.rooms[room.room_id] = room
+        room._on_change = self._update_lobby_entry
+        if SHARED_STATE or room_journal:
+            room._on_touch = self._on_room_touched
+        self._update_lobby_entry(room)
+
+    def _on_room_touched(self, room: GameRoom):
+        """房间状态变化后保存到共享存储或本地持久化"""
+        if SHARED_STATE:
+            self._mark_dirty(room)
+        if room_journal:
+            room_journal.mark_dirty(room)
+
     def get_room(self, room_id: str) -> Optional[GameRoom]:
         """获取房间"""
         return self.rooms.get(room_id)
@@ -36,18 +96,289 @@ class RoomManager:
         logger.info(f"玩家 {player_name} 加入房间 {room_id}")
         return room
 
+    async def fetch_room(self, room_id: str) -> Optional[GameRoom]:
+        """获取房间，本地没有时尝试从共享存储加载（其他worker创建的房间）"""
+        room = self.rooms.get(room_id)
+        if room or not SHARED_STATE:
+            return room
+        return await self._load_room(room_id)
+
     def remove_room(self, room_id: str) -> bool:
         """删除房间"""
+        if self._drop_room(room_id):
+            if SHARED_STATE:
+                self._dirty_rooms.pop(room_id, None)
+                self._stored_versions.pop(room_id, None)
+                asyncio.create_task(self._delete_shared_room(room_id))
+            return True
+        return False
+
+    def _drop_room(self, room_id: str) -> bool:
+        """从本地移除房间"""
         if room_id in self.rooms:
             del self.rooms[room_id]
+            event_speculator.cancel_room(room_id)
+            if room_journal:
+                room_journal.forget(room_id)
+            self._lobby_grace.pop(room_id, None)
+            if self._lobby_entries.pop(room_id, None):
+                self._bump_lobby_version()
+                self._notify_lobby_listeners(room_id, None)
             logger.info(f"房间 {room_id} 已删除")
             return True
         return False
 
+    def restore_rooms(self) -> List[GameRoom]:
+        """启动时从本地持久化恢复房间"""
+        if not room_journal:
+            return []
+        rooms = room_journal.restore()
+        for room in rooms:
+            self._install_room(room)
+        return rooms
+
+    # ==================== 共享状态（多worker） ====================
+
+    async def load_shared_rooms(self):
+        """启动时从共享存储加载所有房间"""
+        if not SHARED_STATE:
+            return
+        for room_id in await room_store.room_ids():
+            await self._load_room(room_id)
+        logger.info(f"已从共享存储加载 {len(self.rooms)} 个房间")
+
+    async def _load_room(self, room_id: str, force: bool = False) -> Optional[GameRoom]:
+        """从共享存储加载房间
+
+        本地已有该房间时把快照原地应用到同一个对象上，持有该对象的处理流程不会写到旧对象上。
+        force为True时即使本地已经加载过该版本也重新应用（保存冲突后丢弃本地未保存的修改）。
+        """
+        stored = await room_store.load(room_id)
+        if stored is None:
+            return None
+        version, data = stored
+        local = self.rooms.get(room_id)
+        if local and not force and self._stored_versions.get(room_id, -1) >= version:
+            return local
+        self._stored_versions[room_id] = version
+        if local:
+            self._dirty_rooms.pop(room_id, None)
+            local.apply_snapshot(data, version)
+            return local
+        room = GameRoom.from_snapshot(data, version)
+        self._install_room(room)
+        return room
+
+    def _mark_dirty(self, room: GameRoom):
+        """房间状态变化后，在当前事件循环迭代结束后统一保存并通知其他worker"""
+        self._dirty_rooms[room.room_id] = room
+        if self._persist_task is None:
+            self._dirty_event = asyncio.Event()
+            self._persist_task = asyncio.create_task(self._persist_loop())
+        self._dirty_event.set()
+
+    async def _persist_loop(self):
+        """单个任务按顺序保存房间，保证同一房间的快照不会乱序写入"""
+        while True:
+            await self._dirty_event.wait()
+            self._dirty_event.clear()
+            dirty, self._dirty_rooms = self._dirty_rooms, {}
+            for room_id, room in dirty.items():
+                await self._save_room(room_id, room)
+
+    @asynccontextmanager
+    async def _room_command(self, room_id: str):
+        """共享状态模式下包裹房间命令：持有跨worker的房间锁，先加载最新状态，执行后立即保存
+
+        同一房间的命令在所有worker之间串行执行，每个命令都基于最新的共享状态修改，
+        不会出现两个worker基于同一版本各自修改、后保存的一方被丢弃的情况。
+        """
+        async with room_store.lock(room_id):
+            if room_id in self.rooms:
+                await self._load_room(room_id)
+            try:
+                yield
+            finally:
+                room = self._dirty_rooms.pop(room_id, None)
+                if room is not None:
+                    await self._save_room(room_id, room)
+
+    async def _save_room(self, room_id: str, room: GameRoom):
+        """把房间保存到共享存储并通知其他worker"""
+        async with self._save_lock:
+            if self.rooms.get(room_id) is not room:
+                return
+            version = room.version
+            if self._stored_versions.get(room_id, -1) >= version:
+                return
+            try:
+                saved = await room_store.save(
+                    room_id, version, room.snapshot(), self._stored_versions.get(room_id)
+                )
+                if not saved:
+                    # 其他worker在此期间保存了该房间（例如房间锁超时），放弃本地修改并加载最新状态，
+                    # 已经推送给客户端的本地修改随之失效，重新向客户端推送完整状态
+                    logger.warning(f"房间 {room_id} 已被其他worker修改，重新加载共享状态")
+                    await self._load_room(room_id, force=True)
+                    await self._notify_resync_listeners(room)
+                    return
+                self._stored_versions[room_id] = version
+                await broadcast_bus.publish(
+                    {"type": "room_updated", "room_id": room_id, "version": version}
+                )
+            except Exception as e:
+                logger.error(f"保存房间 {room_id} 到共享存储失败: {e}")
+
+    async def _notify_resync_listeners(self, room: GameRoom):
+        for listener in self._resync_listeners:
+            try:
+                await listener(room)
+            except Exception as e:
+                logger.error(f"房间重新同步监听器执行失败: {e}")
+
+    def add_resync_listener(self, listener: Callable[[GameRoom], Awaitable[None]]):
+        """注册房间重新同步监听器"""
+        self._resync_listeners.append(listener)
+
+    async def _delete_shared_room(self, room_id: str):
+        try:
+            await room_store.delete(room_id)
+            await broadcast_bus.publish({"type": "room_removed", "room_id": room_id})
+        except Exception as e:
+            logger.error(f"从共享存储删除房间 {room_id} 失败: {e}")
+
+    async def _on_bus_message(self, message: Dict):
+        """处理其他worker发布的房间变化"""
+        message_type = message.get("type")
+        room_id = message.get("room_id")
+        if message_type == "room_updated":
+            if self._stored_versions.get(room_id, -1) < message.get("version", 0):
+                await self._load_room(room_id)
+        elif message_type == "room_removed":
+            self._drop_room(room_id)
+
     def get_all_rooms(self) -> Dict[str, GameRoom]:
         """获取所有房间"""
         return self.rooms.copy()
 
+    def _update_lobby_entry(self, room: GameRoom):
+        """房间的大厅展示数据发生变化时更新索引"""
+        entry = self._build_lobby_entry(room)
+        if room.room_id in self._lobby_entries and self._lobby_entries[room.room_id] == entry:
+            return
+        self._lobby_entries[room.room_id] = entry
+        self._bump_lobby_version()
+        self._notify_lobby_listeners(room.room_id, entry)
+
+    def _build_lobby_entry(self, room: GameRoom) -> Optional[Dict]:
+        """构建房间在大厅中的展示数据，不应显示时返回None
+
+        智能显示逻辑：
+        1. 优先显示有在线玩家的房间
+        2. 对于刚创建的房间（可能WebSocket还没连接），给予短暂的宽限期
+        """
+        self._lobby_grace.pop(room.room_id, None)
+        if room.online_player_count():
+            # 有在线玩家，直接显示
+            display_players = room.get_online_players()
+        elif room.players and datetime.now() - room.created_at < NEW_ROOM_GRACE_PERIOD:
+            # 新房间且有玩家，给予宽限期（可能WebSocket还在连接中）
+            display_players = room.players
+            self._lobby_grace[room.room_id] = room.created_at + NEW_ROOM_GRACE_PERIOD
+        else:
+            # 旧房间且无在线玩家，不显示
+            return None
+
+        return {
+            "room_id": room.room_id,
+            "player_count": len(display_players),
+            "max_players": 4,
+            "game_state": room.game_state.value,
+            "created_at": room.created_at.isoformat() if room.created_at else None,
+            "players": [{"name": p.name, "is_host": p.is_host} for p in display_players],
+        }
+
+    def _bump_lobby_version(self):
+        self._lobby_version += 1
+        self._lobby_cache.clear()
+
+    def _notify_lobby_listeners(self, room_id: str, entry: Optional[Dict]):
+        for listener in self._lobby_listeners:
+            try:
+                listener(room_id, entry)
+            except Exception as e:
+                logger.error(f"大厅变化监听器执行失败: {e}")
+
+    def add_lobby_listener(self, listener: Callable[[str, Optional[Dict]], None]):
+        """注册大厅变化监听器"""
+        self._lobby_listeners.append(listener)
+
+    @property
+    def lobby_version(self) -> int:
+        """大厅索引当前版本号"""
+        return self._lobby_version
+
+    def next_lobby_grace_expiry(self) -> Optional[datetime]:
+        """最早结束的新房间宽限期，没有处于宽限期的房间时返回None"""
+        return min(self._lobby_grace.values(), default=None)
+
+    def expire_lobby_grace(self):
+        """把宽限期已结束的房间重新计算展示数据"""
+        now = datetime.now()
+        expired = [room_id for room_id, until in self._lobby_grace.items() if until <= now]
+        for room_id in expired:
+            room = self.rooms.get(room_id)
+            if room:
+                self._update_lobby_entry(room)
+            else:
+                self._lobby_grace.pop(room_id, None)
+
+    def get_lobby_rooms(self) -> List[Dict]:
+        """获取大厅中当前显示的所有房间"""
+        if self._lobby_grace:
+            self.expire_lobby_grace()
+        return [entry for entry in self._lobby_entries.values() if entry]
+
+    def get_lobby_listing(
+        self,
+        game_state: Optional[str] = None,
+        offset: int = 0,
+        limit: Optional[int] = None,
+    ) -> Tuple[str, bytes]:
+        """获取预渲染的大厅房间列表
+
+        Args:
+            game_state: 只返回该游戏状态的房间（可选）
+            offset: 分页偏移
+            limit: 分页大小（可选）
+
+        Returns:
+            (ETag, 编码后的JSON响应体)
+        """
+        if self._lobby_grace:
+            self.expire_lobby_grace()
+
+        etag = f'W/"{self._lobby_epoch}-{self._lobby_version}"'
+        key = (game_state, offset, limit)
+        body = self._lobby_cache.get(key)
+        if body is None:
+            rooms = [
+                entry
+                for entry in self._lobby_entries.values()
+                if entry and (game_state is None or entry["game_state"] == game_state)
+            ]
+            page = rooms[offset:] if limit is None else rooms[offset:offset + limit]
+            body = encode_message(
+                {"success": True, "rooms": page, "total_count": len(rooms)}
+            ).encode("utf-8")
+            self._lobby_cache[key] = body
+            # 查询参数由客户端任意指定，限制缓存条目数
+            while len(self._lobby_cache) > LOBBY_CACHE_MAX_ENTRIES:
+                self._lobby_cache.popitem(last=False)
+        else:
+            self._lobby_cache.move_to_end(key)
+        return etag, body
+
     def get_room_count(self) -> int:
         """获取房间总数"""
         return len(self.rooms)
@@ -56,7 +387,7 @@ class RoomManager:
         """清理空房间"""
         empty_rooms = []
         for room_id, room in self.rooms.items():
-            if not room.get_online_players():
+            if not room.online_player_count():
                 empty_rooms.append(room_id)
         
         for room_id in empty_rooms:
@@ -0,0 +1,102 @@
+from bisect import bisect
+from typing import Dict, List, Optional, Tuple
+import hashlib
+import logging
+import os
+
+from state_backend import SHARED_STATE, WORKER_ID
+
+logger = logging.getLogger(__name__)
+
+# 分片部署的节点列表，格式为 "worker_id=http://host:port,worker_id=http://host:port"，为空时不分片
+SHARD_NODES = os.getenv("SHARD_NODES", "")
+# 每个节点在哈希环上的虚拟节点数，越多分布越均匀
+SHARD_VIRTUAL_NODES = int(os.getenv("SHARD_VIRTUAL_NODES", "64"))
+
+
+def _hash(key: str) -> int:
+    return int.from_bytes(hashlib.md5(key.encode("utf-8")).digest()[:8], "big")
+
+
+class HashRing:
+    """一致性哈希环
+
+    每个房间ID映射到环上顺时针方向的第一个虚拟节点所属的worker，
+    增减worker时只有相邻区间的房间需要迁移。
+    """
+
+    def __init__(self, nodes: Dict[str, str], virtual_nodes: int = SHARD_VIRTUAL_NODES):
+        if not nodes:
+            raise ValueError("哈希环至少需要一个节点")
+        # worker_id -> 对外访问地址
+        self.nodes = dict(nodes)
+        points: List[Tuple[int, str]] = sorted(
+            (_hash(f"{node_id}#{i}"), node_id)
+            for node_id in self.nodes
+            for i in range(virtual_nodes)
+        )
+        self._keys = [point for point, _ in points]
+        self._owners = [node_id for _, node_id in points]
+
+    def owner(self, room_id: str) -> str:
+        """房间所属的worker_id"""
+        index = bisect(self._keys, _hash(room_id)) % len(self._keys)
+        return self._owners[index]
+
+    def is_local(self, room_id: str) -> bool:
+        """房间是否属于当前worker"""
+        return self.owner(room_id) == WORKER_ID
+
+    def owner_url(self, room_id: str) -> Optional[str]:
+        """房间所属worker的地址，属于当前worker时返回None"""
+        owner = self.owner(room_id)
+        return None if owner == WORKER_ID else self.nodes[owner]
+
+
+def _parse_nodes(spec: str) -> Dict[str, str]:
+    nodes = {}
+    for item in spec.split(","):
+        item = item.strip()
+        if not item:
+            continue
+        node_id, _, url = item.partition("=")
+        nodes[node_id.strip()] = url.strip().rstrip("/")
+    return nodes
+
+
+def to_websocket_url(url: str) -> str:
+    """把HTTP地址转换为对应的WebSocket地址"""
+    if url.startswith("https://"):
+        return "wss://" + url[len("https://"):]
+    if url.startswith("http://"):
+        return "ws://" + url[len("http://"):]
+    return url
+
+
+def _create_ring() -> Optional[HashRing]:
+    nodes = _parse_nodes(SHARD_NODES)
+    if not nodes:
+        return None
+    if WORKER_ID not in nodes:
+        raise ValueError(f"WORKER_ID {WORKER_ID} 不在 SHARD_NODES 中")
+    if SHARED_STATE:
+        logger.warning("同时启用了共享房间状态和分片部署，房间仍只由所属worker处理")
+    logger.info(f"分片部署: 当前worker {WORKER_ID}，共 {len(nodes)} 个节点")
+    return HashRing(nodes)
+
+
+# 全局哈希环实例，未配置 SHARD_NODES 时为None
+shard_ring = _create_ring()
+
+
+# 迁移比例检查：python shard_ring.py
+if __name__ == "__main__":
+    room_ids = [f"{i:04d}" for i in range(10000)]
+    before = HashRing({f"w{i}": "" for i in range(4)})
+    after = HashRing({f"w{i}": "" for i in range(5)})
+    moved = sum(before.owner(r) != after.owner(r) for r in room_ids)
+    counts: Dict[str, int] = {}
+    for r in room_ids:
+        counts[after.owner(r)] = counts.get(after.owner(r), 0) + 1
+    print(f"4 -> 5 个worker: {moved / len(room_ids):.1%} 的房间需要迁移（理想值 20%）")
+    print(f"5 个worker的房间分布: {counts}")
@@ -0,0 +1,79 @@
+from typing import Any, Awaitable, Callable, Dict, Optional, Tuple
+import asyncio
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+class _Flight:
+    """一次进行中的生成及其等待者数量"""
+
+    def __init__(self, task: asyncio.Task):
+        self.task = task
+        self.waiters = 0
+
+
+class SingleFlight:
+    """进行中的生成去重
+
+    同一房间、同一阶段、同一轮次且提示词相同的生成同时只执行一次，
+    之后到达的调用等待同一个结果，不再重复请求大模型。提示词不同（输入已变化）时不会复用。
+    生成在独立的任务中执行，单个等待者被取消不影响其他等待者；
+    所有等待者都取消时才取消生成本身。生成结束后立即移除，不缓存结果。
+    """
+
+    def __init__(self):
+        # (房间ID, 阶段, 轮次, 提示词) -> 进行中的生成
+        self._flights: Dict[Tuple[str, str, Optional[int], str], _Flight] = {}
+        # 执行的生成次数和复用进行中生成的次数
+        self.started = 0
+        self.joined = 0
+
+    async def run(
+        self,
+        room_id: str,
+        stage: str,
+        round_num: Optional[int],
+        prompt: str,
+        generate: Callable[[], Awaitable[Any]],
+    ) -> Any:
+        """执行生成，相同的生成正在进行时等待它的结果"""
+        key = (room_id, stage, round_num, prompt)
+        flight = self._flights.get(key)
+        if flight is None:
+            flight = _Flight(asyncio.create_task(generate()))
+            self._flights[key] = flight
+            flight.task.add_done_callback(lambda _: self._finish(key, flight))
+            self.started += 1
+        else:
+            self.joined += 1
+            logger.info("房间 %s 复用进行中的 %s 生成（轮次 %s）", room_id, stage, round_num)
+
+        flight.waiters += 1
+        try:
+            return await asyncio.shield(flight.task)
+        except asyncio.CancelledError:
+            if not flight.task.done() and flight.waiters == 1:
+                flight.task.cancel()
+            raise
+        finally:
+            flight.waiters -= 1
+
+    def _finish(self, key: Tuple[str, str, Optional[int], str], flight: _Flight):
+        if self._flights.get(key) is flight:
+            del self._flights[key]
+        # 没有等待者时取出异常，避免未处理的警告
+        if not flight.task.cancelled():
+            flight.task.exception()
+
+    def stats(self) -> Dict[str, int]:
+        """去重统计"""
+        return {
+            "in_flight": len(self._flights),
+            "started": self.started,
+            "joined": self.joined,
+        }
+
+
+# 全局生成去重实例
+single_flight = SingleFlight()
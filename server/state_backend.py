@@ -0,0 +1,203 @@
+from contextlib import nullcontext
+from typing import AsyncContextManager, Awaitable, Callable, Dict, List, Optional, Tuple
+import asyncio
+import json
+import logging
+import os
+import socket
+
+logger = logging.getLogger(__name__)
+
+# 房间状态后端: memory（默认，单进程）、redis（多个worker共享房间状态）
+STATE_BACKEND = os.getenv("STATE_BACKEND", "memory")
+REDIS_URL = os.getenv("REDIS_URL", "redis://localhost:6379/0")
+REDIS_KEY_PREFIX = os.getenv("REDIS_KEY_PREFIX", "startup-mod")
+# 跨worker房间锁的最长持有时间（秒），应长于最慢的命令（包括大模型生成和重试）
+ROOM_LOCK_TIMEOUT = float(os.getenv("ROOM_LOCK_TIMEOUT", "300"))
+# 当前worker的标识，用于忽略自己发布的广播
+WORKER_ID = os.getenv("WORKER_ID") or f"{socket.gethostname()}-{os.getpid()}"
+
+# 是否与其他worker共享房间状态
+SHARED_STATE = STATE_BACKEND == "redis"
+
+BusHandler = Callable[[Dict], Awaitable[None]]
+
+
+class MemoryRoomStore:
+    """单进程内存存储
+
+    房间对象本身就保存在RoomManager中，这里不需要再保存一份。
+    """
+
+    async def load(self, room_id: str) -> Optional[Tuple[int, str]]:
+        return None
+
+    async def save(
+        self, room_id: str, version: int, data: str, expected_version: Optional[int] = None
+    ) -> bool:
+        return True
+
+    async def delete(self, room_id: str):
+        pass
+
+    async def room_ids(self) -> List[str]:
+        return []
+
+    def lock(self, room_id: str) -> AsyncContextManager:
+        return nullcontext()
+
+
+# 比较并写入：存储中的版本号与预期一致（房间不存在时预期为-1）才写入快照
+_SAVE_SCRIPT = """
+local current = redis.call('HGET', KEYS[1], 'version')
+if (current or '-1') ~= ARGV[1] then
+    return 0
+end
+redis.call('HSET', KEYS[1], 'version', ARGV[2], 'data', ARGV[3])
+redis.call('SADD', KEYS[2], ARGV[4])
+return 1
+"""
+
+
+class RedisRoomStore:
+    """基于Redis的房间状态存储，保存每个房间的 (版本号, JSON快照)"""
+
+    def __init__(self, client):
+        self._redis = client
+        self._save_script = client.register_script(_SAVE_SCRIPT)
+
+    @staticmethod
+    def _key(room_id: str) -> str:
+        return f"{REDIS_KEY_PREFIX}:room:{room_id}"
+
+    async def load(self, room_id: str) -> Optional[Tuple[int, str]]:
+        """读取房间快照，不存在时返回None"""
+        version, data = await self._redis.hmget(self._key(room_id), "version", "data")
+        if data is None:
+            return None
+        return int(version or 0), data
+
+    async def save(
+        self, room_id: str, version: int, data: str, expected_version: Optional[int] = None
+    ) -> bool:
+        """保存房间快照
+
+        存储中的版本号不是expected_version（其他worker已经保存了更新的状态）时不写入，返回False。
+        expected_version为None表示房间还没有保存过。
+        """
+        saved = await self._save_script(
+            keys=[self._key(room_id), f"{REDIS_KEY_PREFIX}:rooms"],
+            args=[
+                -1 if expected_version is None else expected_version,
+                version,
+                data,
+                room_id,
+            ],
+        )
+        return bool(saved)
+
+    async def delete(self, room_id: str):
+        """删除房间快照"""
+        pipe = self._redis.pipeline()
+        pipe.delete(self._key(room_id))
+        pipe.srem(f"{REDIS_KEY_PREFIX}:rooms", room_id)
+        await pipe.execute()
+
+    async def room_ids(self) -> List[str]:
+        """所有已保存的房间ID"""
+        return list(await self._redis.smembers(f"{REDIS_KEY_PREFIX}:rooms"))
+
+    def lock(self, room_id: str) -> AsyncContextManager:
+        """跨worker的房间锁，同一房间的命令在所有worker之间串行执行"""
+        return self._redis.lock(
+            f"{REDIS_KEY_PREFIX}:lock:{room_id}",
+            timeout=ROOM_LOCK_TIMEOUT,
+            blocking_timeout=ROOM_LOCK_TIMEOUT,
+        )
+
+
+class MemoryBroadcastBus:
+    """单进程广播总线：没有其他worker，不需要转发"""
+
+    def subscribe(self, handler: BusHandler):
+        pass
+
+    async def publish(self, message: Dict):
+        pass
+
+    async def start(self):
+        pass
+
+    async def stop(self):
+        pass
+
+
+class RedisBroadcastBus:
+    """基于Redis发布订阅的广播总线，把房间事件转发给其他worker"""
+
+    def __init__(self, client):
+        self._redis = client
+        self._channel = f"{REDIS_KEY_PREFIX}:bus"
+        self._handlers: List[BusHandler] = []
+        self._pubsub = None
+        self._task: Optional[asyncio.Task] = None
+
+    def subscribe(self, handler: BusHandler):
+        """注册消息处理函数，收到其他worker发布的消息时调用"""
+        self._handlers.append(handler)
+
+    async def publish(self, message: Dict):
+        """向其他worker发布消息"""
+        await self._redis.publish(
+            self._channel, json.dumps({**message, "origin": WORKER_ID}, default=str)
+        )
+
+    async def start(self):
+        """开始接收其他worker发布的消息"""
+        if self._task:
+            return
+        self._pubsub = self._redis.pubsub()
+        await self._pubsub.subscribe(self._channel)
+        self._task = asyncio.create_task(self._listen())
+        logger.info(f"worker {WORKER_ID} 已订阅广播总线 {self._channel}")
+
+    async def stop(self):
+        """停止接收消息"""
+        if self._task:
+            self._task.cancel()
+            self._task = None
+        if self._pubsub:
+            await self._pubsub.aclose()
+            self._pubsub = None
+
+    async def _listen(self):
+        async for raw in self._pubsub.listen():
+            if raw.get("type") != "message":
+                continue
+            try:
+                message = json.loads(raw["data"])
+            except (TypeError, ValueError):
+                logger.warning("广播总线收到无法解析的消息")
+                continue
+            if message.get("origin") == WORKER_ID:
+                continue
+            for handler in self._handlers:
+                try:
+                    await handler(message)
+                except Exception as e:
+                    logger.error(f"处理广播总线消息失败: {e}")
+
+
+def _create_backend():
+    if not SHARED_STATE:
+        return MemoryRoomStore(), MemoryBroadcastBus()
+
+    import redis.asyncio as redis  # 只有使用redis后端时才需要
+
+    client = redis.from_url(REDIS_URL, decode_responses=True)
+    logger.info(f"房间状态使用Redis后端: {REDIS_URL}（worker {WORKER_ID}）")
+    return RedisRoomStore(client), RedisBroadcastBus(client)
+
+
+# 全局房间状态存储和广播总线实例
+room_store, broadcast_bus = _create_backend()
@@ -0,0 +1,5 @@
+import os
+import sys
+
+# 服务端模块按平级方式导入（与在server目录下运行app.py一致）
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
@@ -0,0 +1,82 @@
+"""不同房间的同一生成阶段发送完全相同的系统提示（可被服务端前缀缓存命中），房间内容只出现在用户消息中"""
+import asyncio
+import json
+from datetime import datetime
+from types import SimpleNamespace
+from typing import Dict, List
+
+import llm
+from room import GameRoom, Player, Role
+
+# 各阶段的示例输出，只用于通过输出结构校验
+OUTPUTS = {
+    "background": "# 游戏背景设定",
+    "roles": json.dumps(
+        {role.value: {"name": role.value.upper(), "description": "描述"} for role in Role}
+    ),
+    "event": json.dumps(
+        {
+            "situation": "局势",
+            "event": {
+                "event_title": "事件",
+                "event_description": "描述",
+                "decision_options": {"A": "选项"},
+            },
+        }
+    ),
+    "report": "结束语",
+}
+
+
+class FakeAsyncClient:
+    """代替AsyncOpenAI客户端，记录每个阶段发送的消息并返回示例输出"""
+
+    def __init__(self):
+        self.stage = ""
+        self.sent: Dict[str, List[List[Dict[str, str]]]] = {}
+        self.chat = SimpleNamespace(completions=SimpleNamespace(create=self.create))
+
+    async def create(self, model, messages, **kwargs):
+        self.sent.setdefault(self.stage, []).append(messages)
+        return SimpleNamespace(
+            choices=[SimpleNamespace(message=SimpleNamespace(content=OUTPUTS[self.stage]))],
+            usage=None,
+        )
+
+
+async def play(client: FakeAsyncClient, room_id: str, idea: str, names: List[str]):
+    room = GameRoom(room_id=room_id, created_at=datetime.now())
+    for name, role in zip(names, Role):
+        room.add_player(Player(name=name, joined_at=datetime.now(), startup_idea=idea))
+        room.set_player_role(name, role)
+    client.stage = "background"
+    background = await room.generate_background_from_ideas([idea])
+    client.stage = "roles"
+    await room.generate_roles_from_background(background + idea)
+    client.stage = "event"
+    for round_num in range(1, 3):
+        event = await room.generate_event(round_num)
+        room.set_round_event(round_num, event["event"], event["private_messages"])
+        room.set_round_situation(round_num + 1, f"{idea}第{round_num}轮的结果")
+        room.summarize_round(round_num)
+    client.stage = "report"
+    await room.generate_final_report()
+
+
+def test_system_prompt_identical_across_rooms(monkeypatch):
+    client = FakeAsyncClient()
+    monkeypatch.setattr(llm, "get_async_client", lambda *args, **kwargs: client)
+
+    async def main():
+        await play(client, "room-a", "面向大学生的二手教材交易平台", ["甲", "乙", "丙", "丁"])
+        await play(client, "room-b", "社区宠物寄养小程序", ["Alice", "Bob", "Carol", "Dave"])
+
+    asyncio.run(main())
+
+    assert set(client.sent) == set(OUTPUTS)
+    for stage, requests in client.sent.items():
+        assert all(messages[0]["role"] == "system" for messages in requests), stage
+        systems = {messages[0]["content"].encode("utf-8") for messages in requests}
+        assert len(systems) == 1, f"{stage} 的系统提示随房间变化"
+        users = {messages[-1]["content"] for messages in requests}
+        assert len(users) == len(requests), f"{stage} 的用户消息没有包含房间内容"
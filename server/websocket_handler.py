@@ -1,11 +1,14 @@
 from fastapi import WebSocket, WebSocketDisconnect
 import json
 import logging
+from typing import Optional
 
 from room import Player, MessageType
 from connection_manager import connection_manager
 from room_manager import room_manager
 from game_handler import game_handler
+from room_mailbox import room_mailboxes
+from shard_ring import shard_ring, to_websocket_url
 
 logger = logging.getLogger(__name__)
 
@@ -25,137 +28,40 @@ class WebSocketHandler:
 
             player_name = connect_data.get("player_name")
             room_id = connect_data.get("room_id")
+            # 客户端最后看到的房间状态版本号，重连时只发送之后的变化
+            last_version = connect_data.get("last_version")
+            if not isinstance(last_version, int):
+                last_version = None
 
             if not player_name or not room_id:
                 await websocket.close(code=4000, reason="缺少玩家名称或房间ID")
                 return
 
+            # 分片部署时，房间不属于当前worker则告知客户端重连到所属worker
+            owner_url = shard_ring.owner_url(room_id) if shard_ring else None
+            if owner_url:
+                await websocket.send_json({
+                    "type": MessageType.REDIRECT,
+                    "data": {"url": to_websocket_url(owner_url) + "/ws"},
+                })
+                await websocket.close(code=4010, reason="房间不在当前节点")
+                return
+
             # 建立连接
             await connection_manager.connect(websocket, player_name)
 
             # 检查房间是否存在
-            room = room_manager.get_room(room_id)
+            room = await room_manager.fetch_room(room_id)
             if not room:
                 await websocket.close(code=4004, reason=f"房间 {room_id} 不存在")
                 return
 
-            # 检查玩家是否已在房间中，如果不在则加入
-            player = room.get_player(player_name)
-            if not player:
-                # 玩家不在房间中，需要加入
-                room = room_manager.join_room(player_name, room_id)
-                player = room.get_player(player_name)
-                is_reconnect = False
-            else:
-                # 玩家已在房间中，设置为在线状态（重连）
-                player.is_online = True
-                is_reconnect = True
-
-            connection_manager.join_room(player_name, room.room_id)
-
-            # 只有在新加入时才广播玩家加入消息
-            if not is_reconnect:
-                await connection_manager.broadcast_to_room(
-                    room.room_id,
-                    {
-                        "type": MessageType.PLAYER_JOIN,
-                        "data": {
-                            "player_name": player_name,
-                            "players": [
-                                {
-                                    "name": p.name,
-                                    "is_online": p.is_online,
-                                    "role": p.role,
-                                    "startup_idea": p.startup_idea,
-                                    "isHost": p.is_host,
-                                }
-                                for p in room.players
-                            ],
-                        },
-                    },
-                )
-            else:
-                # 重连时，只向其他玩家发送玩家列表更新
-                await connection_manager.broadcast_to_room(
-                    room.room_id,
-                    {
-                        "type": MessageType.PLAYER_JOIN,
-                        "data": {
-                            "player_name": player_name,
-                            "players": [
-                                {
-                                    "name": p.name,
-                                    "is_online": p.is_online,
-                                    "role": p.role,
-                                    "startup_idea": p.startup_idea,
-                                    "isHost": p.is_host,
-                                }
-                                for p in room.players
-                            ],
-                        },
-                    },
-                    exclude_player=player_name,
-                )
-
-            # 发送连接成功消息，包含当前游戏状态信息
-            connection_data = {
-                "type": MessageType.CONNECTION_SUCCESS,
-                "data": {
-                    "room_id": room_id,
-                    "player_name": player_name,
-                    "is_reconnect": is_reconnect,
-                    # 手动传递room的主要属性，确保JSON序列化兼容
-                    "game_state": room.game_state.value if hasattr(room.game_state, 'value') else room.game_state,
-                    "current_round": room.current_round,
-                    "startup_idea": room.startup_idea,
-                    "background": room.background,
-                    "dynamic_roles": room.dynamic_roles,
-                    "game_result": room.game_result,
-                    "round_actions": room.round_actions,
-                    "round_events": room.round_events,
-                    "round_private_messages": room.round_private_messages,
-                    "dynamic_round_info": room.dynamic_round_info,
-                    # 格式化players数据以保持前端兼容性
-                    "players": [
-                        {
-                            "name": p.name,
-                            "is_online": p.is_online,
-                            "role": p.role,
-                            "startup_idea": p.startup_idea,
-                            "isHost": p.is_host,
-                        }
-                        for p in room.players
-                    ],
-                    # 添加一些计算属性
-                    "selected_roles": room.get_selected_roles(),
-                    "round_info": room.get_round_info(room.current_round),
-                },
-            }
-
-            # 根据游戏状态添加特定信息
-            if room.game_state == "loading":
-                connection_data["data"][
-                    "loading_message"
-                ] = f"AI正在生成第{room.current_round}轮事件，请稍候..."
-            elif room.game_state == "playing":
-                # 包含当前轮次的事件和私人信息
-                if room.round_events and room.current_round in room.round_events:
-                    connection_data["data"]["roundEvent"] = room.round_events[
-                        room.current_round
-                    ]
-                if (
-                    room.round_private_messages
-                    and room.current_round in room.round_private_messages
-                ):
-                    connection_data["data"]["privateMessages"] = (
-                        room.round_private_messages[room.current_round]
-                    )
-                if room.current_round in room.round_actions:
-                    connection_data["data"]["player_actions"] = room.round_actions[
-                        room.current_round
-                    ]
-
-            await websocket.send_text(json.dumps(connection_data))
+            # 加入房间、设置在线状态、广播和发送房间状态在房间命令队列中执行，
+            # 与同一房间的其他消息和断开按顺序处理
+            await room_mailboxes.run(
+                room_id,
+                lambda: WebSocketHandler._join_room(player_name, room_id, last_version),
+            )
 
         except ValueError as e:
             await websocket.close(code=4004, reason=str(e))
@@ -174,56 +80,229 @@ class WebSocketHandler:
                 await WebSocketHandler.handle_message(player_name, message_data)
 
         except WebSocketDisconnect:
-            await WebSocketHandler.handle_disconnect(player_name)
+            await WebSocketHandler.handle_disconnect(player_name, websocket)
+
+    @staticmethod
+    async def _join_room(player_name: str, room_id: str, last_version: Optional[int]):
+        """玩家加入或重连到房间，广播玩家列表并发送连接成功消息"""
+        # 排队期间房间可能已被删除
+        room = room_manager.get_room(room_id)
+        if not room:
+            raise ValueError(f"房间 {room_id} 不存在")
+
+        # 检查玩家是否已在房间中，如果不在则加入
+        player = room.get_player(player_name)
+        if not player:
+            # 玩家不在房间中，需要加入
+            room = room_manager.join_room(player_name, room_id)
+            player = room.get_player(player_name)
+            is_reconnect = False
+        else:
+            # 玩家已在房间中，设置为在线状态（重连）
+            room.set_player_online(player_name, True)
+            is_reconnect = True
+
+        connection_manager.join_room(player_name, room.room_id)
+
+        # 只有在新加入时才广播玩家加入消息
+        if not is_reconnect:
+            await connection_manager.broadcast_to_room(
+                room.room_id,
+                {
+                    "type": MessageType.PLAYER_JOIN,
+                    "data": {
+                        "player_name": player_name,
+                        "players": [
+                            {
+                                "name": p.name,
+                                "is_online": p.is_online,
+                                "role": p.role,
+                                "startup_idea": p.startup_idea,
+                                "isHost": p.is_host,
+                            }
+                            for p in room.players
+                        ],
+                    },
+                },
+            )
+        else:
+            # 重连时，只向其他玩家发送玩家列表更新
+            await connection_manager.broadcast_to_room(
+                room.room_id,
+                {
+                    "type": MessageType.PLAYER_JOIN,
+                    "data": {
+                        "player_name": player_name,
+                        "players": [
+                            {
+                                "name": p.name,
+                                "is_online": p.is_online,
+                                "role": p.role,
+                                "startup_idea": p.startup_idea,
+                                "isHost": p.is_host,
+                            }
+                            for p in room.players
+                        ],
+                    },
+                },
+                exclude_player=player_name,
+            )
+
+        # 发送连接成功消息，包含当前游戏状态信息
+        connection_data = WebSocketHandler._connection_success(
+            room, player_name, is_reconnect, last_version if is_reconnect else None
+        )
+
+        # 通过发送队列发送，保证与之前的广播消息顺序一致
+        await connection_manager.send_to_player(player_name, connection_data)
+
+    @staticmethod
+    def _connection_success(
+        room, player_name: str, is_reconnect: bool, last_version: Optional[int]
+    ) -> dict:
+        """构建连接成功消息，包含房间当前状态，提供了版本号时只包含之后变化的字段"""
+        connection_data = {
+            "type": MessageType.CONNECTION_SUCCESS,
+            "data": {
+                "room_id": room.room_id,
+                "player_name": player_name,
+                "is_reconnect": is_reconnect,
+                # 房间状态：重连且提供了版本号时只包含之后变化的字段
+                **room.sync_state(player_name, last_version),
+                # 格式化players数据以保持前端兼容性
+                "players": [
+                    {
+                        "name": p.name,
+                        "is_online": p.is_online,
+                        "role": p.role,
+                        "startup_idea": p.startup_idea,
+                        "isHost": p.is_host,
+                    }
+                    for p in room.players
+                ],
+                # 添加一些计算属性
+                "selected_roles": room.get_selected_roles(),
+                "round_info": room.get_round_info(room.current_round),
+            },
+        }
+
+        # 根据游戏状态添加特定信息
+        if room.game_state == "loading":
+            connection_data["data"][
+                "loading_message"
+            ] = f"AI正在生成第{room.current_round}轮事件，请稍候..."
+        elif room.game_state == "playing":
+            # 包含当前轮次的事件和私人信息
+            if room.round_events and room.current_round in room.round_events:
+                connection_data["data"]["roundEvent"] = room.round_events[
+                    room.current_round
+                ]
+            if (
+                room.round_private_messages
+                and room.current_round in room.round_private_messages
+            ):
+                connection_data["data"]["privateMessages"] = room.private_messages_for(
+                    player_name, room.round_private_messages[room.current_round]
+                )
+            if room.current_round in room.round_actions:
+                connection_data["data"]["player_actions"] = room.round_actions[
+                    room.current_round
+                ]
+        return connection_data
+
+    @staticmethod
+    async def resync_room(room):
+        """向本worker上该房间的在线玩家重新推送完整状态（本地修改因保存冲突被丢弃后）"""
+        for player in room.players:
+            if connection_manager.get_player_room(player.name) != room.room_id:
+                continue
+            await connection_manager.send_to_player(
+                player.name,
+                WebSocketHandler._connection_success(room, player.name, True, None),
+            )
 
     @staticmethod
     async def handle_message(player_name: str, message_data: dict):
-        """处理WebSocket消息"""
+        """处理WebSocket消息
+
+        同一房间的消息进入房间命令队列按到达顺序逐个处理，避免并发修改房间状态。
+        """
         try:
-            message_type = message_data.get("type")
-            data = message_data.get("data", {})
-
-            logger.info(f"收到玩家 {player_name} 的消息: {message_type}")
-
-            # 根据消息类型分发处理
-            if message_type == "startup_idea":
-                await game_handler.handle_startup_idea(player_name, data.get("idea"))
-            elif message_type == "start_game":
-                await game_handler.handle_start_game(player_name)
-            elif message_type == "select_role":
-                await game_handler.handle_role_selection(player_name, data.get("role"))
-            elif message_type == "game_action":
-                await game_handler.handle_game_action(player_name, data)
-            # continue_next_round消息处理已移除，因为现在自动进入下一轮
-            elif message_type == "restart_game":
-                await game_handler.handle_restart_game(player_name)
+            room_id = connection_manager.get_player_room(player_name)
+            if room_id:
+                await room_mailboxes.run(
+                    room_id,
+                    lambda: WebSocketHandler._dispatch_message(player_name, message_data),
+                )
             else:
-                logger.warning(f"未知消息类型: {message_type}")
+                await WebSocketHandler._dispatch_message(player_name, message_data)
 
         except Exception as e:
-            logger.error(f"处理WebSocket消息失败: {e}")
+            logger.error("处理WebSocket消息失败: %s", e)
 
     @staticmethod
-    async def handle_disconnect(player_name: str):
-        """处理玩家断开连接"""
+    async def _dispatch_message(player_name: str, message_data: dict):
+        """根据消息类型调用对应的处理函数"""
+        message_type = message_data.get("type")
+        data = message_data.get("data", {})
+
+        logger.debug("收到玩家 %s 的消息: %s", player_name, message_type)
+
+        # 根据消息类型分发处理
+        if message_type == "startup_idea":
+            await game_handler.handle_startup_idea(player_name, data.get("idea"))
+        elif message_type == "start_game":
+            await game_handler.handle_start_game(player_name)
+        elif message_type == "select_role":
+            await game_handler.handle_role_selection(player_name, data.get("role"))
+        elif message_type == "game_action":
+            await game_handler.handle_game_action(player_name, data)
+        # continue_next_round消息处理已移除，因为现在自动进入下一轮
+        elif message_type == "restart_game":
+            await game_handler.handle_restart_game(player_name)
+        else:
+            logger.warning("未知消息类型: %s", message_type)
+
+    @staticmethod
+    async def handle_disconnect(player_name: str, websocket: WebSocket):
+        """处理玩家断开连接，同一房间的断开与消息在房间命令队列中按顺序处理"""
+        room_id = connection_manager.get_player_room(player_name)
+        if room_id:
+            await room_mailboxes.run(
+                room_id,
+                lambda: WebSocketHandler._handle_disconnect(player_name, websocket),
+            )
+        else:
+            await WebSocketHandler._handle_disconnect(player_name, websocket)
+
+    @staticmethod
+    async def _handle_disconnect(player_name: str, websocket: WebSocket):
+        # 排队期间玩家已经用新连接重连，旧连接的断开不再处理
+        if connection_manager.has_newer_connection(player_name, websocket):
+            logger.info("玩家 %s 已重新连接，忽略旧连接的断开", player_name)
+            return
+
         # 先获取玩家所在房间ID（在断开连接之前）
         room_id = connection_manager.get_player_room(player_name) or ""
-        
+
         # 处理玩家离线
         if room_id:
             room = room_manager.get_room(room_id)
             if room:
                 # 先检查房间是否还有其他在线玩家（在移除当前玩家之前）
-                other_online_players = [p for p in room.get_online_players() if p.name != player_name]
-                logger.info(f"玩家 {player_name} 断开连接前，房间 {room_id} 还有 {len(other_online_players)} 个其他在线玩家")
+                player = room.get_player(player_name)
+                other_online_count = room.online_player_count() - (
+                    1 if player and player.is_online else 0
+                )
+                logger.info("玩家 %s 断开连接前，房间 %s 还有 %s 个其他在线玩家", player_name, room_id, other_online_count)
                 
                 # 移除玩家（设为离线状态）
                 room.remove_player(player_name)
-                logger.info(f"玩家 {player_name} 离开房间 {room_id}")
+                logger.info("玩家 %s 离开房间 %s", player_name, room_id)
 
                 # 如果还有其他在线玩家，先通知他们玩家离开
-                if other_online_players:
-                    logger.info(f"向房间 {room_id} 中的 {len(other_online_players)} 个在线玩家广播 {player_name} 离开消息")
+                if other_online_count:
+                    logger.info("向房间 %s 中的 %s 个在线玩家广播 %s 离开消息", room_id, other_online_count, player_name)
                     await connection_manager.broadcast_to_room(
                         room_id,
                         {
@@ -243,20 +322,20 @@ class WebSocketHandler:
                             },
                         },
                     )
-                    logger.info(f"已完成广播 {player_name} 离开消息")
+                    logger.info("已完成广播 %s 离开消息", player_name)
                 else:
-                    logger.info(f"房间 {room_id} 没有其他在线玩家，跳过广播离开消息")
+                    logger.info("房间 %s 没有其他在线玩家，跳过广播离开消息", room_id)
                 
                 # 检查房间是否还有在线玩家（移除当前玩家后的状态）
-                remaining_online_players = room.get_online_players()
-                logger.info(f"房间 {room_id} 在 {player_name} 离开后还有 {len(remaining_online_players)} 个在线玩家")
+                remaining_online_count = room.online_player_count()
+                logger.info("房间 %s 在 %s 离开后还有 %s 个在线玩家", room_id, player_name, remaining_online_count)
                 
-                if not remaining_online_players:
+                if not remaining_online_count:
                     # 房间没有在线玩家，删除房间
                     room_manager.remove_room(room_id)
-                    logger.info(f"房间 {room_id} 已清理：无在线玩家")
+                    logger.info("房间 %s 已清理：无在线玩家", room_id)
                 else:
-                    logger.info(f"房间 {room_id} 保留：还有在线玩家 {[p.name for p in remaining_online_players]}")
+                    logger.info("房间 %s 保留：还有 %s 个在线玩家", room_id, remaining_online_count)
 
         # 最后断开WebSocket连接
         connection_manager.disconnect(player_name)
@@ -264,3 +343,4 @@ class WebSocketHandler:
 
 # 全局WebSocket处理器实例
 websocket_handler = WebSocketHandler()
+room_manager.add_resync_listener(WebSocketHandler.resync_room)